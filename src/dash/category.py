@@ -6,16 +6,24 @@ Created on Jul 18, 2013
 
 import csv
 
+# Default location of the alias owners file, DAM.config can point somewhere else with "categoryfile"
+CSVPATH = '/homes/richilb/workspace/DAM/src/bin/bug_alias_owners.csv'
+
 class Category(object):
     
     '''
     Get the data from bug_alias_owners.csv which was generated by the script and build a dictionary out of it:
     For the dictionary: {key: 'SPOC'; Value: 'Category, alias, SPOC'} 
+    The rows are split once here into frozen sets so that lookups do not have to parse them again:
+    aliasdict (user -> aliases), categorydict (user -> categories), aliasuserdict (alias -> users)
+    and allcategories.
     '''
-    def __init__(self):
+    def __init__(self, csvpath=None):
+        if csvpath is None:
+            csvpath = CSVPATH
         self.catdict = {}
         try:
-            spamReader = csv.reader(open('/homes/richilb/workspace/DAM/src/bin/bug_alias_owners.csv'), delimiter=' ', quotechar='|')
+            spamReader = csv.reader(open(csvpath), delimiter=' ', quotechar='|')
             for row in spamReader:
                 # print row[0].split(",")[2]
                 column = row[0].split(",")
@@ -26,27 +34,45 @@ class Category(object):
             self.catdict = None
             print e.message
         
+        aliasdict = {}
+        categorydict = {}
+        aliasuserdict = {}
+        for user, rows in (self.catdict or {}).items():
+            for value in rows:
+                column = value.split(',')
+                categorydict.setdefault(user, set()).add(column[0])
+                aliasdict.setdefault(user, set()).add(column[1])
+                aliasuserdict.setdefault(column[1], set()).add(user)
+        self.aliasdict = dict((user, frozenset(v)) for user, v in aliasdict.items())
+        self.categorydict = dict((user, frozenset(v)) for user, v in categorydict.items())
+        self.aliasuserdict = dict((alias, frozenset(v)) for alias, v in aliasuserdict.items())
+        self.allcategories = frozenset().union(*self.categorydict.values())
+        
     # Generate a list of all aliases for a particular user        
     def listAliasForUser(self, username):
-        if self.catdict.get(username) != None:
-            aliasList =  [value.split(',')[1] for value in self.catdict.get(username)]
-            return list(set(aliasList))
+        if username in self.aliasdict:
+            return list(self.aliasdict[username])
         else:
             return None
     
     # Generate a list of all Categoriess for a particular user
     def listCategoriesForUser(self, username):
-        if self.catdict.get(username) != None:
-            catList = [value.split(',')[0] for value in self.catdict.get(username)]
-            return list(set(catList))
+        if username in self.categorydict:
+            return list(self.categorydict[username])
+        else:
+            return None
+    
+    # Generate a list of all users owning a particular alias
+    def listUsersForAlias(self, alias):
+        if alias in self.aliasuserdict:
+            return list(self.aliasuserdict[alias])
         else:
             return None
     
     # Generate a list of all categories in the JUNOS system
     def listAllCategories(self):
-        catList = []
-        for key, value in self.catdict.items():
-            for v in value:
-                catList.append(v.split(',')[0])
-            
-        return list(set(catList))
+        return list(self.allcategories)
+    
+    # Check whether a category is in the JUNOS system
+    def isCategory(self, category):
+        return category in self.allcategories
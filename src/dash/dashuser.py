@@ -6,16 +6,90 @@ Created on Jul 19, 2013
 
 import os
 import re
+import json
+import time
+import threading
+
+LDAPSEARCH = "ldapsearch -x -b 'dc=juniper, dc=net' -h authldap.juniper.net 'authGroupName=dashboard-users' | grep uid"
+UIDRE = re.compile('uid=(.*?),')
+
+# Seconds for which a snapshot in the cache file is used as is
+CACHETTL = 24 * 60 * 60
 
 class Dashuser(object):
-    
-    
-    # Get the list of all dashboard users from ldap and store it in dashuserlist 
-    def __init__(self):
-        self.dashuserlist = []
-        for line in os.popen("ldapsearch -x -b 'dc=juniper, dc=net' -h authldap.juniper.net 'authGroupName=dashboard-users' | grep uid"):
-            r = re.compile('uid=(.*?),')
-            m = r.search(line)
+
+    '''
+    Get the set of all dashboard users and store it in dashuserlist.
+    The users come from, in order of preference:
+      ldiffile  - an LDIF dump (e.g. saved ldapsearch output), LDAP is not contacted at all
+      cachefile - the snapshot saved by the last LDAP search; if it is older than ttl seconds it
+                  is still used, but a background thread searches LDAP again and swaps in the result
+      ldapsearch, which is then saved to cachefile (if one was given)
+    '''
+    def __init__(self, cachefile=None, ttl=None, ldiffile=None):
+        if ttl is None:
+            ttl = CACHETTL
+        self.cachefile = cachefile
+        self.ttl = ttl
+        self.refresher = None
+
+        if ldiffile is not None:
+            self.dashuserlist = self.parse(open(ldiffile))
+            return
+
+        snapshot = self.readCache()
+        if snapshot is None:
+            self.refresh()
+            return
+
+        timestamp, self.dashuserlist = snapshot
+        if time.time() - timestamp >= ttl:
+            self.refresher = threading.Thread(target=self.refresh)
+            self.refresher.setDaemon(True)
+            self.refresher.start()
+
+    # Pick the user ids out of ldapsearch/LDIF output lines
+    def parse(self, lines):
+        users = set()
+        for line in lines:
+            m = UIDRE.search(line)
             if m:
-                self.dashuserlist.append(m.group(1))
+                users.add(m.group(1))
+        return users
+
+    # Search LDAP for the dashboard users, swap them in and save them to the cache file
+    def refresh(self):
+        users = self.parse(os.popen(LDAPSEARCH))
+        if len(users) == 0 and self.refresher is not None:
+            # the search failed, keep going with the old snapshot
+            return
+        self.dashuserlist = users
+        self.writeCache(users)
+
+    # Return (timestamp, users) saved in the cache file, or None if there is no usable snapshot
+    def readCache(self):
+        if self.cachefile is None or not os.path.exists(self.cachefile):
+            return None
+        try:
+            snapshot = json.load(open(self.cachefile))
+            return snapshot['timestamp'], set(str(u) for u in snapshot['users'])
+        except Exception, e:
+            print 'Ignoring dashboard user cache %s: %s' % (self.cachefile, e)
+            return None
+
+    def writeCache(self, users):
+        if self.cachefile is None or len(users) == 0:
+            return
+        try:
+            # write aside and rename, so a reader never sees a half written file
+            tmpfile = '%s.%d' % (self.cachefile, os.getpid())
+            f = open(tmpfile, 'w')
+            json.dump({'timestamp': time.time(), 'users': sorted(users)}, f)
+            f.close()
+            os.rename(tmpfile, self.cachefile)
+        except Exception, e:
+            print 'Could not save dashboard user cache %s: %s' % (self.cachefile, e)
 
+    # Check whether a user is a dashboard user
+    def isDashuser(self, username):
+        return username in self.dashuserlist
@@ -29,22 +29,69 @@ class Hier(object):
             report = arr[reportIDX]
             manager = arr[managerIDX]
             self.empdict.setdefault(manager, []).append(report)
-    
+        
+        self.buildIndex()
     
     '''
-    Recursively traverses through the employee dictionary to return the hierarchy of reporting members of a particular manager.
+    Index the org chart once so that lookups do not have to walk empdict:
+      managerdict - reverse map of report -> manager (a person listed under several managers
+                    is filed under the first one)
+      tourlist    - every person in depth-first order, so that all the reports of X are the slice
+                    tourlist[tin[X] + 1 : tout[X] + 1] and A is under B if tin[B] < tin[A] <= tout[B]
+      cycles      - reporting loops found in the data; each loop is cut above its first member
+    Sorted report lists are memoized in subtreedict as they are asked for.
     '''
-    def __all_reports(self, manager, reportslist):
-        nextlevelreports = self.reports(manager, 1)
-        if nextlevelreports is not None:
-            for report in nextlevelreports:
-                reportslist.append(report)
-                if self.reports(report, 1) is not None:
-                    self.__all_reports(report, reportslist)
-                else:
+    def buildIndex(self):
+        self.managerdict = {}
+        for manager, reports in self.empdict.items():
+            for report in reports:
+                self.managerdict.setdefault(report, manager)
+        
+        childdict = {}
+        for report, manager in self.managerdict.items():
+            childdict.setdefault(manager, []).append(report)
+        
+        roots = [manager for manager in self.empdict if manager not in self.managerdict]
+        self.cycles = []
+        self.tourlist = []
+        self.tin = {}
+        self.tout = {}
+        self.subtreedict = {}
+        
+        self.__tour(roots, childdict)
+        # whoever was not reached hangs off a reporting loop
+        for person in self.managerdict.keys():
+            if person in self.tin:
+                continue
+            chain = [person]
+            seen = set(chain)
+            while self.managerdict[chain[-1]] not in seen:
+                chain.append(self.managerdict[chain[-1]])
+                seen.add(chain[-1])
+            cycle = chain[chain.index(self.managerdict[chain[-1]]):]
+            if cycle[0] in self.tin:
+                continue
+            print 'Reporting loop in org chart: %s' % ' -> '.join(cycle + [cycle[0]])
+            self.cycles.append(cycle)
+            childdict[self.managerdict[cycle[0]]].remove(cycle[0])
+            self.__tour([cycle[0]], childdict)
+    
+    # Iterative depth-first walk from each root, numbering people in the order they are visited
+    def __tour(self, roots, childdict):
+        for root in roots:
+            self.tin[root] = len(self.tourlist)
+            self.tourlist.append(root)
+            stack = [(root, iter(childdict.get(root, ())))]
+            while stack:
+                person, children = stack[-1]
+                child = next(children, None)
+                if child is None:
+                    self.tout[person] = len(self.tourlist) - 1
+                    stack.pop()
                     continue
-                
-        return reportslist
+                self.tin[child] = len(self.tourlist)
+                self.tourlist.append(child)
+                stack.append((child, iter(childdict.get(child, ()))))
     
     '''
     reports(manager , directflag)
@@ -60,16 +107,40 @@ class Hier(object):
         direct_reports = reports("sofiane", 1); 
     '''
     def reports(self, manager, flag):
-        try:
-            if flag == 1:
-                return sorted(self.empdict[manager], key=str.lower)
-            elif flag == 0:
-                return sorted(self.__all_reports(manager, []), key=str.lower)
-            else:
+        if flag == 1:
+            if manager not in self.empdict:
                 return None
-        except KeyError:
+            return sorted(self.empdict[manager], key=str.lower)
+        elif flag == 0:
+            # callers append to the list they get, so hand out a copy of the memoized one
+            return list(self.__all_reports(manager))
+        else:
             return None
     
+    # Sorted tuple of everyone under a manager, computed from the tour on first use
+    def __all_reports(self, manager):
+        if manager not in self.subtreedict:
+            if manager in self.empdict:
+                allreports = self.tourlist[self.tin[manager] + 1 : self.tout[manager] + 1]
+            else:
+                allreports = []
+            self.subtreedict[manager] = tuple(sorted(allreports, key=str.lower))
+        return self.subtreedict[manager]
+    
+    '''
+    isUnder(username, manager)
+
+    =>  Check whether a person reports, directly or not, to a given manager.
+      Returns:
+        True or False
+      Example:
+        if isUnder("alex", "sofiane"): ...
+    '''
+    def isUnder(self, username, manager):
+        if username not in self.tin or manager not in self.tin:
+            return False
+        return self.tin[manager] < self.tin[username] <= self.tout[manager]
+    
     '''
     managers(manager , directflag)
 
@@ -109,9 +180,7 @@ class Hier(object):
         mgr = manager("alex");
     '''
     def manager(self, username):
-        for manager, reports in self.empdict.items():
-            if username in reports:
-                return manager
+        return self.managerdict.get(username)
         
     '''
     unmanaged()
@@ -141,8 +210,8 @@ class Hier(object):
     '''
     def unmanaged_managers(self):
         unmanagedmgrlist = list()
-        for manager, reports in self.empdict.items():
-            if self.manager(manager) is None  and manager != '':
+        for manager in self.empdict:
+            if manager not in self.managerdict and manager != '':
                 unmanagedmgrlist.append(manager)
         
         return sorted(unmanagedmgrlist, key=str.lower)
@@ -14,6 +14,14 @@ class Login(object):
     def __init__(self):
         self.__username = 'dashboard'
         self.__password = 'dashboard'
+        
+        # Every Login owns its own opener instead of installing one globally,
+        # so that several verification workers can scrape at the same time.
+        self.__passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        
+        # create the AuthHandler
+        authhandler = urllib2.HTTPBasicAuthHandler(self.__passman)
+        self.__opener = urllib2.build_opener(authhandler)
  
     
     # Access the dashboard web page by specifying login credentials and other details    
@@ -21,18 +29,11 @@ class Login(object):
         if url == None:
             url = 'https://deepthought.juniper.net/dashboard/agenda/junos'
             
-        passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-        passman.add_password(None, url, self.__username, self.__password)
-        
-        # create the AuthHandler
-        authhandler = urllib2.HTTPBasicAuthHandler(passman)
-        opener = urllib2.build_opener(authhandler)
-        urllib2.install_opener(opener)
+        self.__passman.add_password(None, url, self.__username, self.__password)
         
-        # ...and install it globally so it can be used with urlopen.
         page = None
         try:
-            page = urllib2.urlopen(url).read()
+            page = self.__opener.open(url).read()
         except urllib2.HTTPError:
             print "** Error in connecting to dashboard: connection timeout... "
             sys.exit() 
@@ -5,19 +5,33 @@ Created on Jun 12, 2013
 '''
 
 
-import os, gnats, getpass, copy, datetime
+import os, gnats, getpass, copy, datetime, re
 from hier import Hier
 from category import Category
 from dashuser import Dashuser
 
 class Rule(object):
     
-    # Initialize the connection string required to connect to GNATS database
-    def __init__(self):
-        self.hier = Hier()
-        self.category = Category()
-        self.dashuser = Dashuser()
-        
+    '''
+    Initialize the connection string required to connect to GNATS database.
+    The org chart, category and dashboard user data may be passed in so that several
+    Rule objects (one per verification worker) can share them.
+    '''
+    def __init__(self, hier=None, category=None, dashuser=None, prcache=None):
+        if hier is None:
+            hier = Hier()
+        if category is None:
+            category = Category()
+        if dashuser is None:
+            dashuser = Dashuser()
+        self.hier = hier
+        self.category = category
+        self.dashuser = dashuser
+        # PR lists filled by prefetchPRs() in bulk mode: {ruletype: {user: PRlist}}
+        if prcache is None:
+            prcache = {}
+        self.prcache = prcache
+
         host = 'gnats.juniper.net'
         db = 'default'
         
@@ -27,10 +41,18 @@ class Rule(object):
         
         # Get a database object, which holds the metadata (field names, etc.)
         self.db_obj = gnats.get_database(host, db)
-        # Get a db handle, a connection to the server
-        self.db_handle = self.db_obj.get_handle(username, passwd='*')
+        self.username = username
+
+    # Get a db handle for one query; its connection is borrowed from the server's pool
+    # and given back when the handle is closed, so queries don't each open a connection
+    def getHandle(self):
+        return self.db_obj.get_handle(self.username, passwd='*', pooled=True)
+
+    # Create a Rule for a verification worker: it shares the lookup data of this one
+    # (a handle must not be used by two threads, so every query takes its own from the pool)
+    def spawn(self):
+        return Rule(self.hier, self.category, self.dashuser, self.prcache)
 
-    
     # build an OR query e.g.: (responsible == "user1" | responsible == "user2"...)
     def getORquery(self, field, userlist, op = '=='):
         
@@ -56,12 +78,7 @@ class Rule(object):
         # we should also consider count of that user if he/she is a manager 
         userlist.append(responsible)
         # remove those users which are not junos dashboard users
-        userlistcopy = copy.copy(userlist)
-        for user in userlistcopy:
-            if user not in self.dashuser.dashuserlist:
-                userlist.remove(user)
-        
-        return userlist
+        return [user for user in userlist if user in self.dashuser.dashuserlist]
         
         
     '''
@@ -92,7 +109,9 @@ class Rule(object):
     def getCategoryOwnerQuery(self, responsible):
         aliaslist = self.buildCatAliasList(responsible)
         catlist = self.buildCatAliasList(responsible, 0)
-        
+        return self.buildCategoryOwnerQuery(aliaslist, catlist)
+    
+    def buildCategoryOwnerQuery(self, aliaslist, catlist):
         if len(aliaslist) > 0:
             return '| (%(1)s & (dev-owner == "" | %(2)s) & %(3)s)' % {"1": self.getORquery('responsible', aliaslist), \
                                                                       "2": self.getORquery('dev-owner', aliaslist, '~'), \
@@ -138,14 +157,38 @@ class Rule(object):
     & blocker == "test"
     & (state != "closed" & state != "suspended" & state != "monitored") 
     & product[group] == "junos"
+    If since is given only the PRs last modified at or after that time are returned.
     '''
-    def getPRlist(self, responsible, ruletype):
+    def getPRlist(self, responsible, ruletype, since=None):
+        # In bulk mode the list was already fetched along with those of the other users
+        cached = self.prcache.get(self.cacheKey(ruletype, since), {}).get(responsible)
+        if cached is not None:
+            return list(cached)
+        
         # The columns we want, and the query
         columns = ['number', 'last-modified']
 
         # Build the junosuserlist which are users who fall under junos dashboard
         junosuserlist = self.buildJunosUserList(responsible)
         # print 'Junos user list', junosuserlist        
+        expr = self.buildRuleQuery(junosuserlist, self.getCategoryOwnerQuery(responsible), ruletype, since)
+        
+        
+        #print 'Expression used: %s ' % expr
+        
+        try:
+            # Run the query, the rows are read off the socket as we go
+            PRlist = []
+            with self.getHandle() as db_handle:
+                for prno in db_handle.iter_query(expr, columns):
+                    PRlist.append(str(prno[0]))
+            return PRlist
+        except gnats.GnatsException, err:
+            print "Error in query: %s" % err.message
+            return 0
+    
+    # Build the query-pr expression of getPRlist() for a list of junos users and a category owner clause
+    def buildRuleQuery(self, junosuserlist, categoryquery, ruletype, since=None):
         expr = ''' (   %(1)s | 
                        (%(2)s & state != "feedback") 
                        %(3)s
@@ -154,21 +197,90 @@ class Rule(object):
                     & (state != "closed" & state != "suspended" & state != "monitored")  
                     & product[group] == "junos" ''' \
         % {"1": self.getORquery('responsible', junosuserlist), "2": self.getORquery('dev-owner', junosuserlist), \
-           "3": self.getCategoryOwnerQuery(responsible), "4": self.getQueryForRuleType(ruletype)}
-        
-        
-        #print 'Expression used: %s ' % expr
+           "3": categoryquery, "4": self.getQueryForRuleType(ruletype)}
+        if since is not None:
+            expr += '& last-modified >= "%s" ' % since
+        return expr
+    
+    # prcache key of the PR lists fetched for a rule type, since is the same as for getPRlist()
+    def cacheKey(self, ruletype, since=None):
+        if since is None:
+            return ruletype
+        return (ruletype, since)
+    
+    '''
+    Bulk mode: fire a single query for the union of the users in usernamelist and work out the
+    PR list of every user from the responsible, dev-owner, category and state columns, applying
+    the same conditions getPRlist() would have put in that user's own query.
+    The lists are kept in prcache, which getPRlist() looks at before going to gnatsd, so a run
+    costs one query per rule type instead of one per rule type and user.
+    '''
+    def prefetchPRs(self, ruletype, usernamelist, since=None):
+        users = {}
+        alljunosusers = set()
+        allaliases = set()
+        allcategories = set()
+        for user in usernamelist:
+            junosusers = set(self.buildJunosUserList(user))
+            aliaslist = self.buildCatAliasList(user)
+            catlist = set(self.buildCatAliasList(user, 0))
+            users[user] = (junosusers, aliaslist, catlist)
+            alljunosusers.update(junosusers)
+            allaliases.update(aliaslist)
+            allcategories.update(catlist)
         
+        columns = ['number', 'responsible', 'dev-owner', 'category', 'state']
+        expr = self.buildRuleQuery(sorted(alljunosusers),
+                                   self.buildCategoryOwnerQuery(sorted(allaliases), sorted(allcategories)),
+                                   ruletype, since)
+        PRlists = dict((user, []) for user in usernamelist)
         try:
-            # Run the query
-            prs = self.db_handle.query(expr, columns, sort=(('number', 'desc'),))
-            PRlist = []
-            for prno in prs:
-                PRlist.append(str(prno[0]))
-            return PRlist
+            with self.getHandle() as db_handle:
+                for prno in db_handle.iter_query(expr, columns):
+                    number, responsible, devowner, category, state = [str(v) for v in prno]
+                    for user, (junosusers, aliaslist, catlist) in users.items():
+                        if self.isOwner(responsible, devowner, category, state, junosusers, aliaslist, catlist):
+                            PRlists[user].append(number)
         except gnats.GnatsException, err:
             print "Error in query: %s" % err.message
-            return 0
+            return
+        self.prcache[self.cacheKey(ruletype, since)] = PRlists
+    
+    # Client side equivalent of the ownership part of the query built by getPRlist()
+    def isOwner(self, responsible, devowner, category, state, junosusers, aliaslist, catlist):
+        if responsible in junosusers:
+            return True
+        if devowner in junosusers and state != 'feedback':
+            return True
+        if responsible in aliaslist and category in catlist:
+            # dev-owner ~ "alias" is a regular expression match in query-pr
+            return devowner == '' or any(re.search(alias, devowner) for alias in aliaslist)
+        return False
+
+    '''
+    Get the PRs last modified at or after a given time, for incremental verification.
+    Returns the set of their numbers (without scope) and the latest last-modified value among
+    them, which is where the next incremental run can start from; (None, None) on error.
+    PRs of any product are included, so that PRs moved out of junos are re-checked too; each
+    rule's own query filters them.  Dates have one-second resolution, so PRs modified in the
+    same second as the watermark are fetched again rather than missed.
+    '''
+    def getModifiedPRs(self, since):
+        columns = ['number', 'last-modified']
+        expr = 'last-modified >= "%s"' % since
+        modified = set()
+        watermark = None
+        try:
+            with self.getHandle() as db_handle:
+                for prno in db_handle.iter_query(expr, columns):
+                    modified.add(str(prno[0]).split('-')[0])
+                    # the server prints every date in the same format, so the strings sort by time
+                    if watermark is None or str(prno[1]) > watermark:
+                        watermark = str(prno[1])
+        except gnats.GnatsException, err:
+            print "Error in query: %s" % err.message
+            return None, None
+        return modified, watermark
 
     '''
     Get PR number, last modified datetime, responsible and category values for the PRs in the list provided.
@@ -180,16 +292,17 @@ class Rule(object):
         expr = '%s' % self.getORquery('number', [PR for PR in PRlist])
         try:
             # Run the query
-            prs = self.db_handle.query(expr, columns, sort=(('number', 'desc'),))
+            with self.getHandle() as db_handle:
+                prs = db_handle.query(expr, columns, sort=(('number', 'desc'),))
             PRdict = {}
             for prno in prs:
                 # if responsible is not in junos system discard the discrepancy
-                if (prno[2] not in self.dashuser.dashuserlist) or (prno[2] not in self.category.listAllCategories()):
+                if (prno[2] not in self.dashuser.dashuserlist) or not self.category.isCategory(prno[2]):
                     #print 'user removed: ', prno[2]
                     continue
                 
                 # if category is not in junos system discard the discrepancy
-                if prno[3] not in self.category.listAllCategories():
+                if not self.category.isCategory(prno[3]):
                     #print 'category removed: ', prno[3]
                     continue
                 
@@ -8,8 +8,12 @@ import json, sys
 from verify import Verify
 
 
-if len(sys.argv) > 1:
-    RUNPATH = sys.argv[1]
+# --full forces a full run when incremental verification is on
+args = [arg for arg in sys.argv[1:] if arg != '--full']
+FULLRESYNC = '--full' in sys.argv[1:]
+
+if len(args) > 0:
+    RUNPATH = args[0]
 else:
     RUNPATH = '../bin'
     
@@ -22,13 +26,37 @@ data = json.loads(config_data)
 USERLIST = [json.dumps(u).strip('"') for u in data["userlist"]] 
 RULELIST = [json.dumps(r).strip('"') for r in data["rulelist"]]
 SERVER = json.dumps(data["server"]).strip('"')
+# Number of (rule, user) pairs verified in parallel, 1 keeps the serial run
+WORKERS = int(data.get("workers", 1))
+# Query GNATS once per rule type for all users instead of once per user and rule type
+BULK = bool(data.get("bulk", False))
+# bug_alias_owners.csv generated by the alias owners script, None uses the default location
+CATEGORYFILE = data.get("categoryfile")
+# Snapshot of the LDAP dashboard users and how long (in seconds) it is used before searching LDAP again
+DASHUSERCACHE = data.get("dashusercache", RUNPATH + '/dashusers.cache')
+DASHUSERTTL = data.get("dashuserttl")
+# LDIF file to read the dashboard users from instead of LDAP
+DASHUSERFILE = data.get("dashuserfile")
+# Incremental verification: PR lists of the previous run are kept in the state file and only
+# PRs modified since are queried again; every resyncinterval seconds the run is a full one
+STATEFILE = data.get("statefile")
+RESYNCINTERVAL = data.get("resyncinterval")
 
 print 'Runpath: ', RUNPATH
 print 'Logpath: ', LOGPATH
 print 'Server from config file: ', SERVER
 print 'Userlist from config file: ', USERLIST
 print 'Rulelist from config file: ', RULELIST
+print 'Workers from config file: ', WORKERS
+print 'Bulk mode from config file: ', BULK
+print 'Category file from config file: ', CATEGORYFILE
+print 'Dashboard user cache from config file: ', DASHUSERCACHE
+print 'Dashboard user file from config file: ', DASHUSERFILE
+print 'State file from config file: ', STATEFILE
+print 'Full run requested: ', FULLRESYNC
  
 
-v = Verify(LOGPATH, SERVER)
+v = Verify(LOGPATH, SERVER, WORKERS, BULK, CATEGORYFILE,
+           dashusercache=DASHUSERCACHE, dashuserttl=DASHUSERTTL, dashuserfile=DASHUSERFILE,
+           statefile=STATEFILE, resyncinterval=RESYNCINTERVAL, fullresync=FULLRESYNC)
 v.run(USERLIST, RULELIST)
@@ -0,0 +1,60 @@
+'''
+Verification state kept between DAM runs, for incremental verification.
+'''
+
+import json
+import os
+import time
+
+class State(object):
+
+    '''
+    Load the state saved by the previous run from a JSON file:
+      prlists   - GNATS PR list of every (rule type, user) pair
+      watermark - last-modified time from which GNATS has to be asked for changes again
+      lastfull  - time of the last run that queried every pair in full
+    A missing or unreadable file gives an empty state, i.e. a full run.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.prlists = {}
+        self.watermark = None
+        self.lastfull = 0
+        if not os.path.exists(path):
+            return
+        try:
+            data = json.load(open(path))
+            self.prlists = dict((str(key), [str(PR) for PR in PRlist]) for key, PRlist in data['prlists'].items())
+            if data['watermark'] is not None:
+                self.watermark = str(data['watermark'])
+            self.lastfull = data['lastfull']
+        except Exception, e:
+            print 'Ignoring verification state %s: %s' % (path, e)
+            self.prlists = {}
+            self.watermark = None
+            self.lastfull = 0
+
+    def key(self, ruletype, user):
+        return '%s|%s' % (ruletype, user)
+
+    # PR list stored for a rule type and user, or None if there is none
+    def get(self, ruletype, user):
+        PRlist = self.prlists.get(self.key(ruletype, user))
+        if PRlist is None:
+            return None
+        return list(PRlist)
+
+    def set(self, ruletype, user, PRlist):
+        self.prlists[self.key(ruletype, user)] = list(PRlist)
+
+    # Write the state out; it is written aside and renamed so that a crash never leaves half of it
+    def save(self):
+        tmppath = '%s.%d' % (self.path, os.getpid())
+        f = open(tmppath, 'w')
+        json.dump({'prlists': self.prlists, 'watermark': self.watermark, 'lastfull': self.lastfull}, f)
+        f.close()
+        os.rename(tmppath, self.path)
+
+    # Seconds since the last full run
+    def sinceFull(self):
+        return time.time() - self.lastfull
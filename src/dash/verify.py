@@ -7,18 +7,49 @@ Created on Jun 12, 2013
 from scrape import Scrape
 from emailalert import EmailAlert
 from rule import Rule
+from category import Category
+from dashuser import Dashuser
+from state import State
 import logging
 import datetime
+import threading
+import Queue
+import sys
+import time
+# datetime.strptime imports this lazily, which is not thread safe in Python 2
+import _strptime
+
+# Seconds between two full runs when incremental verification is on
+RESYNCINTERVAL = 7 * 24 * 60 * 60
+# How far back a full run looks for changes to set the first watermark, in query-pr date syntax
+FULLWINDOW = '1 week ago'
 
 
 class Verify(object):
     
-    # Initialize the logpath and server name obtained from the config file
-    def __init__(self, logpath, server):
+    # Initialize the logpath, server name, number of verification workers, bulk query mode,
+    # category alias owners file, dashboard user sources and incremental verification state
+    # obtained from the config file
+    def __init__(self, logpath, server, workers=1, bulk=False, categoryfile=None,
+                 dashusercache=None, dashuserttl=None, dashuserfile=None,
+                 statefile=None, resyncinterval=None, fullresync=False):
         self.logpath = logpath
+        self.server = server
+        self.workers = workers
+        self.bulk = bulk
+        self.state = None
+        if statefile is not None:
+            self.state = State(statefile)
+        if resyncinterval is None:
+            resyncinterval = RESYNCINTERVAL
+        self.resyncinterval = resyncinterval
+        self.fullresync = fullresync
+        self.since = None       # watermark of the previous run when this one is incremental
+        self.modified = None    # numbers of the PRs modified since then
         self.timestamp = ''    # Time stamp will be updated when the file is created
         self.scrape = Scrape(server)
-        self.rule = Rule()
+        self.rule = Rule(category=Category(categoryfile),
+                         dashuser=Dashuser(dashusercache, dashuserttl, dashuserfile))
     
     # Send an email by refering to the dictionary that includes list of users for which discrepancy was found for particular rule type
     def sendEmail(self, UserRuleDict):
@@ -45,54 +76,28 @@ class Verify(object):
         hdlr = logging.FileHandler(logfile)
         try:
             discrepancyUserdict = {}
-            for ruletype in rulelist:
-                for user in usernamelist:
-                    logline = '-----------------------------------------------------------------------------------'
-                    print logline
-                    logging.critical(logline)
-                    
-                    logline = 'Verifying for user ||%(1)s|| for ||%(2)s|| type of PRs: ' % {"1": user, "2": ruletype}
-                    print logline
-                    logging.critical(logline)
-                    
-                    gnatsPRlist = self.rule.getPRlist(user, ruletype)
-                    dashPRlist = self.scrape.getPRList(user, ruletype)
-                    
-                    discrepancylist1 = list(set(gnatsPRlist) - set(dashPRlist))
-                    discrepancylist2 = list(set(dashPRlist) - set(gnatsPRlist))
-                    
-                    logging.critical('%s:' % datetime.datetime.now().strftime("%A, %d - %B %Y %I:%M%p"))
-                    logline = 'Count of PRs from GNATS: %d' % len(gnatsPRlist)
-                    print logline
-                    logging.critical(logline)
-                    
-                    logline = 'Count of PRs from Dashboard: %d' % len(dashPRlist)
-                    print logline
-                    logging.critical(logline)
-                    
-                    logline = 'List of PRs missing in dashboard: [%s] ' % ','.join(d for d in discrepancylist1)
-                    print logline
-                    logging.critical(logline)
-                    
-                    logline = 'List of PRs additionally found in dashboard: [%s]' % ','.join(d for d in discrepancylist2)
-                    print logline
-                    logging.critical(logline)
-                    
-                    if len(discrepancylist1 + discrepancylist2) > 0:
-                        print 'Checking for recently updated PRs and discarding false negatives from the list...'
-                        finalDescList = self.removeRecentPRs(discrepancylist1 + discrepancylist2)
-                        if len(finalDescList) > 0:
-                            logline = '\nDiscrepancies found after removing recently updated PRs: [%s] ' % ','.join(f for f in finalDescList)
-                            discrepancyUserdict.setdefault(ruletype, []).append(user)
-                        else:
-                            logline = '\nDiscrepancies found after removing recently updated PRs: None'
-                        print logline
-                        logging.critical(logline)
-                    else:
-                        logline = '\nNo discrepancies found at all'
-                        print logline
-                        logging.critical(logline)
+            watermark = self.startState()
+            # In bulk mode GNATS is queried once per rule type for all users up front
+            self.rule.prcache.clear()
+            if self.bulk and (self.modified is None or len(self.modified) > 0):
+                for ruletype in rulelist:
+                    self.rule.prefetchPRs(ruletype, usernamelist, self.since)
             
+            pairs = [(ruletype, user) for ruletype in rulelist for user in usernamelist]
+            if self.workers > 1 and len(pairs) > 1:
+                results = self.verifyParallel(pairs)
+            else:
+                results = (self.verifyPair(self.rule, self.scrape, ruletype, user) for ruletype, user in pairs)
+            
+            # Results always come back in (ruletype, user) order, so the log is the same for both modes
+            for result in results:
+                if self.report(result):
+                    discrepancyUserdict.setdefault(result['ruletype'], []).append(result['user'])
+                if self.state is not None and result['gnats'] != 0:
+                    self.state.set(result['ruletype'], result['user'], result['gnats'])
+            
+            if self.state is not None:
+                self.saveState(watermark)
             
             # alert admin by sending an autogenerated email:
             if len(discrepancyUserdict) > 0:
@@ -103,13 +108,198 @@ class Verify(object):
         except Exception, e:
             logging.exception(e)
     
+    '''
+    Decide whether this run can be incremental and return the watermark to save at the end of it.
+    The run is a full one if there is no watermark yet, if one was asked for or if the last full
+    run is older than resyncinterval. Either way the watermark is taken from the PRs modified before
+    any PR list is fetched, so changes made while the run goes on are picked up by the next one.
+    '''
+    def startState(self):
+        self.since = None
+        self.modified = None
+        if self.state is None:
+            return None
+        
+        full = self.fullresync or self.state.watermark is None or self.state.sinceFull() >= self.resyncinterval
+        modified, watermark = self.rule.getModifiedPRs(self.state.watermark or FULLWINDOW)
+        if modified is None:
+            # no watermark to move on to, the run has to be a full one and set it again
+            return None
+        if not full:
+            self.since = self.state.watermark
+            self.modified = modified
+        if watermark is None:
+            watermark = self.state.watermark
+        return watermark
+    
+    # Save the PR lists of this run along with the watermark returned by startState()
+    def saveState(self, watermark):
+        self.state.watermark = watermark
+        if self.since is None:
+            self.state.lastfull = time.time()
+            self.fullresync = False
+        self.state.save()
+    
+    '''
+    GNATS PR list for one user and rule type. In an incremental run it is the list of the previous
+    run, minus the PRs modified since, plus those modified PRs that match the rule now.
+    '''
+    def getGnatsPRlist(self, rule, ruletype, user):
+        previous = None
+        if self.since is not None:
+            previous = self.state.get(ruletype, user)
+        if previous is None:
+            return rule.getPRlist(user, ruletype)
+        if len(self.modified) == 0:
+            return previous
+        
+        matches = rule.getPRlist(user, ruletype, self.since)
+        if matches == 0:
+            return 0
+        PRlist = [PR for PR in previous if PR.split('-')[0] not in self.modified]
+        seen = set(PRlist)
+        for PR in matches:
+            if PR not in seen:
+                PRlist.append(PR)
+                seen.add(PR)
+        return PRlist
+    
+    '''
+    Compare the GNATS and Dashboard PR lists for one user and rule type and return the outcome
+    as a dictionary that report() turns into log lines.
+    If overlap is set the dashboard is scraped in a helper thread while GNATS is being queried.
+    '''
+    def verifyPair(self, rule, scrape, ruletype, user, overlap=False):
+        if overlap:
+            dashFetch = _Fetch(scrape.getPRList, user, ruletype)
+            gnatsPRlist = self.getGnatsPRlist(rule, ruletype, user)
+            dashPRlist = dashFetch.result()
+        else:
+            gnatsPRlist = self.getGnatsPRlist(rule, ruletype, user)
+            dashPRlist = scrape.getPRList(user, ruletype)
+        
+        result = {'ruletype': ruletype, 'user': user, 'gnats': gnatsPRlist, 'dash': dashPRlist,
+                  'checked': datetime.datetime.now(), 'final': None}
+        result['missing'] = list(set(gnatsPRlist) - set(dashPRlist))
+        result['extra'] = list(set(dashPRlist) - set(gnatsPRlist))
+        
+        if len(result['missing'] + result['extra']) > 0:
+            result['final'] = self.removeRecentPRs(result['missing'] + result['extra'], rule, scrape)
+        return result
+    
+    # Print and log the outcome of one verifyPair() call, return True if a discrepancy remains
+    def report(self, result):
+        logline = '-----------------------------------------------------------------------------------'
+        print logline
+        logging.critical(logline)
+        
+        logline = 'Verifying for user ||%(1)s|| for ||%(2)s|| type of PRs: ' % {"1": result['user'], "2": result['ruletype']}
+        print logline
+        logging.critical(logline)
+        
+        logging.critical('%s:' % result['checked'].strftime("%A, %d - %B %Y %I:%M%p"))
+        logline = 'Count of PRs from GNATS: %d' % len(result['gnats'])
+        print logline
+        logging.critical(logline)
+        
+        logline = 'Count of PRs from Dashboard: %d' % len(result['dash'])
+        print logline
+        logging.critical(logline)
+        
+        logline = 'List of PRs missing in dashboard: [%s] ' % ','.join(d for d in result['missing'])
+        print logline
+        logging.critical(logline)
+        
+        logline = 'List of PRs additionally found in dashboard: [%s]' % ','.join(d for d in result['extra'])
+        print logline
+        logging.critical(logline)
+        
+        discrepancy = False
+        if result['final'] is not None:
+            print 'Checking for recently updated PRs and discarding false negatives from the list...'
+            if len(result['final']) > 0:
+                logline = '\nDiscrepancies found after removing recently updated PRs: [%s] ' % ','.join(f for f in result['final'])
+                discrepancy = True
+            else:
+                logline = '\nDiscrepancies found after removing recently updated PRs: None'
+            print logline
+            logging.critical(logline)
+        else:
+            logline = '\nNo discrepancies found at all'
+            print logline
+            logging.critical(logline)
+        
+        return discrepancy
+    
+    '''
+    Verify the (ruletype, user) pairs on a bounded pool of worker threads.
+    Every worker has its own Rule and dashboard opener; GNATS connections come from the
+    server's connection pool, one per query. Results are yielded in the
+    order of pairs, so the caller sees exactly what the serial run would produce.
+    '''
+    def verifyParallel(self, pairs):
+        tasks = Queue.Queue()
+        for index, pair in enumerate(pairs):
+            tasks.put((index, pair))
+        
+        results = {}
+        done = threading.Condition()
+        for i in range(min(self.workers, len(pairs))):
+            worker = threading.Thread(target=self.__work,
+                                      args=(self.rule.spawn(), Scrape(self.server), tasks, results, done))
+            worker.setDaemon(True)
+            worker.start()
+        
+        try:
+            for index in range(len(pairs)):
+                done.acquire()
+                try:
+                    while index not in results:
+                        done.wait()
+                    failed, value = results.pop(index)
+                finally:
+                    done.release()
+                if failed:
+                    raise value[0], value[1], value[2]
+                yield value
+        finally:
+            # Stop handing out work if we bailed out early
+            while not tasks.empty():
+                try:
+                    tasks.get_nowait()
+                except Queue.Empty:
+                    break
+    
+    # Body of a worker thread: verify pairs until the task queue is empty
+    def __work(self, rule, scrape, tasks, results, done):
+        while True:
+            try:
+                index, (ruletype, user) = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                outcome = (False, self.verifyPair(rule, scrape, ruletype, user, overlap=True))
+            except:
+                # handed over to the main thread, which re-raises it in order
+                outcome = (True, sys.exc_info())
+            done.acquire()
+            try:
+                results[index] = outcome
+                done.notify()
+            finally:
+                done.release()
+    
     # Discard the PRs for which updates are not yet reflected on Dashboard UI. 
-    def removeRecentPRs(self, PRlist):
-        PRdict = self.rule.getPRdict(PRlist)
+    def removeRecentPRs(self, PRlist, rule=None, scrape=None):
+        if rule is None:
+            rule = self.rule
+        if scrape is None:
+            scrape = self.scrape
+        PRdict = rule.getPRdict(PRlist)
         PRlist = []
         for PR, LMD in PRdict.items():
             lastModifiedTime = datetime.datetime.strptime(LMD, '%Y-%m-%d %H:%M:%S %Z')
-            lastDashbrdUpdateTime = self.scrape.getUpdatedTimeFromUI() - datetime.timedelta(hours=2)
+            lastDashbrdUpdateTime = scrape.getUpdatedTimeFromUI() - datetime.timedelta(hours=2)
             #print PR + ' | ' + str(lastModifiedTime) + ' | ' + str(lastDashbrdUpdateTime)
             if (lastModifiedTime < lastDashbrdUpdateTime):
                 PRlist.append(PR)
@@ -117,3 +307,27 @@ class Verify(object):
         return PRlist    
 
 
+class _Fetch(object):
+    
+    '''
+    Run func(*args) in a helper thread; result() waits for it and returns its value,
+    re-raising any exception in the calling thread.
+    '''
+    def __init__(self, func, *args):
+        self.__value = None
+        self.__error = None
+        self.__thread = threading.Thread(target=self.__run, args=(func, args))
+        self.__thread.setDaemon(True)
+        self.__thread.start()
+    
+    def __run(self, func, args):
+        try:
+            self.__value = func(*args)
+        except:
+            self.__error = sys.exc_info()
+    
+    def result(self):
+        self.__thread.join()
+        if self.__error is not None:
+            raise self.__error[0], self.__error[1], self.__error[2]
+        return self.__value
@@ -51,6 +51,62 @@ for col in columns:
 for pr in prs:
     print "%s - %s - %s" % (pr[0], pr[1], pr[2])
 
+query() reads the whole result set into memory before returning it.  For
+broad queries that need no sorting, iter_query() takes the same arguments
+(less sort) and hands out the rows as they are read from gnatsd:
+
+for pr in db_handle.iter_query(expr, columns):
+    print "%s - %s - %s" % (pr[0], pr[1], pr[2])
+
+query_batches() does the same, passing lists of rows to a callback.
+
+Programs that run many short transactions, possibly from several threads,
+can borrow connections from the Server's ConnectionPool instead of opening
+one per handle:
+
+with db_obj.get_handle(username, passwd='*', pooled=True) as db_handle:
+    prs = db_handle.query(expr, columns)
+
+The pool size and idle timeout are Server arguments (pool_size,
+pool_idle_timeout).
+
+Mass updates go through Database.bulk_edit(), which locks, edits and
+unlocks the PRs in batches over pooled connections, and reports the outcome
+of each PR:
+
+edits = [(prnum, {'responsible': 'newowner'}) for prnum in prnums]
+for prnum, err in db_obj.bulk_edit(username, '*', edits, user_address):
+    if err is not None:
+        print "PR %s not edited: %s" % (prnum, err.message)
+
+To keep many queries in flight from one thread, use the callback-based
+AsyncDatabaseHandles of gnats.asyncserver, which share an event loop.
+
+Programs that repeat the same queries can have their results cached (see
+querycache.QueryCache for how entries are kept current):
+
+db_obj.enable_query_cache()
+print db_obj.query_cache.stats()
+
+To find out where the time of slow queries goes, record a profile of each
+query (see queryprofile.QueryProfiler):
+
+db_obj.enable_query_profiler()
+for profile in db_obj.query_profiler.slowest(5):
+    print "%.2fs %s %s" % (profile.seconds, profile.phases, profile.expr)
+
+The Audit-Trail and Change-Log of PRs are read from the Oracle database in
+codes, through a pool of connections.  Another DB-API database can be used
+instead (see auditdb.AuditDB), such as a sqlite stand-in:
+
+db_obj.enable_audit_db(gnats.auditdb.sqlite_audit_db(path))
+
+Each Server counts the protocol commands of its connections by verb (calls,
+failures, latency histogram, bytes each way and records read), cheaply
+enough to stay on; see protostats.ProtocolStats for exporting them:
+
+print db_obj.server.protocol_stats()['QUER']['count']
+
 Global Package Variables
 ========================
 
@@ -83,6 +139,12 @@ than NO_ENUM_METADATA. The following methods and data are affected:
 you have read and understood the code in database.py.  It's here for
 the advanced user, and for the sake of completeness.
 
+At FULL_METADATA, enum field values are read the first time each field's
+values are used (see database.EnumField), so this level costs little more than
+NO_ENUM_METADATA unless many enum fields are validated or sorted on.
+Database.preload_enum_values() loads all of them at once, in two pipelined
+batches of commands.
+
 'refresh_metadata_automatically'
 Defaults to True
 When True, Database instances will check the currency of their metadata on
@@ -91,6 +153,17 @@ has changed, the metadata will be reloaded (which takes 1-4 seconds,
 depending on metadata_level and server load).  When False, the user should call
 Database.update_metadata() periodically to ensure that cached data is still
 valid.  Leave it True unless you find a compelling reason to set it to False.
+Long-running programs can call Database.start_refresher() instead, which
+checks the metadata from a background thread and swaps in new metadata when it
+is ready; get_handle() then doesn't check it.
+
+'metadata_snapshot_dir'
+Defaults to None
+Directory holding metadata snapshots written by metadata.write_snapshot().
+When set, a Database whose snapshot there matches the server's current CFGT
+builds its fields from the snapshot rather than from gnatsd commands, and
+looks up enum values in it as they are needed.  Stale or missing snapshots are
+ignored.  See gnats.metadata for how to write them.
 
 The following flags control "advanced" properties of the library.  Do not
 mess with them unless you know what you're doing.
@@ -103,6 +176,13 @@ sent to the server.  This cuts down on "invisible" errors, and helps guard
 against protocol injection attacks.  When this flag is set, only newlines are
 stripped (as they will definitely cause failure).  Use only if truly needed.
 
+'recv_reader'
+Defaults to True
+Read gnatsd output with recv_into() into a reusable buffer (see
+server._SocketReader), which lets query output be decoded and split in bulk,
+rather than line by line through socket.makefile().  Only affects connections
+opened after it is changed.
+
 'protocol_debug'
 Defaults to False
 Dumps debug info about low-level protocol parsing (probably much more output
@@ -142,9 +222,15 @@ metadata_level = FULL_METADATA
 # Controls automatic db metadata re-loading
 refresh_metadata_automatically = True
 
+# Directory of metadata snapshots, None to always read metadata from gnatsd
+metadata_snapshot_dir = None
+
 # Don't strip (most) ctrl chars from protocol commands
 allow_cmd_control_chars = False
 
+# Read from gnatsd with recv_into() rather than socket.makefile()
+recv_reader = True
+
 # Print debug info during low-level protocol parsing.
 protocol_debug = False
 
@@ -179,7 +265,12 @@ class LastModifiedTimeException(GnatsException):
 
 
 from database import Database, DatabaseHandle, Field, EnumField
+from database import MetadataRefresher
 from server import Server, ServerConnection
+from querycache import QueryCache
+from queryprofile import QueryProfiler
+from auditdb import AuditDB
+from protostats import ProtocolStats
 
 _server_cache = {}
 
@@ -196,10 +287,10 @@ def get_database(host, dbname, port=codes.DEFAULT_PORT):
     return server.get_database(dbname)
 
 def get_database_handle(host, dbname, username, passwd=None,
-                        port=codes.DEFAULT_PORT):
+                        port=codes.DEFAULT_PORT, pooled=False):
     """ Get a DatabaseHandle object for database dbname on host.
 
-    Convenience method.
+    Convenience method.  See DatabaseHandle for pooled.
     """
     return get_database(host, dbname, port=port).\
-               get_handle(username, passwd=passwd)
+               get_handle(username, passwd=passwd, pooled=pooled)
@@ -0,0 +1,468 @@
+"""
+Event-driven gnatsd client, for keeping many queries in flight at once without
+a thread (or a pooled connection) per query.
+
+An AsyncClient runs an asyncore event loop over any number of database
+handles, each with its own connection to gnatsd:
+
+    client = AsyncClient(gnats.get_database(host, db))
+    results = {}
+    for user in users:
+        dbh = client.get_handle(username, passwd='*')
+        dbh.query('responsible=="%s"' % user, ['number', 'synopsis'],
+                  lambda rows, user=user: results.__setitem__(user, rows))
+    client.run()
+
+query(), get_pr() and quer() return at once.  The result is later passed to
+the callback argument, or the GnatsException to the errback argument if the
+request failed.  Failures without an errback, and exceptions raised by
+callbacks, are raised by run() once the loop is done.
+
+Requests on one handle are carried out one after the other, in the order they
+were made; it is the handles that run concurrently.  Metadata (field names and
+types, table columns) comes from the Database object, as for DatabaseHandle.
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import sys
+import time
+import socket
+import asyncore
+import asynchat
+import logging
+from collections import deque
+
+import gnats
+import codes
+from gnats import GnatsAccessException, GnatsException, GnatsNetworkException
+from database import DatabaseHandle
+from server import _Protocol, _split_records, Pipeline, ServerConnection
+
+_LOG = logging.getLogger('asyncserver')
+
+
+class AsyncClient(object):
+    """ The event loop shared by a set of AsyncDatabaseHandles. """
+
+    def __init__(self, database):
+        self.database = database
+        # asyncore socket map of this client's connections
+        self.map = {}
+        self._handles = []
+        # exc_info tuples of failures nobody handled
+        self._errors = []
+
+    def __str__(self):
+        return "AsyncClient for %s" % self.database
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def get_handle(self, username, passwd=None):
+        """ Open a connection to the database, and return its
+        AsyncDatabaseHandle.  The login happens once run() is called. """
+        dbh = AsyncDatabaseHandle(self, self.database, username, passwd)
+        self._handles.append(dbh)
+        return dbh
+
+    def run(self, timeout=None):
+        """ Run the event loop until every handle is idle.
+
+        Raises the first error that had no errback (see module docs), or
+        GnatsNetworkException if the requests are not done within timeout
+        seconds.
+        """
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while self.map and [dbh for dbh in self._handles if dbh.busy()]:
+            wait = 30.0
+            if deadline is not None:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    raise GnatsNetworkException("Timed out waiting for gnatsd "
+                        "at %s port %s" % (self.database.server.host,
+                                           self.database.server.port))
+            asyncore.loop(timeout=wait, map=self.map, count=1)
+        if self._errors:
+            exc_info = self._errors[0]
+            self._errors = []
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def close(self):
+        """ Close the connections of all handles. """
+        for dbh in self._handles:
+            dbh.close()
+        self._handles = []
+
+    def _call(self, func, arg):
+        """ Call a user callback, keeping what it raises for run(). """
+        try:
+            func(arg)
+        except Exception:
+            self._errors.append(sys.exc_info())
+
+    def _unhandled(self, err):
+        """ Keep an error that had no errback for run(). """
+        self._errors.append((err.__class__, err, None))
+
+
+class AsyncDatabaseHandle(DatabaseHandle):
+    """ A DatabaseHandle whose query(), get_pr() and quer() take callbacks
+    instead of returning their results.  Obtain one from
+    AsyncClient.get_handle().
+
+    The other DatabaseHandle methods are not available.
+    """
+
+    def __init__(self, client, database, username, passwd=None):
+        # DatabaseHandle.__init__() would log in with a blocking connection
+        self.client = client
+        self.database = database
+        self.username = username
+        self.passwd = passwd
+        self._pool = None
+        self.access_level = None
+        self.conn = AsyncServerConnection(database.server, client.map)
+        # Requests waiting to be carried out, the current one first
+        self._jobs = deque()
+        self._enqueue(self._chdb, self._logged_in, None)
+
+    def __str__(self):
+        return "AsyncDatabaseHandle for %s" % self.database
+
+    def busy(self):
+        """ True while requests are outstanding. """
+        return len(self._jobs) > 0
+
+    def close(self):
+        """ Close the connection; outstanding requests fail. """
+        if self.conn is not None:
+            self.conn.handle_close()
+            self.conn = None
+
+    def query(self, expr, field_names, callback, table_cols=None,
+              pr_list=None, errback=None):
+        """ Run a query, like DatabaseHandle.query(), passing the list of
+        rows to callback.  Rows come in the order gnatsd sends them; sort
+        them in the callback if need be.
+        """
+        field_names, table_cols = self._check_query(expr, field_names,
+                                                    table_cols, pr_list)
+
+        def records(results):
+            results = results or []
+            if table_cols:
+                tf_indexes = self._table_field_indexes(field_names, table_cols)
+                for record in results:
+                    self._parse_table_fields(record, tf_indexes)
+            return results
+
+        def job(finish, fail):
+            # As in _run_query(), QUER waits for gnatsd to accept the EXPR
+            pipe = self._query_pipeline(expr, field_names, table_cols)
+            if expr:
+                def quer(replies):
+                    self.conn.pipeline().quer(pr_list, parse=True).execute(
+                        lambda replies: finish(records(replies[0])), fail)
+                pipe.execute(quer, fail)
+            else:
+                pipe.quer(pr_list, parse=True)
+                pipe.execute(lambda replies: finish(records(replies[-1])),
+                             fail)
+        self._enqueue(job, callback, errback)
+
+    def get_pr(self, prnum, callback, field_names='all', one_scope=False,
+               table_cols="all", errback=None):
+        """ Fetch a PR, like DatabaseHandle.get_pr(), passing the dict to
+        callback. """
+        fetches, assemble = self._plan_get_pr(prnum, field_names, one_scope,
+                                              table_cols)
+
+        def job(finish, fail):
+            pipe = self.conn.pipeline()
+            quer_indexes = self._queue_pr_fetches(pipe, fetches)
+            def done(replies):
+                try:
+                    pr = assemble([replies[index] for index in quer_indexes])
+                except GnatsException, err:
+                    fail(err)
+                else:
+                    finish(pr)
+            pipe.execute(done, fail)
+        self._enqueue(job, callback, errback)
+
+    def quer(self, prs, callback, parse=True, errback=None):
+        """ Send a bare QUER for the given PRs, in whatever format and with
+        whatever expression the handle's last query left set. """
+        def job(finish, fail):
+            self.conn.pipeline().quer(prs, parse).execute(
+                lambda replies: finish(replies[0]), fail)
+        self._enqueue(job, callback, errback)
+
+    def _chdb(self, finish, fail):
+        """ Log into the database, as DatabaseHandle.__init__() does. """
+        def done(replies):
+            access_level = self.conn._parse_access_level(replies[0][-1])
+            self.access_level = access_level
+            if codes.LEVEL_TO_CODE[access_level] < \
+                    codes.LEVEL_TO_CODE['view']:
+                fail(GnatsAccessException("Insufficient access level: '%s'"
+                                          % access_level))
+            else:
+                finish(access_level)
+        self.conn.pipeline().command('CHDB %s %s %s' % (self.database.name,
+            self.username or '', self.passwd or '')).execute(done, fail)
+
+    def _logged_in(self, access_level):
+        _LOG.info("Logged into %s as %s, access level %s",
+                  self.database.name, self.username, access_level)
+
+    def _enqueue(self, job, callback, errback):
+        """ Queue a request.  job(finish, fail) sends the commands, and calls
+        finish with the result or fail with a GnatsException. """
+        def start():
+            def finish(result):
+                self._next()
+                self.client._call(callback, result)
+            def fail(err):
+                self._next()
+                if errback is None:
+                    self.client._unhandled(err)
+                else:
+                    self.client._call(errback, err)
+            try:
+                job(finish, fail)
+            except GnatsException, err:
+                fail(err)
+        self._jobs.append(start)
+        if len(self._jobs) == 1:
+            start()
+
+    def _next(self):
+        """ Drop the finished request and start the next one. """
+        self._jobs.popleft()
+        if self._jobs:
+            self._jobs[0]()
+
+
+class AsyncServerConnection(asynchat.async_chat, _Protocol):
+    """ A non-blocking connection to gnatsd, driven by an asyncore loop.
+
+    Commands are sent through pipeline(), whose execute() takes callbacks.
+    Replies are interpreted as by ServerConnection.
+    """
+
+    def __init__(self, server, sock_map, sock=None, strict_protocol=True):
+        asynchat.async_chat.__init__(self, sock, sock_map)
+        self.server = server
+        self.strict_protocol = strict_protocol
+        self.gnatsd_version = 'UNKNOWN'
+        self.broken = False
+        self._incoming = []
+        # _AsyncReply for each reply still to be read, in order; the first
+        # is for the greeting
+        self._replies = deque([_AsyncReply(False, self._greeted)])
+        self.set_terminator('\n')
+        if sock is None:
+            self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                self.connect((server.host, server.port))
+            except socket.error:
+                self.broken = True
+                self.close()
+                raise GnatsNetworkException("Error connecting to gnatsd at "
+                    "%s port %s" % (server.host, server.port))
+
+    def __str__(self):
+        return "AsyncServerConnection for %s" % self.server
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def pipeline(self):
+        """ Return an AsyncPipeline for sending commands. """
+        return AsyncPipeline(self)
+
+    def _greeted(self, rettext, error):
+        if error is None:
+            mo = ServerConnection._SERVER_VERSION_RE.match(rettext[0])
+            if mo:
+                self.gnatsd_version = mo.group(1)
+            else:
+                self.gnatsd_version = 'UNKNOWN VERSION'
+
+    def _send(self, commands, replies):
+        """ Send the commands, whose replies are to be handed to the given
+        _AsyncReplys. """
+        if self.broken:
+            err = GnatsNetworkException("Connection to gnatsd at %s port %s "
+                "is closed" % (self.server.host, self.server.port))
+            for reply in replies:
+                reply.done(None, err)
+            return
+        if gnats.protocol_debug:
+            for cmd in commands:
+                _LOG.debug("Sending: %s", cmd)
+        self._replies.extend(replies)
+        self.push(''.join([self._clean_command(cmd) + '\n'
+                           for cmd in commands]))
+
+    # asynchat callbacks
+
+    def collect_incoming_data(self, data):
+        self._incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self._incoming) + '\n'
+        self._incoming = []
+        if gnats.protocol_debug:
+            _LOG.debug("Read: %s", line[:-1])
+        if not self._replies:
+            self._fail(GnatsNetworkException("Unexpected output from "
+                                             "gnatsd: '%s'" % line.rstrip()))
+            return
+        reply = self._replies[0]
+        try:
+            finished = reply.feed(self, line)
+        except GnatsNetworkException, err:
+            self._fail(err)
+            return
+        if finished:
+            self._replies.popleft()
+            reply.done(reply.rettext, reply.error)
+
+    def handle_close(self):
+        self._fail(GnatsNetworkException("Connection to gnatsd at %s port %s "
+            "closed" % (self.server.host, self.server.port)))
+
+    def handle_error(self):
+        err = sys.exc_info()[1]
+        if not isinstance(err, GnatsNetworkException):
+            _LOG.warning("Error talking to gnatsd at %s port %s: %s",
+                         self.server.host, self.server.port, err)
+            err = GnatsNetworkException("Error talking to gnatsd at %s "
+                "port %s: %s" % (self.server.host, self.server.port, err))
+        self._fail(err)
+
+    def _fail(self, err):
+        """ Close the connection, and fail every reply still expected. """
+        self.broken = True
+        self.close()
+        replies = self._replies
+        self._replies = deque()
+        for reply in replies:
+            reply.done(None, err)
+
+
+class _AsyncReply(object):
+    """ Reads one reply, fed to it a line at a time (undecoded), the way
+    ServerConnection._get_reply() and _read_server() would. """
+
+    def __init__(self, parse, done):
+        self.parse = parse
+        # Called with (result, None), or (None, GnatsException)
+        self.done = done
+        self.rettext = []
+        self.error = None
+        # Collects the data of a 300/301 reply
+        self._output = None
+
+    def feed(self, conn, line):
+        """ Take a line of the reply, returning True if it was the last. """
+        if self._output is not None:
+            return self._feed_output(line)
+        (state, text, rtype) = conn._parse_reply(unicode(line,
+                                                         gnats.ENCODING))
+        if (state == codes.CODE_OK
+            or state == codes.CODE_GREETING
+            or state == codes.CODE_CLOSING
+            or state == codes.CODE_INFORMATION):
+            self.rettext.append(text)
+        elif (state == codes.CODE_PR_READY
+              or state == codes.CODE_TEXT_READY):
+            self._output = []
+            return False
+        elif (state == codes.CODE_SEND_PR
+              or state == codes.CODE_SEND_TEXT
+              or state == codes.CODE_INFORMATION_FILLER):
+            pass
+        elif (state == codes.CODE_NO_PRS_MATCHED):
+            self.rettext = None
+            return True
+        elif (state >= '400' and state <= '799'):
+            self.rettext.append(text)
+            try:
+                conn._check_error(state, rtype, self.rettext)
+            except GnatsNetworkException:
+                raise
+            except GnatsException, err:
+                # Unlike _get_reply(), read the rest of the reply, so the
+                # conversation stays in step
+                if self.error is None:
+                    self.error = err
+        else:
+            conn._check_unknown_state(state, text)
+            self.rettext.append(text)
+        if rtype == codes.REPLY_END:
+            if self.error is not None:
+                self.rettext = None
+            return True
+        return False
+
+    def _feed_output(self, line):
+        if line[0] == '.':
+            if line.startswith('..'):
+                line = line[1:]
+            elif line.startswith('.\r'):
+                if self.parse:
+                    self.rettext = _split_records(''.join(self._output))
+                else:
+                    self.rettext = self._output
+                return True
+        if not self.parse:
+            line = unicode(line, gnats.ENCODING).rstrip()
+        self._output.append(line)
+        return False
+
+
+class AsyncPipeline(Pipeline):
+    """ A Pipeline whose execute() hands the replies to a callback. """
+
+    def execute(self, callback, errback):
+        """ Send the queued commands.  Once all replies are in, call
+        callback with the list of them, or if any command failed, errback
+        with the exception of the first failure (with command and index
+        attributes, as for Pipeline.execute()).
+        """
+        commands = self._commands
+        self._commands = []
+        if not commands:
+            callback([])
+            return
+        results = [None] * len(commands)
+        failures = []
+        outstanding = [len(commands)]
+
+        def handler(index, cmd):
+            def done(result, error):
+                results[index] = result
+                if error is not None:
+                    _LOG.info("Pipelined command %d ('%s') failed: %s",
+                              index, cmd, error.message)
+                    if not failures:
+                        error.command = cmd
+                        error.index = index
+                    failures.append(error)
+                outstanding[0] -= 1
+                if outstanding[0] == 0:
+                    if failures:
+                        errback(failures[0])
+                    else:
+                        callback(results)
+            return done
+
+        self.conn._send([cmd for cmd, __ in commands],
+                        [_AsyncReply(parse, handler(index, cmd))
+                         for index, (cmd, parse) in enumerate(commands)])
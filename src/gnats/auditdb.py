@@ -0,0 +1,219 @@
+"""
+Audit-Trail and Change-Log database access.
+
+The Audit-Trail and Change-Log of PRs are read from a relational database
+rather than from gnatsd.  AuditDB reads them through any DB-API 2 module,
+keeping a small pool of open connections, binding the PR numbers as
+parameters, and fetching the rows of many PRs with one query per
+in_limit PRs:
+
+    db = gnats.get_database(host, dbname)
+    db.enable_audit_db(gnats.auditdb.oracle_audit_db())
+
+The Oracle database in codes is used by default.  sqlite_audit_db() reads the
+same tables from a sqlite file (see SQLITE_SCHEMA), as a local stand-in for
+testing and benchmarking.
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import logging
+import threading
+
+import codes
+
+_LOG = logging.getLogger('auditdb')
+
+# The tables read, for sqlite stand-ins
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS AUDIT_TRAIL (
+    ID INTEGER, AUDIT_TRAIL_ROW_ID INTEGER, AUDIT_TRAIL_USERNAME TEXT,
+    AUDIT_TRAIL_DATETIME TEXT, AUDIT_TRAIL_INFO TEXT);
+CREATE INDEX IF NOT EXISTS AUDIT_TRAIL_ID ON AUDIT_TRAIL (ID);
+CREATE TABLE IF NOT EXISTS CHANGE_LOG (
+    ID INTEGER, CHANGE_LOG_ROW_ID INTEGER, CHANGE_LOG_USERNAME TEXT,
+    CHANGE_LOG_DATETIME TEXT, CHANGE_LOG_FIELD TEXT, CHANGE_LOG_FROM TEXT,
+    CHANGE_LOG_TO TEXT, CHANGE_LOG_REASON TEXT, CHANGE_LOG_SCOPE TEXT);
+CREATE INDEX IF NOT EXISTS CHANGE_LOG_ID ON CHANGE_LOG (ID);
+"""
+
+# codes.AT_BULK_QUERY and CL_BULK_QUERY, with the datetimes stored as text
+SQLITE_AT_QUERY = "SELECT ID, AUDIT_TRAIL_ROW_ID, AUDIT_TRAIL_USERNAME, \
+                AUDIT_TRAIL_DATETIME, AUDIT_TRAIL_INFO FROM AUDIT_TRAIL \
+                WHERE ID IN (%s) ORDER BY ID, AUDIT_TRAIL_ROW_ID"
+SQLITE_CL_QUERY = "SELECT ID, CHANGE_LOG_ROW_ID, CHANGE_LOG_USERNAME, \
+                CHANGE_LOG_DATETIME, CHANGE_LOG_FIELD, CHANGE_LOG_FROM, \
+                CHANGE_LOG_TO, CHANGE_LOG_REASON, CHANGE_LOG_SCOPE \
+                FROM CHANGE_LOG WHERE ID IN (%s) ORDER BY ID, CHANGE_LOG_ROW_ID"
+
+# Encoding of the text in the database
+ENCODING = 'iso-8859-1'
+
+
+class AuditDB(object):
+    """ Reads the Audit-Trail and Change-Log of PRs from a DB-API 2 database.
+
+    connect is a function returning a new connection.  paramstyle is that
+    of the DB-API module, 'named' (:p0) or 'qmark' (?).  at_query and
+    cl_query select the PR number and then the columns of codes.AT_FIELDS
+    and CL_FIELDS, for PR numbers in an IN list, which is substituted for
+    %s.  At most in_limit PR numbers are bound per query, and rows are
+    fetched arraysize at a time.
+
+    Up to max_idle connections are kept open between calls, so that
+    threads sharing the AuditDB don't connect for every PR.  A connection
+    that fails is thrown away rather than kept.
+    """
+
+    IN_LIMIT = codes.AUDIT_IN_LIMIT
+    ARRAYSIZE = 500
+    MAX_IDLE = 4
+
+    def __init__(self, connect, paramstyle='named',
+                 at_query=codes.AT_BULK_QUERY, cl_query=codes.CL_BULK_QUERY,
+                 in_limit=IN_LIMIT, arraysize=ARRAYSIZE, max_idle=MAX_IDLE):
+        if paramstyle not in ('named', 'qmark'):
+            raise ValueError("Unsupported paramstyle: '%s'" % paramstyle)
+        self.connect = connect
+        self.paramstyle = paramstyle
+        self.at_query = at_query
+        self.cl_query = cl_query
+        self.in_limit = in_limit
+        self.arraysize = arraysize
+        self.max_idle = max_idle
+        self._lock = threading.Lock()
+        self._idle = []
+        self.connections = 0
+        self.queries = 0
+
+    def __str__(self):
+        return "AuditDB of %d idle connections" % len(self._idle)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def get(self, prnums):
+        """ Return a dict of each of the PR numbers prnums to a dict of its
+        'audit-trail' and 'change-log' rows, as lists of dicts of
+        AT_FIELDS and CL_FIELDS names to values.
+
+        Errors of the DB-API module are raised.
+        """
+        out = {}
+        for prnum in prnums:
+            out[prnum] = {'audit-trail': [], 'change-log': []}
+        if not prnums:
+            return out
+        conn = self._get_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.arraysize = self.arraysize
+            try:
+                for start in xrange(0, len(prnums), self.in_limit):
+                    chunk = prnums[start:start + self.in_limit]
+                    for name, query, fields in (
+                            ('audit-trail', self.at_query, codes.AT_FIELDS),
+                            ('change-log', self.cl_query, codes.CL_FIELDS)):
+                        self._fetch(cursor, query, chunk, name, fields, out)
+            finally:
+                cursor.close()
+        except:
+            self._discard(conn)
+            raise
+        self._put_connection(conn)
+        return out
+
+    def close(self):
+        """ Close the idle connections. """
+        self._lock.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            self._discard(conn)
+
+    def _fetch(self, cursor, query, prnums, name, fields, out):
+        """ Run query for prnums, adding the rows to out. """
+        if self.paramstyle == 'named':
+            marks = [':p%d' % i for i in xrange(len(prnums))]
+            params = dict([('p%d' % i, int(prnum))
+                           for i, prnum in enumerate(prnums)])
+        else:
+            marks = ['?'] * len(prnums)
+            params = [int(prnum) for prnum in prnums]
+        cursor.execute(query % ', '.join(marks), params)
+        self.queries += 1
+        while 1:
+            rows = cursor.fetchmany()
+            if not rows:
+                break
+            for row in rows:
+                rows_of_pr = out.get(str(row[0]))
+                if rows_of_pr is not None:
+                    rows_of_pr[name].append(audit_row(row[1:], fields))
+
+    def _get_connection(self):
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop()
+        finally:
+            self._lock.release()
+        conn = self.connect()
+        self.connections += 1
+        return conn
+
+    def _put_connection(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        self._discard(conn)
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception, err:
+            _LOG.debug("Error closing audit database connection: %s", err)
+
+
+def audit_row(row, fields):
+    """ Turn a row of an Audit-Trail or Change-Log query into a dict of
+    fields to unicode values. """
+    out = {}
+    for name, val in zip(fields, row):
+        if val is None:
+            val = u''
+        elif isinstance(val, str):
+            val = unicode(val, ENCODING)
+        elif not isinstance(val, unicode):
+            val = unicode(val)
+        if name == 'datetime':
+            val = val.replace(u'-0800', u'PST').replace(u'-0700', u'PDT')
+        out[unicode(name)] = val
+    return out
+
+def oracle_audit_db(user=codes.DEFAULT_USER, password=codes.DEFAULT_PASSWORD,
+                    dsn=codes.DEFAULT_DB, **kwargs):
+    """ Return an AuditDB reading the Oracle database, with cx_Oracle (which
+    is imported when the first connection is made).  kwargs are passed on
+    to AuditDB. """
+    def connect():
+        import cx_Oracle
+        return cx_Oracle.Connection(user, password, dsn)
+    return AuditDB(connect, 'named', **kwargs)
+
+def sqlite_audit_db(path, **kwargs):
+    """ Return an AuditDB reading the sqlite file at path, which should
+    have the tables of SQLITE_SCHEMA.  kwargs are passed on to AuditDB. """
+    import sqlite3
+    def connect():
+        return sqlite3.connect(path, check_same_thread=False)
+    kwargs.setdefault('at_query', SQLITE_AT_QUERY)
+    kwargs.setdefault('cl_query', SQLITE_CL_QUERY)
+    return AuditDB(connect, 'qmark', **kwargs)
@@ -31,6 +31,19 @@ CL_QUERY = "SELECT CHANGE_LOG_ROW_ID, CHANGE_LOG_USERNAME, \
 CL_FIELDS = ['row-id', 'username', 'datetime', 'field', 
                 'from', 'to', 'reason', 'scope']
 
+# Audit-Trail and Change-Log of many PRs at once, with the PR number first.
+# %s is a comma-separated list of at most AUDIT_IN_LIMIT PR numbers.
+AUDIT_IN_LIMIT = 1000
+AT_BULK_QUERY = "SELECT ID, AUDIT_TRAIL_ROW_ID, AUDIT_TRAIL_USERNAME, \
+                to_char(AUDIT_TRAIL_DATETIME, 'YYYY-MM-DD HH24:MI:SS TZHTZM'), \
+                AUDIT_TRAIL_INFO FROM AUDIT_TRAIL WHERE ID IN (%s) \
+                ORDER BY ID, AUDIT_TRAIL_ROW_ID"
+CL_BULK_QUERY = "SELECT ID, CHANGE_LOG_ROW_ID, CHANGE_LOG_USERNAME, \
+                to_char(CHANGE_LOG_DATETIME, 'YYYY-MM-DD HH24:MI:SS TZHTZM'), \
+                CHANGE_LOG_FIELD, CHANGE_LOG_FROM, CHANGE_LOG_TO, \
+                CHANGE_LOG_REASON, CHANGE_LOG_SCOPE FROM CHANGE_LOG WHERE \
+                ID IN (%s) ORDER BY ID, CHANGE_LOG_ROW_ID"
+
 # Separators for building query formats
 COL_SEP = '\034'
 ROW_SEP = '\035'
@@ -6,16 +6,26 @@ Dirk Bergstrom, dirk@juniper.net, 2008-04-17
 Copyright (c) 2008-2009, Juniper Networks, Inc.
 All rights reserved.
 """
+import os
 import time
 import re
+import heapq
+import operator
+import itertools
 import logging
+import threading
+import Queue
 
 import gnats
 import codes
 from gnats import GnatsException
+from gnats import GnatsNetworkException
 from gnats import InvalidFieldNameException
 from gnats import LastModifiedTimeException
 from gnats import PRNotFoundException
+import metadata
+import auditdb
+import queryprofile
 from metadata import ConfigMeta
 
 # Assign empty dict and array to store release values to avoid running of the
@@ -33,6 +43,77 @@ def _require_metadata(level):
                              "(gnats.metadata_level < gnats.%s" % level[1])
 
 
+class _MetadataConnection(object):
+    """ Stands in for a connection when metadata is read after a Database
+    has been loaded.  The first command borrows a connection from the
+    server's pool, logged in as the metadata user; release() gives it back.
+    """
+
+    def __init__(self, database):
+        self._database = database
+        self._conn = None
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            server = self._database.server
+            username, passwd = server.dbuser(self._database.name)
+            self._conn = server.pool.get(self._database.name, username, passwd)
+        return getattr(self._conn, name)
+
+    def release(self):
+        if self._conn is not None:
+            self._database.server.pool.put(self._conn)
+            self._conn = None
+
+
+class _PrefetchingConnection(object):
+    """ Wraps a connection, so that protocol methods called on it ahead of
+    time with prefetch(), in a pipelined batch, return the replies (or raise
+    the errors) from that batch.  Other calls are passed on.  Used to load
+    metadata in a few round trips rather than one per command.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+        # (method name, args): reply or GnatsException
+        self._replies = {}
+
+    def prefetch(self, calls):
+        """ Send calls, a list of (method name, args) tuples, in one
+        pipelined batch, and keep their replies. """
+        calls = [(name, _hashable(args)) for name, args in calls]
+        calls = [call for call in calls if call not in self._replies]
+        if not calls:
+            return
+        pipe = self._conn.pipeline()
+        for name, args in calls:
+            getattr(pipe, name)(*args)
+        for call, reply in zip(calls, pipe.execute(raise_errors=False)):
+            self._replies[call] = reply
+
+    def peek(self, name, *args):
+        """ Return the prefetched reply or error of a call, or None. """
+        return self._replies.get((name, _hashable(args)))
+
+    def __getattr__(self, name):
+        attr = getattr(self._conn, name)
+        if not callable(attr):
+            return attr
+        def call(*args):
+            reply = self._replies.pop((name, _hashable(args)), attr)
+            if reply is attr:
+                return attr(*args)
+            if isinstance(reply, GnatsException):
+                raise reply
+            return reply
+        return call
+
+
+def _hashable(args):
+    return tuple([isinstance(arg, list) and tuple(arg) or arg
+                  for arg in args])
+
+
 class Database(object):
     """ Metadata for a GNATS database.
 
@@ -51,6 +132,10 @@ class Database(object):
     post_metadata_callback to one later, and it will be called after metadata is
     refreshed, with the Database object as its sole argument.
 
+    Alternatively, start_refresher() starts a MetadataRefresher thread that
+    checks the metadata every so often, and swaps in new metadata once it is
+    built, so that get_handle() never waits on metadata.
+
     Call the get_handle() method to obtain a DatabaseHandle object, with which
     you can communicate with the server.
 
@@ -68,6 +153,10 @@ class Database(object):
         ('reply-to:', "Reply-To:", "", ""),
     )
 
+    # Default number of connections and of PRs per batch of bulk_edit()
+    BULK_WORKERS = 4
+    BULK_BATCH_SIZE = 20
+
     def __init__(self, server, name, conn, callback=None):
         self.server = server
         self.name = name
@@ -79,6 +168,17 @@ class Database(object):
         self.fields = {}
         self.initial_entry_fields = []
         self.last_config_time = 0
+        # QueryCache used by DatabaseHandle.query(), see enable_query_cache()
+        self.query_cache = None
+        # QueryProfiler of DatabaseHandle.query(), see enable_query_profiler()
+        self.query_profiler = None
+        # AuditDB for Audit-Trail and Change-Log, see enable_audit_db()
+        self.audit_db = None
+        self._audit_db_lock = threading.Lock()
+        # Serializes metadata refreshes by handles in different threads
+        self._metadata_lock = threading.RLock()
+        # MetadataRefresher, see start_refresher()
+        self.refresher = None
         self.single_valued_fields = []
         self.table_fields = []
         self.multi_valued_fields = {}
@@ -152,7 +252,7 @@ class Database(object):
             ftype = ftype.lower()
             if ftype.find('enum') > -1:
                 fld = EnumField(name.lower(), real_name, desc, ftype, default,
-                                flag, axes, conn)
+                                flag, axes, conn, self)
             elif ftype == 'table':
                 fld = TableField(name, desc, flag, self, conn)
             else:
@@ -164,27 +264,43 @@ class Database(object):
     def _get_metadata(self, conn):
         """ Fetch metadata from gnatsd and cache it.
 
+        If there is a metadata snapshot for the db in
+        gnats.metadata_snapshot_dir with the server's current CFGT, the
+        fields are built from that instead (see metadata.MetadataSnapshot).
+
         TODO May need to be more thread-safe.
         """
-        # Initialize class 'ConfigMeta' to get the meta data from the pickle
-        # file.
-        ConfigMeta(self, self.name)
-        ConfigMeta.mdata_dict = self.mdata_dict
-        ConfigMeta.user_list_fields = self.user_list_fields
-        self.mdata_dict = {}
+        snapshot = None
+        if gnats.metadata_level > gnats.NO_METADATA:
+            snapshot = self._fresh_snapshot(conn)
+        if snapshot is not None:
+            ConfigMeta.mdata_dict = {}
+            ConfigMeta.user_list_fields = snapshot.user_list_fields
+        else:
+            # Initialize class 'ConfigMeta' to get the meta data from the
+            # pickle file.
+            ConfigMeta(self, self.name)
+            ConfigMeta.mdata_dict = self.mdata_dict
+            ConfigMeta.user_list_fields = self.user_list_fields
+            self.mdata_dict = {}
         if gnats.metadata_level == gnats.NO_METADATA:
             return
         new_fields = {}
         new_single_valued_fields = []
         new_table_fields = []
         new_multi_valued_fields = {}
-        # Reading data from data structure generated by automated script instead
-        # of sending commands to gnatsd. 
-        cmd = 'LIST fieldnames'
-        if not ConfigMeta.mdata_dict.has_key(cmd):
-            ConfigMeta.mdata_dict[cmd] = conn.list("fieldnames")
-        names = ConfigMeta.mdata_dict[cmd]
-        new_ordered_fields = self._create_fields(conn, names)
+        if snapshot is not None:
+            new_ordered_fields = self._snapshot_fields(snapshot)
+        else:
+            # Reading data from data structure generated by automated script
+            # instead of sending commands to gnatsd.
+            cmd = 'LIST fieldnames'
+            if not ConfigMeta.mdata_dict.has_key(cmd):
+                ConfigMeta.mdata_dict[cmd] = conn.list("fieldnames")
+            names = ConfigMeta.mdata_dict[cmd]
+            conn = _PrefetchingConnection(conn)
+            self._prefetch_fields(conn, names)
+            new_ordered_fields = self._create_fields(conn, names)
         for fld in new_ordered_fields:
             new_fields[fld.lcname] = fld
             if fld.multi_valued:
@@ -197,13 +313,18 @@ class Database(object):
         new_fields.update(self.envelope_fields)
 
         new_initial_entry_fields = []
+        new_description = self.description
         if gnats.metadata_level > gnats.MINIMAL_METADATA:
-            self.description = conn.dbdesc(self.name)
-            # find and mark initial input fields
-            cmd = "LIST initialinputfields"
-            if not ConfigMeta.mdata_dict.has_key(cmd):
-                ConfigMeta.mdata_dict[cmd] = conn.list("initialinputfields")
-            input_fields = ConfigMeta.mdata_dict[cmd]
+            if snapshot is not None:
+                new_description = snapshot.description
+                input_fields = list(snapshot.initial_fields)
+            else:
+                new_description = conn.dbdesc(self.name)
+                # find and mark initial input fields
+                cmd = "LIST initialinputfields"
+                if not ConfigMeta.mdata_dict.has_key(cmd):
+                    ConfigMeta.mdata_dict[cmd] = conn.list("initialinputfields")
+                input_fields = list(ConfigMeta.mdata_dict[cmd])
             # The from: envelope field is required on create
             input_fields.append('from:')
             for fname in input_fields:
@@ -214,65 +335,383 @@ class Database(object):
         # The first field is always (?) builtinfield:number
         new_fields['builtinfield:number'] = new_ordered_fields[0]
 
-        # Removed hardcoded tuple 'BUILTIN_NAMES' of builtinfields and used
-        # the gnatsd command (LIST builtinfields) to get the builtin field name.
-        builtin_name_flds = conn.list("builtinfields")
+        if snapshot is not None:
+            for builtin_name, lcname in snapshot.builtins().items():
+                new_fields['builtinfield:%s' % builtin_name] = new_fields[lcname]
+        else:
+            # Removed hardcoded tuple 'BUILTIN_NAMES' of builtinfields and used
+            # the gnatsd command (LIST builtinfields) to get the builtin field
+            # name.
+            builtin_name_flds = conn.list("builtinfields")
+
+            # Construct the dict with builtinfields and real names.
+            builtin_flds = dict(map(lambda k: k.split(':'), builtin_name_flds))
+            for builtin_name, real_name in builtin_flds.items():
+                # Ignore table fields. For example 'Audit-Trail.Info'.
+                if real_name.find('.') != -1: continue
+                try:
+                    new_fields['builtinfield:%s' % builtin_name.lower()] = new_fields[real_name.lower()]
+                except KeyError:
+                    # This db has renamed the builtin.  It's a disaster, but
+                    # there's nothing we can do now.
+                    _LOG.warning("Database '%s' has renamed builtin '%s'",
+                                 builtin_name, real_name)
 
-        # Construct the dict with builtinfields and real names.
-        builtin_flds = dict(map(lambda k: k.split(':'), builtin_name_flds))
-        for builtin_name, real_name in builtin_flds.items():
-            # Ignore table fields. For example 'Audit-Trail.Info'.
-            if real_name.find('.') != -1: continue
+        if snapshot is not None:
+            new_config_time = snapshot.config_time
+        else:
             try:
-                new_fields['builtinfield:%s' % builtin_name.lower()] = new_fields[real_name.lower()]
-            except KeyError:
-                # This db has renamed the builtin.  It's a disaster, but
-                # there's nothing we can do now.
-                _LOG.warning("Database '%s' has renamed builtin '%s'",
-                             builtin_name, real_name)
-
-        self.fields = new_fields
-        self.number_field = new_ordered_fields[0]
-        self.initial_entry_fields = new_initial_entry_fields
-        self.ordered_fields = new_ordered_fields
-        self.multi_valued_fields = new_multi_valued_fields
-        self.single_valued_fields = new_single_valued_fields
-        self.table_fields = new_table_fields
-
-        try:
-            self.last_config_time = conn.cfgt()
-        except GnatsException:
-            self.last_config_time = time.time()
+                new_config_time = conn.cfgt()
+            except GnatsException:
+                new_config_time = time.time()
+
+        # Swap the new metadata in with one dict update, so that readers in
+        # other threads see either the old metadata or the new, never a mix.
+        self.__dict__.update({
+            'fields': new_fields,
+            'number_field': new_ordered_fields[0],
+            'initial_entry_fields': new_initial_entry_fields,
+            'ordered_fields': new_ordered_fields,
+            'multi_valued_fields': new_multi_valued_fields,
+            'single_valued_fields': new_single_valued_fields,
+            'table_fields': new_table_fields,
+            'description': new_description,
+            'last_config_time': new_config_time,
+        })
 
         if callable(self.post_metadata_callback):
             # Execute the callback, and hope that it works
             self.post_metadata_callback(self)
 
+    def _prefetch_fields(self, conn, names):
+        """ Send the commands that _create_fields() will need for the fields
+        names, and for the columns of the table fields among them, ahead of
+        time on conn, a _PrefetchingConnection.  Commands whose output is in
+        the pickle file are left out.  That is three pipelined batches,
+        however many fields there are.
+        """
+        mdata_dict = ConfigMeta.mdata_dict
+        def field_calls(names):
+            calls = [('FTYP', 'ftyp'), ('FIELDFLAGS', 'fieldflags')]
+            if gnats.metadata_level > gnats.MINIMAL_METADATA:
+                calls.extend([('FDSC', 'fdsc'), ('INPUTDEFAULT', 'inputdefault')])
+            return [(method, (names,)) for cmd, method in calls
+                    if not mdata_dict.has_key(cmd + ' ' + ' '.join(names))]
+
+        calls = field_calls(names)
+        if not mdata_dict.has_key('LIST axisnames'):
+            calls.append(('list', ('axisnames',)))
+        if gnats.metadata_level > gnats.MINIMAL_METADATA and \
+                not mdata_dict.has_key('LIST initialinputfields'):
+            calls.append(('list', ('initialinputfields',)))
+        conn.prefetch(calls)
+
+        types = mdata_dict.get('FTYP ' + ' '.join(names)) or \
+            conn.peek('ftyp', names)
+        if not isinstance(types, list):
+            # FTYP failed, _create_fields() will say so
+            return
+        tables = [name.lower() for name, ftype in zip(names, types)
+                  if ftype.lower() == 'table']
+        conn.prefetch([('ftypinfo', (table, 'columns')) for table in tables
+                       if not mdata_dict.has_key('FTYPINFO %s columns' % table)])
+        calls = []
+        for table in tables:
+            col_names = mdata_dict.get('FTYPINFO %s columns' % table) or \
+                conn.peek('ftypinfo', table, 'columns')
+            if isinstance(col_names, list):
+                calls.extend(field_calls(['%s.%s' % (table, col.lower())
+                                          for col in col_names]))
+        conn.prefetch(calls)
+
+    def preload_enum_values(self, conn=None):
+        """ Load the values of all enum fields and columns that haven't been
+        loaded yet, sending the commands for them in two pipelined batches,
+        rather than a few round trips per field.  Uses conn, or a connection
+        from the server's pool.
+        """
+        _require_metadata(gnats.FULL_METADATA)
+        fields = []
+        for fld in self.ordered_fields:
+            fields.append(fld)
+            if isinstance(fld, TableField):
+                fields.extend(fld.ordered_columns)
+        fields = [fld for fld in fields if isinstance(fld, EnumField) and
+                  fld._pending_db is not None and fld._snapshot is None]
+        if not fields:
+            return
+        borrowed = conn is None
+        if borrowed:
+            conn = _MetadataConnection(self)
+        try:
+            prefetcher = _PrefetchingConnection(conn)
+            calls = []
+            for fld in fields:
+                for prop in ('subfields', 'separators'):
+                    if (prop == 'subfields' or fld.ftype == 'multienum') and \
+                            not fld._mdata_dict.has_key(
+                                'FTYPINFO %s %s' % (fld.lcname, prop)):
+                        calls.append(('ftypinfo', (fld.lcname, prop)))
+            prefetcher.prefetch(calls)
+            calls = []
+            for fld in fields:
+                mdata_dict = fld._mdata_dict
+                subfields = mdata_dict.get('FTYPINFO %s subfields' % fld.lcname) \
+                    or prefetcher.peek('ftypinfo', fld.lcname, 'subfields')
+                if isinstance(subfields, GnatsException) or \
+                        (subfields and '435 ERROR' in subfields):
+                    if not mdata_dict.has_key('FVLD ' + fld.lcname):
+                        calls.append(('fvld', (fld.lcname,)))
+                elif fld.lcname not in fld._user_list_fields and \
+                        not mdata_dict.has_key(fld._values_command()):
+                    calls.append(('fvld', (fld.lcname, '*')))
+            prefetcher.prefetch(calls)
+            for fld in fields:
+                fld._ensure_loaded(prefetcher)
+        finally:
+            if borrowed:
+                conn.release()
+
+    def _fresh_snapshot(self, conn):
+        """ Return the metadata snapshot of the db if there is one, and it
+        has the server's current CFGT, else None. """
+        path = metadata.snapshot_path(self.server, self.name)
+        if path is None:
+            return None
+        snapshot = metadata.open_snapshot(path)
+        if snapshot is None:
+            return None
+        try:
+            config_time = conn.cfgt()
+        except GnatsException:
+            # Can't tell whether it is current
+            config_time = None
+        if snapshot.dbname != self.name or \
+                unicode(config_time) != snapshot.config_time:
+            _LOG.info("Metadata snapshot %s is stale, reading metadata "
+                      "from gnatsd", path)
+            snapshot.close()
+            return None
+        _LOG.info("Reading metadata for db %s from %s", self.name, path)
+        return snapshot
+
+    def _snapshot_fields(self, snapshot):
+        """ Create Field objects for the fields in a metadata snapshot. """
+        rows = snapshot.fields()
+        columns = {}
+        for lcname, name, desc, ftype, default, flags, axis, table in rows:
+            if table is not None:
+                columns.setdefault(table, []).append(self._snapshot_field(
+                    snapshot, lcname, name, desc, ftype, default, flags, axis))
+        fields = []
+        for lcname, name, desc, ftype, default, flags, axis, table in rows:
+            if table is not None:
+                continue
+            if ftype == 'table':
+                fld = TableField(name, desc, flags, self, None,
+                                 columns.get(lcname, []))
+            else:
+                fld = self._snapshot_field(snapshot, lcname, name, desc, ftype,
+                                           default, flags, axis)
+            fields.append(fld)
+        return fields
+
+    def _snapshot_field(self, snapshot, lcname, name, desc, ftype, default,
+                        flags, axis):
+        if ftype.find('enum') > -1:
+            return EnumField(lcname, name, desc, ftype, default, flags, axis,
+                             None, self, snapshot)
+        return Field(lcname, name, desc, ftype, default, flags, axis, None)
+
     def update_metadata(self, conn):
         """ Check with the server to determine if the cached metadata is
         current, and reload it if not. """
+        self._metadata_lock.acquire()
         try:
-            fetch_meta = self.last_config_time != conn.cfgt()
-        except GnatsException:
-            # server doesn't implement CFGT, refresh every Server.cache_time
-            # seconds.
-            fetch_meta = (time.time() - int(self.last_config_time)) \
-                > self.server.cache_time
-        if fetch_meta:
-            _LOG.info("Refreshing metadata for db %s", self.name)
-            self._get_metadata(conn)
-
-    def get_handle(self, username, passwd=None, conn=None):
+            try:
+                fetch_meta = self.last_config_time != conn.cfgt()
+            except GnatsException:
+                # server doesn't implement CFGT, refresh every
+                # Server.cache_time seconds.
+                fetch_meta = (time.time() - int(self.last_config_time)) \
+                    > self.server.cache_time
+            if fetch_meta:
+                _LOG.info("Refreshing metadata for db %s", self.name)
+                if self.query_cache is not None:
+                    self.query_cache.clear()
+                self._get_metadata(conn)
+        finally:
+            self._metadata_lock.release()
+
+    def start_refresher(self, interval=None):
+        """ Start a MetadataRefresher checking the metadata every interval
+        seconds (default MetadataRefresher.INTERVAL), unless one is running,
+        and return it.  While it runs, get_handle() doesn't check the
+        metadata itself.
+        """
+        if interval is None:
+            interval = MetadataRefresher.INTERVAL
+        self._metadata_lock.acquire()
+        try:
+            if self.refresher is None or not self.refresher.isAlive():
+                self.refresher = MetadataRefresher(self, interval)
+                self.refresher.start()
+            return self.refresher
+        finally:
+            self._metadata_lock.release()
+
+    def stop_refresher(self, timeout=None):
+        """ Stop the MetadataRefresher, if any, waiting up to timeout seconds
+        for it to finish a check in progress. """
+        refresher = self.refresher
+        self.refresher = None
+        if refresher is not None:
+            refresher.stop(timeout)
+
+    def enable_query_cache(self, cache=None):
+        """ Have DatabaseHandle.query() cache results in the given
+        QueryCache, or in a new one with the default settings, and return
+        the cache.  Set query_cache to None to turn caching off. """
+        if cache is None:
+            cache = gnats.QueryCache()
+        self.query_cache = cache
+        return cache
+
+    def enable_query_profiler(self, profiler=None):
+        """ Have DatabaseHandle.query() record the timings of each query in
+        the given queryprofile.QueryProfiler, or in a new one with the
+        default settings, and return the profiler.  Set query_profiler to
+        None to turn profiling off. """
+        if profiler is None:
+            profiler = queryprofile.QueryProfiler()
+        self.query_profiler = profiler
+        return profiler
+
+    def enable_audit_db(self, audit_db=None):
+        """ Have DatabaseHandles read the Audit-Trail and Change-Log of PRs
+        with the given auditdb.AuditDB, or with one reading the Oracle
+        database in codes, and return it. """
+        if audit_db is None:
+            audit_db = auditdb.oracle_audit_db()
+        self.audit_db = audit_db
+        return audit_db
+
+    def get_audit_db(self):
+        """ Return the audit_db, enabling the default one if there is
+        none. """
+        self._audit_db_lock.acquire()
+        try:
+            if self.audit_db is None:
+                self.enable_audit_db()
+            return self.audit_db
+        finally:
+            self._audit_db_lock.release()
+
+    def get_handle(self, username, passwd=None, conn=None, pooled=False):
         """ Return a DatabaseHandle object for this database, refreshing
-        cached metadata if necessary.
+        cached metadata if necessary (unless a MetadataRefresher is doing
+        that).
+
+        If pooled is True (and no conn is given), the handle borrows its
+        connection from the server's ConnectionPool; close() it when done.
         """
         _LOG.info("User '%s' getting handle for db %s", username, self.name)
-        dbh = DatabaseHandle(self, username, passwd, conn)
+        dbh = DatabaseHandle(self, username, passwd, conn, pooled)
         if gnats.refresh_metadata_automatically and \
-                gnats.metadata_level > gnats.NO_METADATA:
-            self.update_metadata(dbh.conn)
+                gnats.metadata_level > gnats.NO_METADATA and \
+                self.refresher is None:
+            try:
+                self.update_metadata(dbh.conn)
+            except:
+                dbh.close()
+                raise
         return dbh
 
+    def bulk_edit(self, username, passwd, edits, user_address,
+                  workers=BULK_WORKERS, batch_size=BULK_BATCH_SIZE):
+        """ Apply changes to many PRs, and return a list of (prnum, error)
+        in the order of edits, where error is None if the PR was edited, or
+        the exception raised for it.  A failed PR doesn't stop the others.
+
+        edits is a list of (prnum, changes), where changes is a dict of the
+        fields to set, as for DatabaseHandle.edit_pr_delta() (without a
+        baseline): fields are replaced, and changes needing a whole-PR EDIT
+        are made with edit_pr(), which adds to the changes dict.  A PR should
+        appear only once in edits.
+
+        The PRs are edited batch_size at a time, locking and unlocking each
+        batch with a single pipeline, on up to workers connections borrowed
+        from the server's pool (as username, passwd), each in its own
+        thread.  Locked PRs are always unlocked, on a new connection if the
+        one they were locked on fails.
+        """
+        batches = Queue.Queue()
+        for start in xrange(0, len(edits), batch_size):
+            batches.put((start, edits[start:start + batch_size]))
+        results = [(prnum, None) for prnum, __ in edits]
+        _LOG.info("User '%s' editing %d PRs in db %s", user_address,
+                  len(edits), self.name)
+
+        def work():
+            dbh = None
+            try:
+                while 1:
+                    try:
+                        start, batch = batches.get_nowait()
+                    except Queue.Empty:
+                        break
+                    locked = []
+                    errors = {}
+                    try:
+                        if dbh is None:
+                            dbh = self.get_handle(username, passwd, pooled=True)
+                        dbh._edit_batch(batch, user_address, locked, errors)
+                    except Exception, err:
+                        _LOG.warning("Bulk edit of %d PRs in db %s failed: %s",
+                                     len(batch) - len(errors), self.name, err)
+                        # PRs already edited (or refused) keep their outcome
+                        for offset in xrange(len(batch)):
+                            errors.setdefault(offset, err)
+                        if dbh is not None:
+                            dbh.close()
+                            dbh = None
+                        if locked:
+                            self._unlock_prs(username, passwd, locked)
+                    for offset, error in errors.iteritems():
+                        results[start + offset] = (batch[offset][0], error)
+            finally:
+                if dbh is not None:
+                    dbh.close()
+
+        workers = min(workers, batches.qsize(), self.server.pool.max_size)
+        if workers <= 1:
+            work()
+        else:
+            threads = [threading.Thread(target=work) for __ in xrange(workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        return results
+
+    def _unlock_prs(self, username, passwd, prnums):
+        """ Unlock PRs left locked by a failed connection. """
+        try:
+            dbh = self.get_handle(username, passwd, pooled=True)
+        except GnatsException, err:
+            _LOG.error("Unable to unlock PRs %s in db %s: %s",
+                       ', '.join(prnums), self.name, err)
+            return
+        try:
+            for prnum in prnums:
+                try:
+                    dbh.unlock_pr(prnum)
+                except GnatsException, err:
+                    _LOG.error("Unable to unlock PR %s in db %s: %s",
+                               prnum, self.name, err)
+        finally:
+            dbh.close()
+
     def builtin(self, name):
         """ Return the field name corresponding to the builtin field name, or
         the empty string if there is no such field.
@@ -562,6 +1001,74 @@ class Database(object):
         return errs
 
 
+class MetadataRefresher(threading.Thread):
+    """ A daemon thread that checks the metadata of a Database every
+    interval seconds (see Database.update_metadata()), through a connection
+    borrowed from the server's pool.  When gnatsd's configuration has
+    changed, the new metadata is built while the old stays in use, then
+    swapped in, and the post_metadata_callback is called.
+
+    Errors are logged and kept in last_error, and the check is tried again
+    after the next interval.  checks and refreshes count the checks made
+    and the times new metadata was swapped in.
+
+    Normally started with Database.start_refresher().
+    """
+
+    INTERVAL = 60
+
+    def __init__(self, database, interval=INTERVAL):
+        threading.Thread.__init__(self,
+                                  name='gnats-metadata-%s' % database.name)
+        self.setDaemon(True)
+        self.database = database
+        self.interval = interval
+        self.checks = 0
+        self.refreshes = 0
+        self.last_error = None
+        self._stopping = threading.Event()
+
+    def __str__(self):
+        return "MetadataRefresher for %s, every %ss" % (self.database,
+                                                       self.interval)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def run(self):
+        while 1:
+            self._stopping.wait(self.interval)
+            if self._stopping.isSet():
+                return
+            self.check()
+
+    def check(self):
+        """ Check the metadata now, and refresh it if need be. """
+        db = self.database
+        config_time = db.last_config_time
+        conn = _MetadataConnection(db)
+        try:
+            try:
+                db.update_metadata(conn)
+            except Exception, e:
+                _LOG.exception("Metadata check for db %s failed", db.name)
+                self.last_error = e
+            else:
+                self.last_error = None
+                if db.last_config_time != config_time:
+                    self.refreshes += 1
+        finally:
+            conn.release()
+        self.checks += 1
+
+    def stop(self, timeout=None):
+        """ Stop checking, waiting up to timeout seconds for a check in
+        progress to finish. """
+        self._stopping.set()
+        if self.isAlive() and threading.currentThread() is not self:
+            self.join(timeout)
+
+
 class Field(object):
     """ Holds the metadata describing a GNATS field. """
 
@@ -616,37 +1123,177 @@ class Field(object):
 
 
 class EnumField(Field):
-    """ A GNATS field having a list of values. """
+    """ A GNATS field having a list of values.
+
+    The values, values_dict, subfields, and for multienum fields separators
+    and default_separator, are read the first time one of them is used
+    (unless metadata_level is below FULL_METADATA), so fields that are never
+    validated or sorted on cost nothing to load.  They are looked up in the
+    metadata snapshot if the Database was built from one; otherwise reading
+    them borrows a connection from the server's pool if they are not in the
+    pickle file.
+    """
 
-    def __init__(self, lcname, name, desc, ftype, default, flags, axes, conn):
+    def __init__(self, lcname, name, desc, ftype, default, flags, axes, conn,
+                 db=None, snapshot=None):
         Field.__init__(self, lcname, name, desc, ftype, default, flags,
                        axes, conn)
-        self.values_dict = {}
-        self.values = []
+        self._values_dict = {}
+        self._values = []
+        self._subfields = None
+        self._separators = None
+        self._default_separator = None
+        self._sort_keys = None
+        # The pickle file metadata at the time the field was created
+        self._mdata_dict = ConfigMeta.mdata_dict
+        self._user_list_fields = ConfigMeta.user_list_fields
+        self._load_lock = threading.Lock()
+        # The Database and MetadataSnapshot to load values from on first
+        # use, None once loaded
+        self._pending_db = None
+        self._snapshot = None
         if gnats.metadata_level > gnats.NO_ENUM_METADATA:
-            self.load_enum_values(conn)
+            if db is None:
+                self.load_enum_values(conn)
+            else:
+                self._pending_db = db
+                self._snapshot = snapshot
+
+    def _ensure_loaded(self, conn=None):
+        """ Load the values if that has been put off, once, even with
+        several threads asking at the same time.  Commands are sent on conn,
+        or on a connection borrowed from the pool if it is None. """
+        if self._pending_db is None:
+            return
+        self._load_lock.acquire()
+        try:
+            db = self._pending_db
+            if db is None:
+                return
+            if self._snapshot is not None:
+                enum = self._snapshot.enum_values(self.lcname)
+                self._snapshot = None
+                if enum is not None:
+                    (self._subfields, separators, self._values,
+                     self._values_dict) = enum
+                    if self.ftype == 'multienum':
+                        self._separators = separators
+                        self._default_separator = separators[:1]
+                    self._pending_db = None
+                    return
+            _LOG.debug("Loading values of field %s", self.lcname)
+            if conn is not None:
+                self.load_enum_values(conn)
+                return
+            conn = _MetadataConnection(db)
+            try:
+                self.load_enum_values(conn)
+            finally:
+                conn.release()
+        finally:
+            self._load_lock.release()
+
+    def _values_command(self):
+        """ Return the pickle file key of the FVLD output of the field, if
+        it has subfields. """
+        if self.lcname in ConfigMeta.platforms_list:
+            return ConfigMeta.platforms_cmd
+        elif self.lcname in ConfigMeta.sw_images_list:
+            return ConfigMeta.sw_image_cmd
+        elif self.lcname in ConfigMeta.products_list:
+            return ConfigMeta.products_cmd
+        elif self.lcname in ConfigMeta.releases_list:
+            return ConfigMeta.releases_cmd
+        return 'FVLD ' + self.lcname + ' *'
+
+    def _get_values(self):
+        self._ensure_loaded()
+        return self._values
+
+    def _set_values(self, values):
+        self._values = values
+        self._sort_keys = None
+
+    values = property(_get_values, _set_values)
+
+    def _get_sort_keys(self):
+        sort_keys = self._sort_keys
+        if sort_keys is None:
+            values = self.values
+            sort_keys = {}
+            for rank in xrange(len(values) - 1, -1, -1):
+                sort_keys[values[rank]] = rank
+            self._sort_keys = sort_keys
+        return sort_keys
+
+    sort_keys = property(_get_sort_keys, doc=
+        """ Dict of value: position in values, for sorting in the order
+        of the dbconfig.  Built on first use. """)
+
+    def _get_values_dict(self):
+        self._ensure_loaded()
+        return self._values_dict
+
+    def _set_values_dict(self, values_dict):
+        self._values_dict = values_dict
+
+    values_dict = property(_get_values_dict, _set_values_dict)
+
+    def _get_subfields(self):
+        self._ensure_loaded()
+        return self._subfields
+
+    def _set_subfields(self, subfields):
+        self._subfields = subfields
+
+    subfields = property(_get_subfields, _set_subfields)
+
+    def _get_separators(self):
+        self._ensure_loaded()
+        return self._separators
+
+    def _set_separators(self, separators):
+        self._separators = separators
+
+    separators = property(_get_separators, _set_separators)
+
+    def _get_default_separator(self):
+        self._ensure_loaded()
+        return self._default_separator
+
+    def _set_default_separator(self, separator):
+        self._default_separator = separator
+
+    default_separator = property(_get_default_separator,
+                                 _set_default_separator)
 
     def load_enum_values(self, conn):
+        """ Read the values of the field, using conn for anything that is
+        not in the pickle file. """
+        mdata_dict = self._mdata_dict
+        self._values_dict = {}
+        self._values = []
+        self._sort_keys = None
         try:
             # Reading data from data structure generated by automated script
             # instead of sending commands to gnatsd.
             cmd = 'FTYPINFO ' + self.lcname + ' subfields'
-            if not ConfigMeta.mdata_dict.has_key(cmd):
-                ConfigMeta.mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'subfields')
-            self.subfields = ConfigMeta.mdata_dict[cmd]
+            if not mdata_dict.has_key(cmd):
+                mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'subfields')
+            self._subfields = mdata_dict[cmd]
         except GnatsException, e:
             if e.code == codes.CODE_INVALID_FTYPE_PROPERTY:
                 # Field has no subfields, just grab the values
                 cmd = 'FVLD ' + self.lcname
                 # Adding command output in the form of key:value if it does
                 # not exist in pickle file.
-                if not ConfigMeta.mdata_dict.has_key(cmd):
-                    ConfigMeta.mdata_dict[cmd] = conn.fvld(self.lcname)
-                self.values = ConfigMeta.mdata_dict[cmd]
-                self.subfields = [self.lcname]
+                if not mdata_dict.has_key(cmd):
+                    mdata_dict[cmd] = conn.fvld(self.lcname)
+                self._values = mdata_dict[cmd]
+                self._subfields = [self.lcname]
                 # and set up a "fake" values_dict with one entry
-                for val in self.values:
-                    self.values_dict[val] = {self.lcname: val}
+                for val in self._values:
+                    self._values_dict[val] = {self.lcname: val}
             else:
                 # A real error that needs to propagate
                 raise
@@ -661,60 +1308,52 @@ class EnumField(Field):
 
             # Since data is reading from file, So added error '435 ERROR' in
             # the file to handle if there is any exception occured.
-            if '435 ERROR' in ConfigMeta.mdata_dict[cmd]:
+            if '435 ERROR' in mdata_dict[cmd]:
                 cmd = 'FVLD ' + self.lcname
                 # Adding command output in the form of key:value if it does
                 # not exist in pickle file.
-                if not ConfigMeta.mdata_dict.has_key(cmd):
-                    ConfigMeta.mdata_dict[cmd] = conn.fvld(self.lcname)
-                self.values = ConfigMeta.mdata_dict[cmd]
-                self.subfields = [self.lcname]
+                if not mdata_dict.has_key(cmd):
+                    mdata_dict[cmd] = conn.fvld(self.lcname)
+                self._values = mdata_dict[cmd]
+                self._subfields = [self.lcname]
                 # and set up a "fake" values_dict with one entry
-                for val in self.values:
-                    self.values_dict[val] = {self.lcname: val}
+                for val in self._values:
+                    self._values_dict[val] = {self.lcname: val}
             # Avoid commands which fetches all users information. 
             # Also checking whether field exist in platforms, sw-images,
             # products or releases fields list. If yes then use platforms,
             # sw-images, products or releases command.
-            elif self.lcname not in ConfigMeta.user_list_fields:
-                if self.lcname in ConfigMeta.platforms_list:
-                    cmd = ConfigMeta.platforms_cmd
-                elif self.lcname in ConfigMeta.sw_images_list:
-                    cmd = ConfigMeta.sw_image_cmd
-                elif self.lcname in ConfigMeta.products_list:
-                    cmd = ConfigMeta.products_cmd
-                elif self.lcname in ConfigMeta.releases_list:
-                    cmd = ConfigMeta.releases_cmd
-                else:
-                    cmd = 'FVLD ' + self.lcname + ' *'
-                if not ConfigMeta.mdata_dict.has_key(cmd):
-                    ConfigMeta.mdata_dict[cmd] = conn.fvld(self.lcname, '*')
+            elif self.lcname not in self._user_list_fields:
+                cmd = self._values_command()
+                if not mdata_dict.has_key(cmd):
+                    mdata_dict[cmd] = conn.fvld(self.lcname, '*')
                 if self.lcname in ConfigMeta.releases_list:
                     # Create data structure for releases command once. Use
                     # same data structure for subsequent releases commnads.
                     if len(release_arr):
-                        self.values_dict = release_dict
-                        self.values = release_arr
+                        self._values_dict = release_dict
+                        self._values = release_arr
                     else:
-                        for line in ConfigMeta.mdata_dict[cmd]:
+                        for line in mdata_dict[cmd]:
                             subs = line.split(':')
-                            self.values_dict[subs[0]] = dict(zip(self.subfields, subs))
-                            release_dict[subs[0]] = self.values_dict[subs[0]]
-                            self.values.append(subs[0])
+                            self._values_dict[subs[0]] = dict(zip(self._subfields, subs))
+                            release_dict[subs[0]] = self._values_dict[subs[0]]
+                            self._values.append(subs[0])
                             release_arr.append(subs[0])
                 else:
-                    for line in ConfigMeta.mdata_dict[cmd]:
+                    for line in mdata_dict[cmd]:
                         subs = line.split(':')
-                        self.values_dict[subs[0]] = dict(zip(self.subfields, subs))
-                        self.values.append(subs[0])
+                        self._values_dict[subs[0]] = dict(zip(self._subfields, subs))
+                        self._values.append(subs[0])
         if self.ftype == 'multienum':
             cmd = 'FTYPINFO ' + self.lcname + ' separators'
-            if not ConfigMeta.mdata_dict.has_key(cmd):
-                ConfigMeta.mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'separators')
-            response = ConfigMeta.mdata_dict[cmd]
+            if not mdata_dict.has_key(cmd):
+                mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'separators')
+            response = mdata_dict[cmd]
             mo = re.match(r"\'(.*)\'", response[0])
-            self.separators = mo.group(1)
-            self.default_separator = mo.group(1)[:1]
+            self._separators = mo.group(1)
+            self._default_separator = mo.group(1)[:1]
+        self._pending_db = None
 
     def list_values(self):
         """ Return a list of valid values for the field. """
@@ -725,18 +1364,23 @@ class EnumField(Field):
 class TableField(Field):
     """ A GNATS field that is a table of columns, each of which is a Field. """
 
-    def __init__(self, name, desc, flags, db, conn):
+    def __init__(self, name, desc, flags, db, conn, columns=None):
+        """ The column Fields are created using conn, unless they are given
+        in columns. """
         Field.__init__(self, name.lower(), name, desc, 'table', '', flags,
                        '', conn)
-        # Reading data from data structure generated by automated script instead
-        # of sending commands to gnatsd.
-        cmd = 'FTYPINFO ' + self.lcname + ' columns'
-        if not ConfigMeta.mdata_dict.has_key(cmd):
-            ConfigMeta.mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'columns')
-        col_names = ConfigMeta.mdata_dict[cmd]
-        self.ordered_columns = db._create_fields(conn,    #IGNORE:W0212
-            ['%s.%s' % (self.lcname, col.lower()) for col in col_names],
-            real_names=col_names)
+        if columns is not None:
+            self.ordered_columns = columns
+        else:
+            # Reading data from data structure generated by automated script
+            # instead of sending commands to gnatsd.
+            cmd = 'FTYPINFO ' + self.lcname + ' columns'
+            if not ConfigMeta.mdata_dict.has_key(cmd):
+                ConfigMeta.mdata_dict[cmd] = conn.ftypinfo(self.lcname, 'columns')
+            col_names = ConfigMeta.mdata_dict[cmd]
+            self.ordered_columns = db._create_fields(conn,    #IGNORE:W0212
+                ['%s.%s' % (self.lcname, col.lower()) for col in col_names],
+                real_names=col_names)
         self.columns = {}
         for col in self.ordered_columns:
             # Store columns under their qualified name (field-name.col-name)
@@ -747,6 +1391,134 @@ class TableField(Field):
             self.columns[col.unqualified_name] = col
 
 
+# Session ids of edit_pr_delta() and Database.bulk_edit()
+_edit_sessions = itertools.count(1)
+
+def _edit_session():
+    """ Return a new edit session id. """
+    return '%d-%d' % (os.getpid(), _edit_sessions.next())
+
+
+class _SortPlan(object):
+    """ How to sort the results of a query: for each sort field, its index
+    in the rows and the function turning its values into sort keys.
+
+    Enum values sort in the order of the field's values in the dbconfig,
+    with values not in it first, alphabetically; PR numbers, integers and
+    'numeric' fields by their numeric value; everything else alphabetically.
+    The rows are sorted in place, by one stable key sort for each run of
+    fields sorted in the same direction, starting with the last run, so
+    there are no comparison functions and nothing in the Database's
+    metadata is changed.
+    """
+
+    def __init__(self, dbh, field_names, sort):
+        """ sort is a list of (fieldname, 'asc|desc') tuples, naming fields
+        in field_names.  Raises GnatsException for bad sort fields or
+        directions. """
+        # (index, key function or None for the value itself, descending)
+        self.fields = []
+        for fname, direct in sort:
+            fname = fname.lower()
+            direct = direct.lower()
+            if direct not in ('asc', 'desc'):
+                raise GnatsException("Illegal sort direction: '%s'" % direct)
+            try:
+                fld = dbh.database.fields[fname]
+                ind = field_names.index(fld.lcname)
+            except KeyError:
+                raise InvalidFieldNameException(
+                    "Sort field '%s' does not exist." % fname)
+            except ValueError:
+                raise GnatsException(
+                    "Sort field '%s' not included in results fields." % fname)
+            if fld.sorting == 'table':
+                raise GnatsException("Sorting on 'table' fields is "
+                                     "not supported.")
+            self.fields.append((ind, self._key_func(dbh, fld),
+                                direct == 'desc'))
+
+    def _key_func(self, dbh, fld):
+        if fld == dbh.database.number_field:
+            return dbh._prnum_to_sortable
+        if fld.sorting == 'integer':
+            return int
+        if fld.sorting == 'enum':
+            ranks = fld.sort_keys
+            def enum_key(val):
+                return (ranks.get(val, -1), val)
+            return enum_key
+        if fld.sorting == 'numeric':
+            # Non-integer values that need to be sorted as if they are
+            # numbers (generally release number fields)
+            return dbh._numeric_sortable
+        return None
+
+    def passes(self):
+        """ Return a list of (row key function, descending) tuples, one for
+        each sort to do, in the order to do them. """
+        runs = []
+        for ind, func, desc in self.fields:
+            if runs and runs[-1][1] == desc:
+                runs[-1][0].append((ind, func))
+            else:
+                runs.append(([(ind, func)], desc))
+        runs.reverse()
+        return [(_row_key(cols), desc) for cols, desc in runs]
+
+    def sort(self, rows):
+        """ Sort the list of rows in place. """
+        for key, desc in self.passes():
+            rows.sort(key=key, reverse=desc)
+
+    def key(self):
+        """ Return a function of a row giving a single sort key for all the
+        sort fields, for partial sorts with heapq. """
+        cols = []
+        for ind, func, desc in self.fields:
+            func = func or _same
+            if desc:
+                func = _descending(func)
+            cols.append((ind, func))
+        return _row_key(cols)
+
+
+class _Descending(object):
+    """ A sort key that sorts in the reverse order of the key it wraps. """
+
+    __slots__ = ('key',)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __cmp__(self, other):
+        return cmp(other.key, self.key)
+
+def _descending(func):
+    return lambda val: _Descending(func(val))
+
+def _counted(records, count):
+    """ Pass on the records, counting them in count[0]. """
+    for record in records:
+        count[0] += 1
+        yield record
+
+
+def _row_key(cols):
+    """ Return a function of a row giving its sort key for the list of
+    (index, key function) tuples cols. """
+    if len(cols) == 1:
+        ind, func = cols[0]
+        if func is None:
+            return operator.itemgetter(ind)
+        return lambda row: func(row[ind])
+    cols = [(ind, func or _same) for ind, func in cols]
+    return lambda row: tuple([func(row[ind]) for ind, func in cols])
+
+def _same(val):
+    return val
+
+
 class DatabaseHandle(object):
     """ A connection to a specific database.
 
@@ -761,19 +1533,49 @@ class DatabaseHandle(object):
     you're probably doing something wrong.
 
     Creating a DatabaseHandle is quick, don't try to save time by re-using
-    them, or creating a connection pool.  The gnatsd daemon is not designed
-    for long-running connections, and you will likley run into unexpected
-    and inexplicable errors.
+    them.  The gnatsd daemon is not designed for long-running connections,
+    and you will likley run into unexpected and inexplicable errors.  When
+    many handles are needed (say, one per query in a busy thread), create
+    them with pooled=True: the connection is then borrowed from the server's
+    ConnectionPool, which checks it with RSET, skips CHDB if it is already
+    logged into this database as this user, and closes it once it has been
+    idle for a while.  A pooled handle gives its connection back on close(),
+    or at the end of a with statement.
 
     Field names are case sensitive and *must* be supplied in all-lowercase.
     """
 
-    def __init__(self, database, username, passwd=None, conn=None):
-        self.conn = database.server.get_connection(conn)
+    def __init__(self, database, username, passwd=None, conn=None,
+                 pooled=False):
         self.database = database
         self.username = username
         self.passwd = passwd
-        self.access_level = self.conn.chdb(database.name, username, passwd)
+        self._pool = None
+        # QueryProfile of the query() running, if profiling
+        self._profile = None
+        if pooled and conn is None:
+            self._pool = database.server.pool
+            self.conn = self._pool.get(database.name, username, passwd)
+            self.access_level = self.conn.access_level
+        else:
+            self.conn = database.server.get_connection(conn)
+            self.access_level = self.conn.chdb(database.name, username, passwd)
+
+    def close(self):
+        """ Give the connection of a pooled handle back to the pool.
+
+        Does nothing for other handles, or if called twice.
+        """
+        if self._pool is not None and self.conn is not None:
+            self._pool.put(self.conn)
+            self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
 
     def __str__(self):
         return "DatabaseHandle for %s" % self.database
@@ -834,12 +1636,14 @@ class DatabaseHandle(object):
             pr_base = str(prnum)
         return pr_base
 
-    def query(self, expr, field_names, sort=None, table_cols=None, pr_list=None):
+    def query(self, expr, field_names, sort=None, table_cols=None, pr_list=None,
+              limit=None, offset=0, total=False):
         """ Run the given gnats query, returning the specified fields,
         sorted as requested.
 
-        sort should be a list of tuples of (fieldname, 'asc|desc').
-        field_names should be a list (not a tuple).
+        sort should be a list of tuples of (fieldname, 'asc|desc').  Enum
+        fields sort in the order of their values in the dbconfig; see
+        _SortPlan.  field_names should be a list (not a tuple).
 
         The pr_list parameter may be a list of PR numbers to fetch.  If given,
         and expr is empty, all requested PRs will be returned.  If expr is
@@ -858,7 +1662,209 @@ class DatabaseHandle(object):
         Values for the given table-fields will be parsed into dicts, and the
         rest will be returned as strings.
 
-        Returns a list of lists.
+        If limit is given, only the limit rows following the first offset
+        rows (of the sorted results, if sort is given) are returned.  The
+        rows are read from gnatsd as a stream, and only the best offset +
+        limit of them are kept (see heapq.nsmallest()), so a page of a big
+        result set costs memory in proportion to the page, and table fields
+        are parsed only for the rows returned.  If total is true, a tuple of
+        (rows, number of matching rows) is returned.
+
+        Returns a list of rows, which behave as lists (see server.Row).
+
+        If the Database has a query_cache, repeated queries are answered
+        from it (see querycache.QueryCache).  Queries asking for the total
+        are not cached.
+
+        If the Database has a query_profiler, the query's timings are
+        recorded in it (see queryprofile.QueryProfiler).
+        """
+        if limit is not None and (not isinstance(limit, (int, long)) or
+                                  limit < 0):
+            raise GnatsException("Illegal query limit: '%s'" % (limit,))
+        if not isinstance(offset, (int, long)) or offset < 0:
+            raise GnatsException("Illegal query offset: '%s'" % (offset,))
+        profiler = self.database.query_profiler
+        if profiler is None:
+            return self._cached_query(expr, field_names, sort, table_cols,
+                                      pr_list, limit, offset, total)
+        profile = profiler.start(self.username, expr, field_names, sort,
+                                 pr_list, limit, offset)
+        bytes_read = getattr(self.conn, '_bytes_in', 0)
+        self._profile = profile
+        self.conn.timings = {}
+        try:
+            results = self._cached_query(expr, field_names, sort, table_cols,
+                                         pr_list, limit, offset, total)
+        except Exception, err:
+            profiler.finish(profile,
+                nbytes=getattr(self.conn, '_bytes_in', 0) - bytes_read,
+                error=err)
+            raise
+        finally:
+            self._profile = None
+            self.conn.timings = None
+        if total:
+            rows = len(results[0])
+        else:
+            rows = len(results)
+        profiler.finish(profile, rows,
+                        getattr(self.conn, '_bytes_in', 0) - bytes_read)
+        return results
+
+    def _cached_query(self, expr, field_names, sort, table_cols, pr_list,
+                      limit, offset, total):
+        """ query() body, after checking the window. """
+        cache = self.database.query_cache
+        if cache is None or total:
+            results, count = self._query(expr, field_names, sort, table_cols,
+                                         pr_list, limit, offset, total)
+            if total:
+                return results, count
+            return results
+        key = cache.key(self.username, expr, field_names, sort, table_cols,
+                        pr_list, (limit, offset))
+        results = cache.get(key, self)
+        if self._profile is not None:
+            self._profile.mark('cache')
+            self._profile.cached = results is not None
+        if results is None:
+            started = time.time()
+            config_time = self.database.last_config_time
+            results = self._query(expr, field_names, sort, table_cols,
+                                  pr_list, limit, offset, False)[0]
+            cache.put(key, results, config_time, started)
+        return results
+
+    def _query(self, expr, field_names, sort, table_cols, pr_list,
+               limit=None, offset=0, total=False):
+        """ query() without the cache.  Returns a tuple of the rows and, if
+        total is true, the number of matching rows, or None. """
+        field_names, table_cols = self._check_query(expr, field_names,
+                                                    table_cols, pr_list)
+
+        # Check the sort fields before running the query
+        plan = None
+        if sort is not None:
+            plan = _SortPlan(self, field_names, sort)
+
+        if limit is not None:
+            return self._query_window(expr, field_names, plan, table_cols,
+                                      pr_list, limit, offset, total)
+
+        results = self._run_query(expr, field_names, table_cols, pr_list)
+        profile = self._profile
+        if profile is not None:
+            profile.mark_timings(self.conn.timings)
+
+        if results is None or len(results) == 0:
+            return [], 0
+
+        count = len(results)
+        if plan is not None and count > 1:
+            results = list(results)
+            plan.sort(results)
+            if profile is not None:
+                profile.mark('sort')
+        if offset:
+            results = results[offset:]
+
+        if table_cols:
+            tf_indexes = self._table_field_indexes(field_names, table_cols)
+            for record in results:
+                self._parse_table_fields(record, tf_indexes)
+            if profile is not None:
+                profile.mark('tables')
+        return results, count
+
+    def _query_window(self, expr, field_names, plan, table_cols, pr_list,
+                      limit, offset, total):
+        """ _query() of the limit rows after the first offset, streaming
+        the results and keeping only offset + limit rows at a time. """
+        self._start_query(expr, field_names, table_cols)
+        records = self.conn.quer_iter(pr_list)
+        count = [0]
+        if total:
+            records = _counted(records, count)
+        end = offset + limit
+        if plan is None:
+            rows = list(itertools.islice(records, offset, end))
+            if total:
+                for __ in records:
+                    pass
+        elif end:
+            rows = heapq.nsmallest(end, records, key=plan.key())[offset:]
+        else:
+            rows = []
+            if total:
+                for __ in records:
+                    pass
+        profile = self._profile
+        if profile is not None:
+            profile.mark_timings(self.conn.timings)
+            profile.mark('transfer')
+        if table_cols:
+            tf_indexes = self._table_field_indexes(field_names, table_cols)
+            for record in rows:
+                self._parse_table_fields(record, tf_indexes)
+            if profile is not None:
+                profile.mark('tables')
+        if total:
+            return rows, count[0]
+        return rows, None
+
+    def iter_query(self, expr, field_names, table_cols=None, pr_list=None):
+        """ Run the given gnats query, and return an iterator over the
+        resulting rows, which are parsed as they are read from gnatsd.
+
+        Takes the same arguments as query(), except for sort: since rows
+        are handed out as they arrive they come in the server's order.
+        Memory use does not grow with the size of the result set, so use
+        this for broad queries whose results can be processed one row at
+        a time.
+
+        The handle must not be used for anything else until the iterator
+        is exhausted; if it is, the rest of the rows are thrown away.
+        """
+        field_names, table_cols = self._check_query(expr, field_names,
+                                                    table_cols, pr_list)
+        self._start_query(expr, field_names, table_cols)
+        records = self.conn.quer_iter(pr_list)
+        if not table_cols:
+            return records
+        return self._iter_table_rows(records,
+            self._table_field_indexes(field_names, table_cols))
+
+    def _iter_table_rows(self, records, tf_indexes):
+        for record in records:
+            self._parse_table_fields(record, tf_indexes)
+            yield record
+
+    def query_batches(self, expr, field_names, callback, batch_size=1000,
+                      table_cols=None, pr_list=None):
+        """ Run the given gnats query, passing the resulting rows to
+        callback in lists of at most batch_size rows, as they are read
+        from gnatsd.  See iter_query().
+
+        Returns the number of rows.
+        """
+        count = 0
+        batch = []
+        for row in self.iter_query(expr, field_names, table_cols, pr_list):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                count += len(batch)
+                callback(batch)
+                batch = []
+        if batch:
+            count += len(batch)
+            callback(batch)
+        return count
+
+    def _check_query(self, expr, field_names, table_cols, pr_list):
+        """ Validate the arguments common to query() and iter_query().
+
+        Returns field_names as a list and the validated table_cols.
         """
         _require_metadata(gnats.MINIMAL_METADATA)
         _LOG.info("Query on db %s", self.database.name)
@@ -872,142 +1878,86 @@ class DatabaseHandle(object):
 
         if table_cols:
             table_cols = self._validate_table_columns(table_cols, field_names)
-
-        # Validate sort fields and plan the sort strategy.
-        sort_fast = True
-        mysort = []
-        # List of enum field in requisite fields for sorting
-        reqsort = []
-        if sort is not None:
-            for fname, direct in sort:
-                fname = fname.lower()
-                direct = direct.lower()
-                if direct not in ('asc', 'desc'):
-                    raise GnatsException("Illegal sort direction: '%s'" %
-                                         direct)
-                try:
-                    fld = self.database.fields[fname]
-                    ind = field_names.index(fld.lcname)
-                except KeyError:
-                    raise InvalidFieldNameException(
-                        "Sort field '%s' does not exist." % fname)
-                except ValueError:
-                    raise GnatsException(
-                        "Sort field '%s' not included in results fields." %
-                                         fname)
-                sort_type = fld.sorting
-                if sort_type == 'table':
-                    raise GnatsException("Sorting on 'table' fields is "
-                                         "not supported.")
-                mysort.append((fld, direct, ind, sort_type))
-                if sort_type in ('enum'):
-                    reqsort.append((fname,ind));
-                if direct != 'asc' and sort_type not in ('enum', 'integer'):
-                    # we can do a fast DSU-ish sort if the sorts are
-                    # all either enum/int or ascending alpha.  Anything
-                    # else requires a more complex solution
-                    sort_fast = False
-
-        self.conn.rset()
-        self._format_query(field_names, table_cols)
+        return field_names, table_cols
+
+    def _start_query(self, expr, field_names, table_cols):
+        """ Reset the connection and set up the query format and
+        expression, leaving only QUER to be sent. """
+        self._query_pipeline(expr, field_names, table_cols).execute()
+
+    def _query_pipeline(self, expr, field_names, table_cols):
+        """ Return a Pipeline holding the RSET, QFMT, TQFMT and EXPR commands
+        of a query. """
+        pipe = self.conn.pipeline()
+        pipe.rset()
+        self._format_query(field_names, table_cols, pipe)
         if expr:
-            self.conn.expr(expr)
+            pipe.expr(expr)
+        return pipe
 
-        results = self.conn.quer(pr_list, parse=True)
+    def _run_query(self, expr, field_names, table_cols, pr_list):
+        """ Send a query and return its parsed records.
 
-        if results is None or len(results) == 0:
-            return []
-
-        if table_cols:
-            # Make a list of lists of column values for each table field in
-            # each record in the results
-            tf_indexes = []
-            for tfname in table_cols.iterkeys():
-                # Find the index into the results row for each table-field
-                try:
-                    tf_indexes.append((tfname, field_names.index(tfname)))
-                except ValueError:
-                    pass
-            for record in results:
-                for tfname, tf_index in tf_indexes:
-                    vals = []
-                    for row in record[tf_index].split(codes.ROW_SEP)[:-1]:
-                        vals.append(row.split(codes.COL_SEP))
-                    record[tf_index] = vals
-
-        if len(results) == 1 or sort is None:
-            return results
-
-        # To sort on enum field like responsible, dev-oner, product etc.
-        # Check whether user requested sort on enum fields
-        if len(reqsort) > 0:
-            for row in results:
-                for field, ind in reqsort:
-                    # Collecting values of all enum fields
-                    self.database.fields[field].values.append(row[ind])
-            for field, ind in reqsort:
-                fld = self.database.fields[field]
-                fld.values.sort()
-                # Generating sort_keys array for enum fields. This will not
-                # getting generated at the time of metadata load
-                fld.sort_keys = dict(zip(fld.values, xrange(len(fld.values))))
-
-        dsu_rows = []
-        for row in results:
-            dsu_ent = []
-            for fld, direct, index, sort_type in mysort:
-                if sort_type in ('integer', 'enum'):
-                    if fld == self.database.number_field:
-                        val = self._prnum_to_sortable(row[index])
-                    elif sort_type == 'enum':
-                        # XXX??? unknown values sort at -1
-                        val = fld.sort_keys.get(row[index], -1)
-                    else:
-                        val = int(row[index])
-                    if direct == 'desc':
-                        val = 0 - val
-                elif sort_type == 'numeric':
-                    # non-integer values that need to be sorted as if they are
-                    # numbers (generally release number fields)
-                    val = self._numeric_sortable(row[index])
-                else:
-                    # Plain old alphabetical sort
-                    val = row[index]
-                dsu_ent.append(val)
-            dsu_rows.append((tuple(dsu_ent), row))
-        # Now we do the actual sort
-        if sort_fast:
-            # We can do a simple sort without a comparison function.
-            # This is a lot faster, since it's in C.
-            dsu_rows.sort()
-        else:
-            # Need to specify a comparison function, which will be slow
-            # for large result sets
-            func_parts = []
-            for num, (fld, direct, index, sort_type) in enumerate(mysort):
-                if sort_type in ('enum', 'integer') or direct == 'asc':
-                    higher = 1
-                    lower = 2
-                else:
-                    higher = 2
-                    lower = 1
-                func_parts.append("cmp(row%s[0][%s], row%s[0][%s])" %
-                                  (higher, num, lower, num))
-            func = "lambda row1, row2: " + " or ".join(func_parts)
+        The setup commands are pipelined.  QUER goes along with them when
+        there is no expression; otherwise it is sent once gnatsd has accepted
+        the EXPR, since after a rejected expression it would return every PR
+        in the database.
+        """
+        pipe = self._query_pipeline(expr, field_names, table_cols)
+        if expr:
+            pipe.execute()
+            return self.conn.quer(pr_list, parse=True)
+        pipe.quer(pr_list, parse=True)
+        return pipe.execute()[-1]
+
+    # gnatsd date format for the PR change probe
+    _PROBE_DATE_FORMAT = '%Y-%m-%d %H:%M:%S GMT'
+
+    def _pr_changes_since(self, when):
+        """ Return True if PRs have been modified or submitted after when,
+        seconds since the epoch.  Used by QueryCache.  Also True when the
+        database has no last-modified field, as nothing can be said then.
+        """
+        lm_field = self.database.builtin('last-modified')
+        if not lm_field:
+            return True
+        date = time.strftime(self._PROBE_DATE_FORMAT, time.gmtime(when))
+        expr = '%s>"%s"' % (lm_field, date)
+        # New PRs may not have a last-modified value
+        ad_field = self.database.builtin('arrival-date')
+        if ad_field:
+            expr = '%s | %s>"%s"' % (expr, ad_field, date)
+        return bool(self._run_query(expr, [self.database.number_field.lcname],
+                                    None, None))
+
+    def _table_field_indexes(self, field_names, table_cols):
+        """ Find the index into the results row for each table-field. """
+        tf_indexes = []
+        for tfname in table_cols.iterkeys():
             try:
-                sortfunc = eval(func)
-            except Exception, e:
-                raise GnatsException("Error building sort comparison: %s" % e)
-            dsu_rows.sort(cmp=sortfunc)
-        # Undecorate the sorted rows
-        rows = [r for __, r in dsu_rows]
-        return rows
-
-    def _format_query(self, field_names, table_cols):
-        self.conn.qfmt(self.database.build_format(field_names))
+                tf_indexes.append((tfname, field_names.index(tfname)))
+            except ValueError:
+                pass
+        return tf_indexes
+
+    def _parse_table_fields(self, record, tf_indexes):
+        """ Replace the table-field values of a results row by lists of
+        lists of column values. """
+        for tfname, tf_index in tf_indexes:
+            vals = []
+            for row in record[tf_index].split(codes.ROW_SEP)[:-1]:
+                vals.append(row.split(codes.COL_SEP))
+            record[tf_index] = vals
+
+    def _format_query(self, field_names, table_cols, target=None):
+        """ Send QFMT (and TQFMTs) for the fields, or queue them on target,
+        a Pipeline. """
+        if target is None:
+            target = self.conn
+        target.qfmt(self.database.build_format(field_names))
         if table_cols:
             for tfname, cols in table_cols.iteritems():
-                self.conn.tqfmt(tfname,
+                target.tqfmt(tfname,
                     self.database.build_format(cols, table_field=tfname))
 
     _NUMBER_RE = re.compile(r"^\D*(\d+)\D*(\d*)\D*(\d*)\D*(\d*)")
@@ -1085,10 +2035,124 @@ class DatabaseHandle(object):
         FIXME Should we parse multienum fields into lists?
         TODO Probably flails when confronted with a multi-axis PR number.
         """
+        fetches, assemble = self._plan_get_pr(prnum, field_names, one_scope,
+                                              table_cols)
+        return assemble(self._get_pr_fields_batch(fetches))
+
+    # How many PR numbers get_prs() puts on one QUER command line
+    GET_PRS_CHUNK = 200
+
+    def get_prs(self, prnums, field_names='all', table_cols="all"):
+        """ Fetch many PRs at once.  Returns a dict of PR number (as a
+        string, without any scope) to a dict in the form get_pr() returns.
+        PRs that don't exist are left out of the dict.
+
+        All scopes of each PR are returned.  The field_names and table_cols
+        params are as for get_pr().  Rather than a QUER per PR, there is a
+        QUER for the regular fields and one per axis for each GET_PRS_CHUNK
+        PRs, all sent in one pipelined batch, and the scope rows are
+        grouped back to their PRs by number.
+        """
+        _require_metadata(gnats.MINIMAL_METADATA)
+        bases = []
+        seen = set()
+        for prnum in prnums:
+            base = self._get_base_prnum(prnum).strip()
+            if not base.isdigit():
+                raise GnatsException("Invalid PR number: %s" % prnum)
+            if base not in seen:
+                seen.add(base)
+                bases.append(base)
+        if not bases:
+            return {}
+        _LOG.info("Fetching %d PRs from db %s", len(bases), self.database.name)
+        reg_fields, table_cols, axes, db_at_cl = \
+            self._plan_pr_fields(field_names, table_cols)
+
+        # Each fetch gets the number field first, to tell whose rows are whose
+        number = self.database.number_field.lcname
+        chunks = [bases[i:i + self.GET_PRS_CHUNK]
+                  for i in xrange(0, len(bases), self.GET_PRS_CHUNK)]
+        fetches = []
+        for chunk in chunks:
+            if reg_fields:
+                fetches.append((chunk, [number] + reg_fields, table_cols))
+            for __, fnames in axes:
+                fetches.append((chunk, [number] + fnames, None))
+        results = self._get_pr_fields_batch(fetches, missing_ok=True)
+
+        reg_rows = {}
+        axis_rows = [{} for __ in axes]
+        results.reverse()
+        for chunk in chunks:
+            if reg_fields:
+                for row in results.pop() or []:
+                    reg_rows.setdefault(self._get_base_prnum(row[0]), row[1:])
+            for rows_by_pr in axis_rows:
+                for row in results.pop() or []:
+                    rows_by_pr.setdefault(self._get_base_prnum(row[0]),
+                                          []).append(row[1:])
+
+        if reg_fields:
+            found = [base for base in bases if base in reg_rows]
+        else:
+            found = [base for base in bases
+                     if [1 for rows_by_pr in axis_rows if base in rows_by_pr]]
+        at_cl = {}
+        if db_at_cl and found:
+            at_cl = self._get_change_logs_audit_trails(found)
+        prs = {}
+        for base in found:
+            prs[base] = self._assemble_pr(reg_fields, table_cols, axes,
+                reg_rows.get(base),
+                [rows_by_pr.get(base, []) for rows_by_pr in axis_rows],
+                at_cl.get(base))
+        return prs
+
+    def _plan_get_pr(self, prnum, field_names, one_scope, table_cols):
+        """ Work out what get_pr() has to fetch.  Returns the list of
+        (prnum, field_names, table_cols) to pass to _get_pr_fields_batch(),
+        and a function that turns its results into the PR dict.
+        """
         _require_metadata(gnats.MINIMAL_METADATA)
         if not prnum:
             raise GnatsException("Must supply a PR number.")
         _LOG.info("Fetching PR %s from db %s", prnum, self.database.name)
+        reg_fields, table_cols, axes, db_at_cl = \
+            self._plan_pr_fields(field_names, table_cols)
+
+        # Now we fetch the values, all in one pipelined batch
+        pr_base = self._get_base_prnum(prnum)
+        if one_scope:
+            num = prnum
+        else:
+            num = pr_base
+        fetches = [(num, fnames, None) for __, fnames in axes]
+        at_cl = None
+        if reg_fields:
+            if db_at_cl:
+                at_cl = self._get_change_log_audit_trail(pr_base)
+            fetches.insert(0, (pr_base, reg_fields, table_cols))
+
+        def assemble(results):
+            reg_vals = None
+            if reg_fields:
+                vals = results.pop(0)
+                if vals is None or len(vals) == 0:
+                    raise PRNotFoundException("PR %s not found" % prnum)
+                reg_vals = vals[0]
+            return self._assemble_pr(reg_fields, table_cols, axes, reg_vals,
+                                     results, at_cl)
+
+        return fetches, assemble
+
+    def _plan_pr_fields(self, field_names, table_cols):
+        """ Sort the field_names of get_pr() into regular fields and axes.
+        Returns (reg_fields, table_cols, axes, db_at_cl): table_cols
+        validated, axes a list of (axis, field_names) each starting with the
+        scope, and db_at_cl true if Audit-Trail and Change-Log are to be read
+        from the database rather than from gnatsd.
+        """
         if not field_names:
             raise GnatsException("Must supply a list of field names.")
 
@@ -1137,53 +2201,48 @@ class DatabaseHandle(object):
                     table_cols = 'all'
             table_cols = self._validate_table_columns(table_cols, reg_fields)
 
-        # Now we fetch the values
-        pr_base = self._get_base_prnum(prnum)
+        db_at_cl = False
         if reg_fields:
             # Remove Audit-Trail and Change-Log from the fields and columns for
             # not to access it from gnatsd "but directly" access the same from 
             # database to improve performance in view PR.
-            check_field = reg_fields
-            check_cols = table_cols
-            check_at_and_cl = False
-            at_cl_str = {}
             if (self.database.name == 'default' and \
                 (field_names == 'all' or \
                 (type(field_names) is list and len(field_names) > 2 and field_names.count('audit-trail')))):
-                if check_field.count('audit-trail'):
-                    check_field.remove('audit-trail')
-                if type(check_cols) is dict and check_cols.has_key('audit-trail'):
-                    del(check_cols['audit-trail'])
-                if check_field.count('change-log'):
-                    check_field.remove('change-log')
-                if type(check_cols) is dict and check_cols.has_key('change-log'):
-                    del(check_cols['change-log'])
-                check_at_and_cl = True
-                at_cl_str = self._get_change_log_audit_trail(pr_base)
-            vals = self._get_pr_fields(pr_base, check_field, check_cols)
-            if vals is None or len(vals) == 0:
-                raise PRNotFoundException("PR %s not found" % prnum)
-            pr_dict = dict(zip(reg_fields, vals[0]))
-            if check_cols:
+                if reg_fields.count('audit-trail'):
+                    reg_fields.remove('audit-trail')
+                if type(table_cols) is dict and table_cols.has_key('audit-trail'):
+                    del(table_cols['audit-trail'])
+                if reg_fields.count('change-log'):
+                    reg_fields.remove('change-log')
+                if type(table_cols) is dict and table_cols.has_key('change-log'):
+                    del(table_cols['change-log'])
+                db_at_cl = True
+
+        return reg_fields, table_cols, multi_fields.items(), db_at_cl
+
+    def _assemble_pr(self, reg_fields, table_cols, axes, reg_vals, axis_vals,
+                     at_cl):
+        """ Build the get_pr() dict of a PR from reg_vals, its values of
+        reg_fields, axis_vals, its rows for each of axes, and at_cl, its
+        Audit-Trail and Change-Log as read from the database (or None). """
+        if reg_fields:
+            pr_dict = dict(zip(reg_fields, reg_vals))
+            if table_cols:
                 # Make a list of dicts of colname:colvalue for each table field
-                for tfname, cols in check_cols.iteritems():
+                for tfname, cols in table_cols.iteritems():
                     table_vals = []
                     for row in pr_dict[tfname].split(codes.ROW_SEP)[:-1]:
                         row_dict = dict(zip(cols, row.split(codes.COL_SEP)))
                         table_vals.append(row_dict)
                     pr_dict[tfname] = table_vals
-            if check_at_and_cl:
-                pr_dict['audit-trail'] = at_cl_str['audit-trail']
-                pr_dict['change-log'] = at_cl_str['change-log']
+            if at_cl is not None:
+                pr_dict['audit-trail'] = at_cl['audit-trail']
+                pr_dict['change-log'] = at_cl['change-log']
         else:
             pr_dict = {}
 
-        if one_scope:
-            num = prnum
-        else:
-            num = pr_base
-        for axis, fnames in multi_fields.iteritems():
-            vals = self._get_pr_fields(num, fnames)
+        for (axis, fnames), vals in zip(axes, axis_vals):
             # Turn each scope into a field:value dict, and make a list of those
             # dicts, sorted into axis order.
             scope_list = []
@@ -1197,9 +2256,65 @@ class DatabaseHandle(object):
 
     def _get_pr_fields(self, prnum, field_names, table_cols=None):
         """ Fetch the requested fields for the pr. """
-        self.conn.rset()
-        self._format_query(field_names, table_cols)
-        return self.conn.quer(prs=prnum, parse=True)
+        pipe = self.conn.pipeline()
+        self._queue_pr_fields(pipe, prnum, field_names, table_cols)
+        return pipe.execute()[-1]
+
+    def _get_pr_fields_batch(self, fetches, missing_ok=False):
+        """ Fetch fields of PRs for each (prnum, field_names, table_cols)
+        in fetches, in a single pipelined batch.  Returns the list of
+        results, as _get_pr_fields() would return them.
+
+        gnatsd fails the whole QUER if one of its PRs doesn't exist.  With
+        missing_ok, such a fetch of a list of PRs is made again one PR at a
+        time, in one more batch, and the PRs that don't exist are left out
+        of its result.
+        """
+        pipe = self.conn.pipeline()
+        quer_indexes = self._queue_pr_fetches(pipe, fetches)
+        if not missing_ok:
+            replies = pipe.execute()
+            return [replies[index] for index in quer_indexes]
+
+        replies = pipe.execute(raise_errors=False)
+        for index, reply in enumerate(replies):
+            if isinstance(reply, GnatsException) and \
+                    not (index in quer_indexes and
+                         reply.code == codes.CODE_NONEXISTENT_PR):
+                raise reply
+        results = [replies[index] for index in quer_indexes]
+        singles = []
+        for i, (prnum, field_names, table_cols) in enumerate(fetches):
+            if not isinstance(results[i], GnatsException):
+                continue
+            results[i] = None
+            if not isinstance(prnum, basestring) and len(prnum) > 1:
+                singles.extend([(i, ([base], field_names, table_cols))
+                                for base in prnum])
+        if singles:
+            _LOG.info("PRs missing from db %s, fetching %d PRs one at a time",
+                      self.database.name, len(singles))
+            single_results = self._get_pr_fields_batch(
+                [fetch for __, fetch in singles], missing_ok=True)
+            for (i, __), rows in zip(singles, single_results):
+                if rows:
+                    results[i] = (results[i] or []) + list(rows)
+        return results
+
+    def _queue_pr_fetches(self, pipe, fetches):
+        """ Queue the commands for _get_pr_fields_batch() on a Pipeline,
+        and return the indexes of the QUER replies. """
+        quer_indexes = []
+        for prnum, field_names, table_cols in fetches:
+            self._queue_pr_fields(pipe, prnum, field_names, table_cols)
+            quer_indexes.append(len(pipe) - 1)
+        return quer_indexes
+
+    def _queue_pr_fields(self, pipe, prnum, field_names, table_cols):
+        """ Queue the commands fetching fields of a PR on a Pipeline. """
+        pipe.rset()
+        self._format_query(field_names, table_cols, pipe)
+        pipe.quer(prs=prnum, parse=True)
 
     def submit_pr(self, pr, session_id=None):
         """ Submit the pr to gnatsd and return the new PR number. """
@@ -1222,32 +2337,10 @@ class DatabaseHandle(object):
         _LOG.info("Unlocking PR %s in db %s", prnum, self.database.name)
         return self.conn.unlk(self._get_base_prnum(prnum))
 
-    def edit_pr(self, prnum, pr, user_address, set_flag_notify=None):
-        """ Submit changes to a PR.
-
-        The current state of the PR will be fetched from gnatsd, the supplied
-        values will be inserted into pr, and the whole will be submitted to
-        gnatsd.
-
-        The submitted pr dict will be modified.
-
-        If you need validation, call one of the Database.validate_*() methods.
-
-        If last-modified is supplied, the value will be checked against the
-        current value in the PR, and an exception will be raised if they are
-        different.  This will (help) protect against edits on stale data.
-        """
-        _require_metadata(gnats.MINIMAL_METADATA)
-        _LOG.info("User '%s' editing PR '%s' in db %s", user_address, prnum,
-                   self.database.name)
-        if pr is None or len(pr) == 0:
-            raise GnatsException("No PR supplied for edit.")
-
-        if not prnum:
-            raise GnatsException("No PR number supplied for edit.")
-
-        # Make sure that the user has submitted at least one editable field
-        # Check regular fields, scoped fields, and finally envelope fields.
+    def _has_editable(self, pr):
+        """ Return True if the user has submitted at least one editable
+        field in pr.  Checks regular fields, scoped fields, and finally
+        envelope fields. """
         has_editable = False
         for fld in self.database.single_valued_fields:
             if not fld.read_only and pr.has_key(fld.lcname):
@@ -1284,7 +2377,33 @@ class DatabaseHandle(object):
                 if pr.has_key(fld.lcname):
                     has_editable = True
                     break
-        if not has_editable:
+        return has_editable
+
+    def edit_pr(self, prnum, pr, user_address, set_flag_notify=None):
+        """ Submit changes to a PR.
+
+        The current state of the PR will be fetched from gnatsd, the supplied
+        values will be inserted into pr, and the whole will be submitted to
+        gnatsd.
+
+        The submitted pr dict will be modified.
+
+        If you need validation, call one of the Database.validate_*() methods.
+
+        If last-modified is supplied, the value will be checked against the
+        current value in the PR, and an exception will be raised if they are
+        different.  This will (help) protect against edits on stale data.
+        """
+        _require_metadata(gnats.MINIMAL_METADATA)
+        _LOG.info("User '%s' editing PR '%s' in db %s", user_address, prnum,
+                   self.database.name)
+        if pr is None or len(pr) == 0:
+            raise GnatsException("No PR supplied for edit.")
+
+        if not prnum:
+            raise GnatsException("No PR number supplied for edit.")
+
+        if not self._has_editable(pr):
             raise GnatsException("No editable fields supplied for PR edit.")
 
         if user_address is None or user_address.strip() == '':
@@ -1334,6 +2453,231 @@ class DatabaseHandle(object):
 
         return self.conn.edit(pr_base, self.database.unparse_pr(pr))
 
+    def edit_pr_delta(self, prnum, pr, user_address, baseline=None):
+        """ Submit changes to a PR, sending only the fields that changed.
+
+        baseline should be the PR dict (as from get_pr()) that the changes in
+        pr were made to; only fields whose values differ from it are sent.
+        Without a baseline, every field in pr is sent, and only the
+        last-modified field of the PR is fetched, to check it.  A multitext
+        value that extends the baseline value is appended with APPN; other
+        fields are replaced with REPL, and rows added to the end of a table
+        field are appended with TAPPN (other table changes are ignored, as
+        by edit_pr()).  The commands are sent in one edit session, with the
+        PR locked.
+
+        Falls back to edit_pr() (which sends the whole PR with EDIT) if
+        envelope fields change, a changed field needs a change reason, or a
+        scope not in baseline is given; the EDIT is also sent with the PR
+        locked.  Scopes must exist if there is no baseline.
+
+        If last-modified is in pr or baseline, it is checked against the
+        PR's current value, and LastModifiedTimeException is raised if they
+        differ.
+
+        Returns a list of the (command, field name) edits made, or
+        [('EDIT', None)] after falling back to edit_pr().
+        """
+        _require_metadata(gnats.MINIMAL_METADATA)
+        _LOG.info("User '%s' editing PR '%s' in db %s", user_address, prnum,
+                   self.database.name)
+        self._check_edit(prnum, pr, user_address)
+
+        edits = self._plan_delta(pr, baseline)
+        if edits == []:
+            return []
+
+        pr_base = self._get_base_prnum(prnum)
+        last_mod = self.database.builtin('last-modified')
+        seen_mod = pr.get(last_mod) or (baseline or {}).get(last_mod)
+        session_id = _edit_session()
+        self.conn.editaddr(user_address)
+        self.conn.lockn(pr_base, self.username, os.getpid(), session_id)
+        try:
+            if last_mod and seen_mod:
+                curr_mod = self.get_pr(pr_base, [last_mod]).get(last_mod)
+                if curr_mod != seen_mod:
+                    raise LastModifiedTimeException("PR %s has been modified "
+                        "since you viewed it." % pr_base, old_time=seen_mod,
+                        new_time=curr_mod)
+            if edits is None:
+                _LOG.debug("Falling back to EDIT of PR %s", prnum)
+                self.edit_pr(prnum, pr, user_address)
+            else:
+                self._send_edits(pr_base, edits, session_id)
+        finally:
+            self.conn.unlk(pr_base)
+        if edits is None:
+            return [('EDIT', None)]
+        return [(cmd, fname) for cmd, fname, __, __ in edits]
+
+    def _check_edit(self, prnum, pr, user_address):
+        """ Raise GnatsException if an edit of pr can't be sent. """
+        if pr is None or len(pr) == 0:
+            raise GnatsException("No PR supplied for edit.")
+        if not prnum:
+            raise GnatsException("No PR number supplied for edit.")
+        if not self._has_editable(pr):
+            raise GnatsException("No editable fields supplied for PR edit.")
+        if user_address is None or user_address.strip() == '':
+            raise GnatsException("No user address supplied for PR edit.")
+
+    def _send_edits(self, pr_base, edits, session_id):
+        """ Send the edits planned by _plan_delta(), in the edit session
+        session_id of the locked PR pr_base. """
+        for cmd, fname, value, scope in edits:
+            if cmd == 'TAPPN':
+                self.conn.tappn(pr_base, fname, value, session_id)
+            elif cmd == 'APPN':
+                self.conn.appn(pr_base, fname, value, scope or '', session_id)
+            else:
+                self.conn.repl(pr_base, fname, value, scope or '', session_id)
+
+    def _edit_batch(self, batch, user_address, locked, errors):
+        """ Apply a batch of Database.bulk_edit() changes, a list of
+        (prnum, changes).  The error of each PR (None if it succeeded) is
+        put in the dict errors, under its index in batch, as soon as it is
+        known, so that if the connection fails the caller can tell the PRs
+        already edited from the rest.
+
+        One pipeline locks all the PRs, the edits of each are sent in turn,
+        and a last pipeline unlocks them.  The base numbers of PRs are kept
+        in locked while they are locked, so that the caller can unlock them
+        if the connection fails.
+        """
+        plans = [None] * len(batch)
+        sessions = {}
+        pid = os.getpid()
+        pipe = self.conn.pipeline()
+        pipe.editaddr(user_address)
+        for i, (prnum, changes) in enumerate(batch):
+            try:
+                self._check_edit(prnum, changes, user_address)
+                plans[i] = self._plan_delta(changes, None)
+            except GnatsException, err:
+                errors[i] = err
+                continue
+            if plans[i] == []:
+                errors[i] = None
+                continue
+            sessions[i] = _edit_session()
+            pipe.lockn(self._get_base_prnum(prnum), self.username, pid,
+                       sessions[i])
+        if not sessions:
+            return
+
+        to_lock = sorted(sessions)
+        replies = pipe.execute(raise_errors=False)
+        if isinstance(replies[0], GnatsException):
+            for i in to_lock:
+                errors[i] = replies[0]
+            return
+        held = []
+        try:
+            for i, reply in zip(to_lock, replies[1:]):
+                pr_base = self._get_base_prnum(batch[i][0])
+                if isinstance(reply, GnatsException) and reply.code == '600':
+                    # LOCKN not implemented, lockn() falls back to LOCK
+                    try:
+                        reply = self.conn.lockn(pr_base, self.username, pid,
+                                                sessions[i])
+                    except GnatsNetworkException:
+                        raise
+                    except GnatsException, err:
+                        reply = err
+                if isinstance(reply, GnatsException):
+                    errors[i] = reply
+                    continue
+                locked.append(pr_base)
+                held.append(i)
+            for i in held:
+                prnum, changes = batch[i]
+                try:
+                    if plans[i] is None:
+                        self.edit_pr(prnum, changes, user_address)
+                    else:
+                        self._send_edits(self._get_base_prnum(prnum),
+                                         plans[i], sessions[i])
+                    errors[i] = None
+                except GnatsNetworkException:
+                    raise
+                except GnatsException, err:
+                    errors[i] = err
+        finally:
+            if held and not self.conn.broken:
+                pipe = self.conn.pipeline()
+                for i in held:
+                    pipe.unlk(self._get_base_prnum(batch[i][0]))
+                replies = pipe.execute(raise_errors=False)
+                for i, reply in zip(held, replies):
+                    locked.remove(self._get_base_prnum(batch[i][0]))
+                    if isinstance(reply, GnatsException) and \
+                            errors[i] is None:
+                        errors[i] = reply
+
+    def _plan_delta(self, pr, baseline):
+        """ Work out the edits that edit_pr_delta() should send: a list of
+        (command, field name, value, scope) tuples, or None if the change
+        needs a full EDIT. """
+        db = self.database
+        edits = []
+
+        def plan_field(fld, vals, base_vals, scope=None):
+            if fld._really_read_only or fld.lcname not in vals:
+                return True
+            value = vals[fld.lcname]
+            if fld.ftype == 'table':
+                if base_vals is None:
+                    return True
+                old_rows = base_vals.get(fld.lcname) or []
+                if not isinstance(value, list) or \
+                        value[:len(old_rows)] != old_rows:
+                    return True
+                for row in value[len(old_rows):]:
+                    row = dict([(col, val) for col, val in row.iteritems()
+                                if col != 'row-id'])
+                    edits.append(('TAPPN', fld.lcname, row, None))
+                return True
+            if fld.ftype == 'multienum' and not isinstance(value, basestring):
+                value = fld.default_separator.join(value)
+            old = None
+            if base_vals is not None:
+                old = base_vals.get(fld.lcname)
+                if old == value:
+                    return True
+            if fld.require_change_reason or \
+                    vals.has_key('%s-changed-why' % fld.lcname):
+                return False
+            if fld.ftype == 'multitext' and old and value.startswith(old) \
+                    and len(value) > len(old):
+                edits.append(('APPN', fld.lcname, value[len(old):], scope))
+            else:
+                edits.append(('REPL', fld.lcname, value, scope))
+            return True
+
+        for fld in db.envelope_fields.itervalues():
+            if fld.lcname in pr and (baseline is None or
+                                     baseline.get(fld.lcname) != pr[fld.lcname]):
+                return None
+        for fld in db.single_valued_fields:
+            if not plan_field(fld, pr, baseline):
+                return None
+        for axis, fields in db.multi_valued_fields.iteritems():
+            base_scopes = None
+            if baseline is not None:
+                base_scopes = dict([(str(ident), vals) for ident, vals
+                                    in baseline.get(axis, [])])
+            for ident, vals in pr.get(axis, []):
+                base_vals = None
+                if base_scopes is not None:
+                    base_vals = base_scopes.get(str(ident))
+                    if base_vals is None:
+                        return None
+                for fld in fields:
+                    if not plan_field(fld, vals, base_vals, str(ident)):
+                        return None
+        return edits
+
     def append_to_field(self, prnum, fname, value, username, scope=None,
                         sess=''):
         """ Append the supplied value to the named field. """
@@ -1377,42 +2721,22 @@ class DatabaseHandle(object):
         return self.conn.chek(self.database.unparse_pr(pr), initial)
 
     def _get_change_log_audit_trail(self, prnum):
-        import cx_Oracle
-        change_audit = {}
+        """ Audit-Trail and Change-Log of prnum, read from the Database's
+        audit_db. """
+        return self._get_change_logs_audit_trails([prnum])[prnum]
+
+    def _get_change_logs_audit_trails(self, prnums):
+        """ Audit-Trail and Change-Log of each of prnums, read from the
+        Database's audit_db.  Returns a dict of prnum to a dict of
+        'audit-trail' and 'change-log' rows; if they can't be read, both are
+        empty dicts. """
         try:
-            connection = cx_Oracle.Connection("%s/%s@%s" %
-                        (codes.DEFAULT_USER, codes.DEFAULT_PASSWORD, codes.DEFAULT_DB))
-            cursor = connection.cursor()
-        except:
-            _LOG.warning("Unable to connect to GNATS database for PR %s", prnum)
-            change_audit['audit-trail'] = {}
-            change_audit['change-log'] = {}
-            return change_audit
-
-        change_audit['audit-trail'] = self._exec_query(prnum, cursor, codes.AT_QUERY, codes.AT_FIELDS)
-        change_audit['change-log'] = self._exec_query(prnum, cursor, codes.CL_QUERY, codes.CL_FIELDS)
-
-        cursor.close()
-        connection.close()
-        return change_audit
-
-    def _exec_query(self, prnum, cursor, query, fileds):
-        out = []
-        try:
-            cursor.execute(query % prnum)
-            for result in cursor:
-                dict_index = {}
-                i = 0
-                for val in result:
-                    if val is None:
-                        val = ''
-                    if fileds[i] == 'datetime':
-                        val = val.replace('-0800', 'PST')
-                        val = val.replace('-0700', 'PDT')
-                    dict_index[unicode(fileds[i], 'iso-8859-1')] = unicode(str(val),'iso-8859-1') 
-                    i = i + 1
-                out.append(dict_index)
-        except:
-            _LOG.warning("Unable to execute query: %s for PR %s" % (query, prnum))
-        return out
+            return self.database.get_audit_db().get(prnums)
+        except Exception, err:
+            _LOG.warning("Unable to read Audit-Trail and Change-Log of "
+                         "%d PRs: %s", len(prnums), err)
+        change_audits = {}
+        for prnum in prnums:
+            change_audits[prnum] = {'audit-trail': {}, 'change-log': {}}
+        return change_audits
 
@@ -1,5 +1,20 @@
 """
-Pickle file configuration for Gnatsweb.
+Pickle file configuration for Gnatsweb, and metadata snapshots.
+
+A metadata snapshot holds the parsed field metadata of one database in a
+sqlite file, along with the CFGT it was read under.  When the package
+variable gnats.metadata_snapshot_dir is set, Database looks there for a
+snapshot (see snapshot_path()) and, if its CFGT matches the server's,
+builds its fields from it instead of sending FTYP, FDSC etc. to gnatsd.
+Enum values are looked up in the snapshot when a field first needs them.
+A stale, missing or unreadable snapshot is ignored, and the metadata is read
+from gnatsd as usual.
+
+Snapshots are written by write_snapshot(), from a Database loaded at
+FULL_METADATA, e.g. from a cron job:
+
+    db = gnats.get_database(host, dbname)
+    metadata.write_snapshot(db, metadata.snapshot_path(db.server, dbname))
 
 Kamal Prasad Sharma, ksharma@juniper.net
 Kishorkumar Sorthiya, kishorbs@juniper.net
@@ -9,8 +24,17 @@ Copyright (c) 2011, Juniper Networks, Inc.
 All rights reserved.
 """
 import os
+import time
+import logging
+import sqlite3
+import threading
 import cPickle as pickle
 
+import gnats
+import codes
+
+_LOG = logging.getLogger('metadata')
+
 # Change the path according to gnatsweb setup for the metadata generation files.
 metadata_dir = os.path.join('/opt/www/ui/gnatatui/gnatsweb/web/', 'inc',
                             'metadata', 'mdata.pkl')
@@ -49,3 +73,230 @@ class ConfigMeta(object):
                                            notify-list author""".split()
             except:
                 pass
+
+
+# Bump when the layout of snapshot files changes; files of other versions
+# are ignored.
+SNAPSHOT_VERSION = 1
+
+_SNAPSHOT_SCHEMA = """
+CREATE TABLE info (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE fields (position INTEGER PRIMARY KEY, lcname TEXT, name TEXT,
+    description TEXT, ftype TEXT, dflt TEXT, flags TEXT, axis TEXT,
+    table_name TEXT);
+CREATE TABLE builtins (name TEXT PRIMARY KEY, lcname TEXT);
+CREATE TABLE enums (lcname TEXT PRIMARY KEY, subfields TEXT,
+    separators TEXT);
+CREATE TABLE enum_values (lcname TEXT, position INTEGER, value TEXT,
+    subvalues TEXT, PRIMARY KEY (lcname, position));
+"""
+
+# Joins lists (of subfields, subfield values...) in snapshot columns
+_LIST_SEP = u'\037'
+
+
+def snapshot_path(server, dbname):
+    """ Return the path of the snapshot of the named database on server, in
+    gnats.metadata_snapshot_dir, or None if that is not set. """
+    if not gnats.metadata_snapshot_dir:
+        return None
+    return os.path.join(gnats.metadata_snapshot_dir, '%s_%s_%s.sqlite' %
+                        (server.host, server.port, dbname))
+
+
+def open_snapshot(path):
+    """ Return the MetadataSnapshot at path, or None if there isn't a
+    usable one. """
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return MetadataSnapshot(path)
+    except (sqlite3.Error, KeyError, ValueError), e:
+        _LOG.warning("Ignoring metadata snapshot %s: %s", path, e)
+        return None
+
+
+class MetadataSnapshot(object):
+    """ A metadata snapshot file opened for reading.  Lookups are
+    serialized, so a snapshot may be shared between threads.
+
+    The sqlite file is read through mmap where sqlite supports it, so
+    processes using the same snapshot share its pages, and only the rows
+    that are looked up are read.
+    """
+
+    # Bytes of the file sqlite may memory-map
+    MMAP_SIZE = 64 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        try:
+            self._conn.execute('PRAGMA mmap_size=%d' % self.MMAP_SIZE)
+            info = dict(self._conn.execute('SELECT name, value FROM info'))
+            if int(info['version']) != SNAPSHOT_VERSION:
+                raise ValueError("version %s, not %s" %
+                                 (info['version'], SNAPSHOT_VERSION))
+        except:
+            self._conn.close()
+            raise
+        self.dbname = info['dbname']
+        self.config_time = info['config_time']
+        self.description = info['description']
+        self.written = float(info['written'])
+        self.initial_fields = _split(info['initial_fields'])
+        self.user_list_fields = _split(info['user_list_fields'])
+
+    def __str__(self):
+        return "Metadata snapshot of db %s, CFGT %s, in %s" % \
+            (self.dbname, self.config_time, self.path)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def close(self):
+        self._conn.close()
+
+    def fields(self):
+        """ Return a (lcname, name, description, ftype, default, flags, axis,
+        table_name) tuple for each field in dbconfig order, each table field
+        being followed by its columns, which have table_name set. """
+        return self._select('SELECT lcname, name, description, ftype, dflt, '
+                            'flags, axis, table_name FROM fields '
+                            'ORDER BY position')
+
+    def builtins(self):
+        """ Return a dict of builtin field name: field lcname. """
+        return dict(self._select('SELECT name, lcname FROM builtins'))
+
+    def enum_values(self, lcname):
+        """ Return (subfields, separators, values, values_dict) for the enum
+        field lcname, as EnumField holds them, or None if the snapshot has
+        none or can't be read. """
+        try:
+            enum = self._select('SELECT subfields, separators FROM enums '
+                                'WHERE lcname = ?', (lcname,))
+            rows = self._select('SELECT value, subvalues FROM enum_values '
+                                'WHERE lcname = ? ORDER BY position',
+                                (lcname,))
+        except sqlite3.Error, e:
+            _LOG.warning("Unable to read values of %s from %s: %s",
+                         lcname, self.path, e)
+            return None
+        if not enum:
+            return None
+        subfields = _split(enum[0][0])
+        values = []
+        values_dict = {}
+        for value, subvalues in rows:
+            values.append(value)
+            values_dict[value] = dict(zip(subfields, subvalues.split(_LIST_SEP)))
+        return subfields, enum[0][1], values, values_dict
+
+    def _select(self, sql, args=()):
+        self._lock.acquire()
+        try:
+            return self._conn.execute(sql, args).fetchall()
+        finally:
+            self._lock.release()
+
+
+def write_snapshot(database, path):
+    """ Write the metadata of database to a snapshot at path, replacing any
+    that is there.  database must have been loaded at FULL_METADATA; the
+    values of all its enum fields are loaded to write them.
+
+    The snapshot is written under a temporary name and renamed into place,
+    so readers never see a partial file.
+    """
+    if gnats.metadata_level < gnats.FULL_METADATA:
+        raise gnats.GnatsException("Snapshots need gnats.FULL_METADATA")
+    database.preload_enum_values()
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        conn.executescript(_SNAPSHOT_SCHEMA)
+        info = {
+            'version': SNAPSHOT_VERSION,
+            'dbname': database.name,
+            'config_time': database.last_config_time,
+            'description': database.description,
+            'written': repr(time.time()),
+            'initial_fields': [fld.lcname for fld
+                               in database.initial_entry_fields
+                               if fld.lcname not in database.envelope_fields],
+            'user_list_fields': ConfigMeta.user_list_fields,
+        }
+        for name, value in info.iteritems():
+            if isinstance(value, list):
+                value = _LIST_SEP.join(value)
+            conn.execute('INSERT INTO info VALUES (?, ?)',
+                         (name, _text(value)))
+        position = 0
+        for fld in database.ordered_fields:
+            fields = [(fld, None)]
+            if fld.ftype == 'table':
+                fields.extend([(col, fld.lcname)
+                               for col in fld.ordered_columns])
+            for field, table_name in fields:
+                conn.execute('INSERT INTO fields VALUES (?,?,?,?,?,?,?,?,?)',
+                    (position, field.lcname, _text(field.name),
+                     _text(field.description), field.ftype,
+                     _text(field.default), _flags(field),
+                     getattr(field, 'axis', ''), table_name))
+                position += 1
+                if field.ftype.find('enum') > -1:
+                    _write_enum(conn, field)
+        for name, fld in database.fields.iteritems():
+            if name.startswith('builtinfield:'):
+                conn.execute('INSERT INTO builtins VALUES (?, ?)',
+                             (name[len('builtinfield:'):], fld.lcname))
+        conn.commit()
+    finally:
+        conn.close()
+    os.rename(tmp_path, path)
+    _LOG.info("Wrote metadata snapshot of db %s to %s", database.name, path)
+
+
+def _write_enum(conn, fld):
+    subfields = fld.subfields or []
+    conn.execute('INSERT INTO enums VALUES (?, ?, ?)',
+                 (fld.lcname, _LIST_SEP.join([_text(sf) for sf in subfields]),
+                  _text(fld.separators or '')))
+    for position, value in enumerate(fld.values):
+        subvalues = fld.values_dict.get(value, {})
+        conn.execute('INSERT INTO enum_values VALUES (?, ?, ?, ?)',
+            (fld.lcname, position, _text(value),
+             _LIST_SEP.join([_text(subvalues.get(sf, ''))
+                             for sf in subfields])))
+
+
+def _flags(fld):
+    """ Rebuild the FIELDFLAGS of a Field from its attributes. """
+    flags = []
+    for attr, flag in (('_really_read_only', codes.FLAG_READ_ONLY),
+                       ('required', codes.FLAG_REQUIRED),
+                       ('require_change_reason',
+                        codes.FLAG_REQUIRE_CHANGE_REASON),
+                       ('multi_valued', codes.FLAG_MULTI_VALUED),
+                       ('text_search', codes.FLAG_TEXT_SEARCH),
+                       ('req_cond', codes.FLAG_REQ_COND),
+                       ('allow_any_value', codes.FLAG_ALLOW_ANY_VALUE)):
+        if getattr(fld, attr):
+            flags.append(flag)
+    return ' '.join(flags)
+
+
+def _text(value):
+    if isinstance(value, str):
+        return unicode(value, gnats.ENCODING, gnats.ENCODING_ERROR)
+    return unicode(value)
+
+
+def _split(value):
+    if not value:
+        return []
+    return value.split(_LIST_SEP)
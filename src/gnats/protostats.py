@@ -0,0 +1,121 @@
+"""
+Per-command counters for the gnatsd protocol.
+
+Every Server keeps a ProtocolStats, which its ServerConnections update as
+each command completes: the number of commands of each verb (QUER, EXPR,
+FVLD...), how many failed, a histogram of their latencies, the bytes
+written and read, and the records or lines of output read.  Updating them
+costs two clock reads and a lock per command, so they are always on:
+
+    server = gnats.get_database(host, dbname).server
+    for verb, counts in sorted(server.protocol_stats().items()):
+        print verb, counts['count'], counts['seconds']
+
+To export them to a metrics system as they happen, set a hook, which is
+called with (verb, seconds, bytes_out, bytes_in, records, failed) after
+each command:
+
+    server.stats.hook = my_metrics_hook
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import bisect
+import logging
+import threading
+
+_LOG = logging.getLogger('protostats')
+
+# Upper bounds, in seconds, of the buckets of the latency histograms; the
+# last bucket counts slower commands
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+
+class CommandStats(object):
+    """ Counters of the commands of one verb. """
+
+    __slots__ = ('count', 'failed', 'seconds', 'max_seconds', 'histogram',
+                 'bytes_out', 'bytes_in', 'records')
+
+    def __init__(self):
+        self.count = 0
+        self.failed = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.records = 0
+
+    def as_dict(self):
+        """ Return the counters as a dict; histogram is a list of
+        (upper bound, count) pairs, the last with a bound of None. """
+        return {'count': self.count, 'failed': self.failed,
+                'seconds': self.seconds, 'max_seconds': self.max_seconds,
+                'histogram': zip(LATENCY_BUCKETS + (None,), self.histogram),
+                'bytes_out': self.bytes_out, 'bytes_in': self.bytes_in,
+                'records': self.records}
+
+
+class ProtocolStats(object):
+    """ Thread-safe CommandStats for each protocol verb.
+
+    hook, if set, is called with (verb, seconds, bytes_out, bytes_in,
+    records, failed) by record(), outside the lock.  Exceptions it raises
+    are logged and otherwise ignored.
+    """
+
+    def __init__(self, hook=None):
+        self.hook = hook
+        self._lock = threading.Lock()
+        self._verbs = {}
+
+    def __str__(self):
+        return "ProtocolStats of %d verbs" % len(self._verbs)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def record(self, verb, seconds, bytes_out, bytes_in, records,
+               failed=False):
+        """ Count a command. """
+        self._lock.acquire()
+        try:
+            stats = self._verbs.get(verb)
+            if stats is None:
+                stats = self._verbs[verb] = CommandStats()
+            stats.count += 1
+            if failed:
+                stats.failed += 1
+            stats.seconds += seconds
+            if seconds > stats.max_seconds:
+                stats.max_seconds = seconds
+            stats.histogram[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+            stats.records += records
+        finally:
+            self._lock.release()
+        if self.hook is not None:
+            try:
+                self.hook(verb, seconds, bytes_out, bytes_in, records, failed)
+            except Exception, err:
+                _LOG.warning("Protocol stats hook failed: %s", err)
+
+    def snapshot(self):
+        """ Return a dict of each verb to its counters, see
+        CommandStats.as_dict(). """
+        self._lock.acquire()
+        try:
+            return dict([(verb, stats.as_dict())
+                         for verb, stats in self._verbs.iteritems()])
+        finally:
+            self._lock.release()
+
+    def reset(self):
+        """ Zero all counters. """
+        self._lock.acquire()
+        try:
+            self._verbs = {}
+        finally:
+            self._lock.release()
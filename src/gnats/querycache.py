@@ -0,0 +1,217 @@
+"""
+Query result cache for Database objects.
+
+Tools that run the same queries over and over within minutes can have the
+results kept, keyed by user and normalized query arguments:
+
+    db = gnats.get_database(host, dbname)
+    db.enable_query_cache(gnats.QueryCache(max_bytes=32 * 1024 * 1024))
+
+after which DatabaseHandle.query() answers repeated queries from memory.
+Entries are dropped when they are older than ttl seconds, when the gnatsd
+configuration (CFGT) changes, or when a probe query finds PRs modified since
+the entry was stored.  Rows of cached results are shared between callers,
+and should not be modified.
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from server import Row
+
+_LOG = logging.getLogger('querycache')
+
+
+class _Entry(object):
+    """ A cached query result. """
+
+    __slots__ = ('results', 'size', 'stored', 'checked', 'config_time')
+
+    def __init__(self, results, size, stored, config_time):
+        self.results = results
+        self.size = size
+        self.stored = stored
+        # Time from which PR changes have not been looked for yet
+        self.checked = stored
+        self.config_time = config_time
+
+
+class QueryCache(object):
+    """ A thread-safe LRU cache of query results, bounded by the estimated
+    size of the results in bytes.
+
+    A hit older than probe_interval seconds is checked with a probe query
+    for PRs whose last-modified is later than the time of the last check
+    less probe_slack seconds (an allowance for the clocks of gnatsd and the
+    client not agreeing).  Set probe_interval to None to rely on ttl alone.
+
+    hits, misses, evictions (entries pushed out to make room) and
+    invalidations (entries found to be stale) are counted; see stats().
+    """
+
+    MAX_BYTES = 16 * 1024 * 1024
+    TTL = 300
+    PROBE_INTERVAL = 5
+    PROBE_SLACK = 60
+
+    def __init__(self, max_bytes=MAX_BYTES, ttl=TTL,
+                 probe_interval=PROBE_INTERVAL, probe_slack=PROBE_SLACK):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.probe_interval = probe_interval
+        self.probe_slack = probe_slack
+        self._lock = threading.Lock()
+        # key: _Entry, least recently used first
+        self._entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __str__(self):
+        return "QueryCache of %d entries, %d bytes" % (len(self), self.size)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def key(self, username, expr, field_names, sort, table_cols, pr_list,
+            window=None):
+        """ Return the cache key for the arguments of a query, and the
+        window (limit, offset) of its results. """
+        if isinstance(field_names, basestring):
+            field_names = [field_names]
+        if isinstance(table_cols, dict):
+            table_cols = tuple(sorted([(name, tuple(cols)) for name, cols
+                                       in table_cols.iteritems()]))
+        if sort is not None:
+            sort = tuple([(fname.lower(), direct.lower())
+                          for fname, direct in sort])
+        if pr_list is not None and not isinstance(pr_list, basestring):
+            pr_list = tuple(sorted([str(pr) for pr in pr_list]))
+        if window == (None, 0):
+            window = None
+        return (username, (expr or '').strip(), tuple(field_names), sort,
+                table_cols, pr_list, window)
+
+    def get(self, key, dbh):
+        """ Return a copy of the cached results for key, or None.  dbh is
+        the DatabaseHandle asking, used to check the entry if need be. """
+        now = time.time()
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is not None and (
+                    now - entry.stored > self.ttl or
+                    entry.config_time != dbh.database.last_config_time):
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            probe = self.probe_interval is not None and \
+                now - entry.checked >= self.probe_interval
+        finally:
+            self._lock.release()
+        if probe:
+            if dbh._pr_changes_since(entry.checked - self.probe_slack):
+                _LOG.info("PRs modified, dropping cached query results")
+                self._lock.acquire()
+                try:
+                    if self._entries.get(key) is entry:
+                        self._drop(key)
+                    self.misses += 1
+                finally:
+                    self._lock.release()
+                return None
+            entry.checked = now
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                # Move it to the most recently used end
+                self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+        finally:
+            self._lock.release()
+        return list(entry.results)
+
+    def put(self, key, results, config_time, stored=None):
+        """ Cache the results of a query started at time stored, under the
+        CFGT config_time. """
+        if stored is None:
+            stored = time.time()
+        size = _result_size(results)
+        if size > self.max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _Entry(list(results), size, stored,
+                                        config_time)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._remove(self._entries.iterkeys().next())
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """ Drop all entries, counting them as invalidated. """
+        self._lock.acquire()
+        try:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self.size = 0
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return a dict of the counters, the number of entries and their
+        size, for sizing the cache. """
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'entries': len(self._entries), 'bytes': self.size}
+
+    def _drop(self, key):
+        self._remove(key)
+        self.invalidations += 1
+
+    def _remove(self, key):
+        self.size -= self._entries.pop(key).size
+
+
+# Rough per-object overheads, in bytes
+_ROW_OVERHEAD = 64
+_VALUE_OVERHEAD = 40
+
+def _result_size(value):
+    """ Estimate the memory held by query results.  Rows that have not been
+    split are measured by their span of the reply buffer. """
+    if isinstance(value, Row):
+        if value._fields is None:
+            return _ROW_OVERHEAD + value._end - value._start
+        value = value._fields
+    if isinstance(value, (list, tuple)):
+        size = _ROW_OVERHEAD
+        for item in value:
+            size += _result_size(item)
+        return size
+    if isinstance(value, dict):
+        size = _ROW_OVERHEAD
+        for item in value.itervalues():
+            size += _result_size(item)
+        return size
+    if isinstance(value, unicode):
+        return _VALUE_OVERHEAD + 4 * len(value)
+    if isinstance(value, str):
+        return _VALUE_OVERHEAD + len(value)
+    return _VALUE_OVERHEAD
@@ -0,0 +1,174 @@
+"""
+Query profiling for Database objects.
+
+When a query is slow, the profile of each DatabaseHandle.query() shows
+where its time went:
+
+    db = gnats.get_database(host, dbname)
+    profiler = db.enable_query_profiler()
+    ...
+    for profile in profiler.slowest(5):
+        print profile.seconds, profile.phases, profile.expr
+    profiler.dump(open('queries.json', 'w'))
+
+The phases of a query are:
+
+    cache      looking the query up in the Database's query_cache
+    setup      RSET, QFMT, TQFMT and EXPR, until QUER is sent
+    evaluate   from sending QUER to gnatsd's first reply line
+    transfer   reading the output off the socket
+    parse      splitting the output into Rows
+    sort       sorting the rows on the client
+    tables     splitting table fields into rows and columns
+    other      the rest
+
+For queries with a limit, whose output is streamed, transfer also covers
+parsing and sorting.  Profiling is off unless enabled, and then costs a few
+clock reads per query.
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import json
+import time
+import threading
+from collections import deque
+
+# Keys of ServerConnection.timings ending the phases they are paired with
+_TIMING_PHASES = (('setup', 'sent'), ('evaluate', 'reply'),
+                  ('transfer', 'read'), ('parse', 'parsed'))
+
+
+class QueryProfile(object):
+    """ Timings and sizes of one query().  phases is a dict of phase name
+    to seconds. """
+
+    def __init__(self, username, expr, field_names, sort, pr_list, limit,
+                 offset):
+        self.username = username
+        self.expr = expr or ''
+        if isinstance(field_names, basestring):
+            field_names = [field_names]
+        self.field_names = list(field_names or [])
+        self.sort = sort and [list(spec) for spec in sort] or None
+        self.prs = pr_list and len(pr_list) or 0
+        self.limit = limit
+        self.offset = offset
+        self.started = time.time()
+        self.seconds = None
+        self.phases = {}
+        self.rows = None
+        self.bytes = None
+        self.cached = False
+        self.error = None
+        self._last = self.started
+
+    def __str__(self):
+        return "QueryProfile of %d rows in %.3fs: %s" % \
+            (self.rows or 0, self.seconds or 0, self.expr)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def mark(self, phase, when=None):
+        """ Add the time since the last mark (up to when, if given) to
+        phase. """
+        if when is None:
+            when = time.time()
+        elif when < self._last:
+            return
+        self.phases[phase] = self.phases.get(phase, 0.0) + when - self._last
+        self._last = when
+
+    def mark_timings(self, timings):
+        """ Mark the phases ending at the times of a ServerConnection's
+        timings dict. """
+        if not timings:
+            return
+        for phase, key in _TIMING_PHASES:
+            if key in timings:
+                self.mark(phase, timings[key])
+
+    def as_dict(self):
+        """ Return the profile as a dict, for JSON. """
+        return {'username': self.username, 'expr': self.expr,
+                'expr_length': len(self.expr),
+                'field_names': self.field_names, 'sort': self.sort,
+                'prs': self.prs, 'limit': self.limit, 'offset': self.offset,
+                'started': self.started, 'seconds': self.seconds,
+                'phases': self.phases, 'rows': self.rows,
+                'bytes': self.bytes, 'cached': self.cached,
+                'error': self.error}
+
+
+class QueryProfiler(object):
+    """ A thread-safe record of the QueryProfiles of the last max_profiles
+    queries that took at least min_seconds. """
+
+    MAX_PROFILES = 1000
+
+    def __init__(self, max_profiles=MAX_PROFILES, min_seconds=0):
+        self.min_seconds = min_seconds
+        self._lock = threading.Lock()
+        self._profiles = deque(maxlen=max_profiles)
+
+    def __str__(self):
+        return "QueryProfiler of %d queries" % len(self._profiles)
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def start(self, username, expr, field_names, sort, pr_list, limit,
+              offset):
+        """ Return a QueryProfile for a query starting now. """
+        return QueryProfile(username, expr, field_names, sort, pr_list,
+                            limit, offset)
+
+    def finish(self, profile, rows=None, nbytes=None, error=None):
+        """ Complete profile, with the number of rows and bytes read, or the
+        error raised, and keep it if the query was slow enough. """
+        now = time.time()
+        profile.seconds = now - profile.started
+        other = profile.seconds - sum(profile.phases.itervalues())
+        if other > 0:
+            profile.phases['other'] = other
+        profile.rows = rows
+        profile.bytes = nbytes
+        if error is not None:
+            profile.error = getattr(error, 'message', None) or repr(error)
+        if profile.seconds < self.min_seconds:
+            return
+        self._lock.acquire()
+        try:
+            self._profiles.append(profile)
+        finally:
+            self._lock.release()
+
+    def profiles(self):
+        """ Return the kept QueryProfiles, oldest first. """
+        self._lock.acquire()
+        try:
+            return list(self._profiles)
+        finally:
+            self._lock.release()
+
+    def slowest(self, count=10):
+        """ Return the count slowest kept QueryProfiles, slowest first. """
+        return sorted(self.profiles(), key=lambda p: p.seconds,
+                      reverse=True)[:count]
+
+    def clear(self):
+        """ Forget the kept profiles. """
+        self._lock.acquire()
+        try:
+            self._profiles.clear()
+        finally:
+            self._lock.release()
+
+    def to_json(self):
+        """ Return the kept profiles as a JSON list. """
+        return json.dumps([p.as_dict() for p in self.profiles()])
+
+    def dump(self, fp):
+        """ Write the kept profiles to the file fp, as a JSON list. """
+        json.dump([p.as_dict() for p in self.profiles()], fp, indent=1)
@@ -7,19 +7,37 @@ Copyright (c) 2008-2009, Juniper Networks, Inc.
 All rights reserved.
 """
 import socket
+import errno
 import time
 import re
 import logging
+import threading
+import functools
+from collections import deque
 
 import gnats
 import codes
 from gnats import GnatsAccessException, GnatsException, GnatsNetworkException
 from gnats import Database
+from protostats import ProtocolStats
 
 _LOG = logging.getLogger('server')
 
-# Define global variable to re-use the same gnatsd connection.
-connection = None
+
+def _marks_broken(method):
+    """ Decorator for the ServerConnection methods that talk to gnatsd.  A
+    GnatsNetworkException means the conversation is out of step (or the
+    socket is gone), so the connection is flagged as broken and will not be
+    handed out again by a ConnectionPool.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except GnatsNetworkException:
+            self.broken = True
+            raise
+    return wrapper
 
 class Server(object):
     """ A GNATS server, which may host multiple Databases.
@@ -33,8 +51,13 @@ class Server(object):
 
     # Number of second to cache database list
     CACHE_TIME = 600
+    # Most connections the pool keeps open, and the number of seconds after
+    # which an idle pooled connection is closed
+    POOL_SIZE = 10
+    POOL_IDLE_TIMEOUT = 120
 
-    def __init__(self, host, port=codes.DEFAULT_PORT, cache_time=CACHE_TIME):
+    def __init__(self, host, port=codes.DEFAULT_PORT, cache_time=CACHE_TIME,
+                 pool_size=POOL_SIZE, pool_idle_timeout=POOL_IDLE_TIMEOUT):
         self.host = host
         self.port = int(port)
         self._database_names = []
@@ -43,6 +66,11 @@ class Server(object):
         self._dbusers = {} # hash of tuples of (username, passwd)
         self.cache_time = cache_time
         self.gnatsd_version = 'UNKNOWN'
+        # Guards creation of Database objects
+        self._lock = threading.RLock()
+        self.pool = ConnectionPool(self, pool_size, pool_idle_timeout)
+        # Per-verb counters of the commands of all connections
+        self.stats = ProtocolStats()
 
     def __str__(self):
         return "GNATS %s Server at %s:%s" % \
@@ -53,14 +81,23 @@ class Server(object):
 
     def list_databases(self, conn=None):
         """ List the databases on this server. """
-        if conn is not None or time.time() - self._dbls_time > self.cache_time:
-            conn = self.get_connection(conn)
-            global connection
-            connection = conn
-            self._database_names = conn.dbls()
+        if conn is not None:
+            self._database_names = self._validate_conn(conn).dbls()
+            self._dbls_time = time.time()
+        elif time.time() - self._dbls_time > self.cache_time:
+            conn = self.pool.get()
+            try:
+                self._database_names = conn.dbls()
+            finally:
+                self.pool.put(conn)
             self._dbls_time = time.time()
         return self._database_names
 
+    def protocol_stats(self):
+        """ Return a dict of each protocol verb sent to this server to its
+        counters, see protostats.ProtocolStats. """
+        return self.stats.snapshot()
+
     def _validate_conn(self, conn):
         """ Return the supplied connection if it is valid for this server,
         otherwise raise GnatsException.
@@ -81,17 +118,34 @@ class Server(object):
             self.gnatsd_version = conn.gnatsd_version
             return conn
 
-    def get_database_handle(self, dbname, username, passwd=None, conn=None):
+    def get_database_handle(self, dbname, username, passwd=None, conn=None,
+                            pooled=False):
         """ Return a connection to the named database. """
-        return self.get_database(dbname, conn).get_handle(username, passwd, conn)
+        return self.get_database(dbname, conn).get_handle(username, passwd, conn,
+                                                          pooled)
 
     def get_database(self, dbname, conn=None):
         """ Get a Database object.
 
-        If a connection is supplied, it will be used to fetch the db metadata.
+        If a connection is supplied, it will be used to fetch the db metadata,
+        otherwise one is borrowed from the pool.
         """
-        global connection
-        conn = connection
+        self._lock.acquire()
+        try:
+            if dbname in self._database_names and dbname in self._databases:
+                return self._databases[dbname]
+            if conn is not None:
+                return self._load_database(dbname, conn)
+            conn = self.pool.get()
+            try:
+                return self._load_database(dbname, conn)
+            finally:
+                self.pool.put(conn)
+        finally:
+            self._lock.release()
+
+    def _load_database(self, dbname, conn):
+        """ get_database() body, using the given connection. """
         if not dbname in self._database_names:
             self._dbls_time = 0
             self.list_databases(conn)
@@ -101,7 +155,7 @@ class Server(object):
         if self._databases.has_key(dbname):
             return self._databases[dbname]
         else:
-            db = Database(self, dbname, self.get_connection(conn))
+            db = Database(self, dbname, conn)
             self._databases[dbname] = db
             return db
 
@@ -112,7 +166,89 @@ class Server(object):
         return self._dbusers.get(dbname, ('gnatatui','*'))
 
 
-class ServerConnection(object):
+class _Protocol(object):
+    """ gnatsd protocol details that don't depend on how the conversation
+    is carried: cleaning up commands and interpreting replies.  Shared by
+    ServerConnection and asyncserver.AsyncServerConnection, which must have
+    strict_protocol and server attributes.
+    """
+
+    _CTRL_STRIP_RE = re.compile(r'[\x01-\x08\x0a-\x1a]')
+    def _clean_command(self, cmd):
+        """ Strip control characters out of a protocol command (see package
+        docs on 'allow_cmd_control_chars'), and encode it for sending. """
+        if gnats.allow_cmd_control_chars:
+            fixed_cmd = cmd.replace('\n', ' ')
+        else:
+            fixed_cmd = self._CTRL_STRIP_RE.sub(' ', cmd)
+        return fixed_cmd.encode(gnats.ENCODING, gnats.ENCODING_ERROR)
+
+    _SERVER_REPLY_RE = re.compile(r'(\d+)([- ]?)(.*?)\s*$')
+    def _parse_reply(self, raw_reply):
+        """ Parse a protocol reply line into (state, text, type). """
+        mo = self._SERVER_REPLY_RE.match(raw_reply)
+        if mo:
+            state = mo.group(1)
+            text = mo.group(3)
+            if mo.group(2) == '-':
+                rtype = codes.REPLY_CONT
+            else:
+                if mo.group(2) != ' ':
+                    raise GnatsNetworkException("Bad reply type from server " +
+                                                "(neither ' ' nor '-').", state)
+                rtype = codes.REPLY_END
+            return (state, text, rtype)
+        else:
+            raise GnatsNetworkException("Unparseable reply from server: '%s'" %
+                                        raw_reply)
+
+    def _check_error(self, state, rtype, rettext):
+        """ Deal with an error reply (400 - 699): raise GnatsAccessException
+        or GnatsException if it ends the reply, log the 600s otherwise.
+        rettext holds the reply text read so far, including this line.
+        """
+        if (state == codes.CODE_NO_ACCESS):
+            if hasattr(self, 'database'):
+                errmsg = 'You do not have access to database "%s"' % \
+                    getattr(self, 'database').name
+            else:
+                errmsg = 'Access denied'
+            raise GnatsAccessException(errmsg, state)
+        elif rtype != codes.REPLY_CONT:
+            raise GnatsException("Error: %s - %s" %
+                (state, '\n'.join(rettext)), state)
+        elif state > "500":
+            # Errors in the 400s are problems with user input
+            # and the like, while the 600s are "real" problems
+            _LOG.warning("Received error code %s: '%s'", state, rettext[-1])
+
+    def _check_unknown_state(self, state, text):
+        """ Raise GnatsNetworkException for a reply state we don't know,
+        unless strict_protocol is off. """
+        if self.strict_protocol:
+            raise GnatsNetworkException\
+                ("unknown state '%s' from gnatsd, with message '%s'" %
+                 (state, text), state)
+
+    _ACCESS_LEVEL_RE = re.compile(r"User access level set to '(\w*)'")
+    def _parse_access_level(self, srv_output):
+        mo = self._ACCESS_LEVEL_RE.match(srv_output)
+        if mo:
+            access_level = mo.group(1)
+        else:
+            access_level = 'none'
+        return access_level
+
+    def _quer_prs(self, prs):
+        """ Format the PR numbers argument of QUER. """
+        if prs is not None and not (isinstance(prs, basestring) or
+                isinstance(prs, int)):
+            prs = ' '.join([str(pr) for pr in prs])
+        if prs is None: prs = ''
+        return prs
+
+
+class ServerConnection(_Protocol):
     """ A connection to a GNATS server.
 
     This class is normally not directly employed by the user, instead a
@@ -125,26 +261,49 @@ class ServerConnection(object):
 
     Set strict_protocol to False to "work through" unknown reply state values.
     """
-    # TODO Consider using raw socket send/recv calls, instead of makefile.
-    # Profiling shows that half the time required for reading data is spent
-    # in socket._fileobject.readline() (almost half of that on data.find('\n')).
+    # Profiling showed that half the time required for reading data was spent
+    # in socket._fileobject.readline() (almost half of that on data.find('\n')),
+    # hence _SocketReader.  See package docs on 'recv_reader'.
     _SERVER_VERSION_RE = re.compile(r'.*GNATS server (.*) ready.*')
     def __init__(self, server, conn=None, strict_protocol=True):
         self.strict_protocol = strict_protocol
         self.server = server
+        # Record iterator of a streamed command whose output is not read yet
+        self._stream = None
+        # Set when talking to gnatsd failed, see _marks_broken
+        self.broken = False
+        # (database, user, passwd) of the last CHDB/USER, and the resulting
+        # access level
+        self.chdb_state = None
+        self.access_level = None
+        # [verb, time sent, bytes written, bytes read] of each command sent
+        # whose reply is not read yet, oldest first, and the number of bytes
+        # read so far, for server.stats
+        self._in_flight = deque()
+        self._bytes_in = 0
+        # Set to a dict to have the times of the last command sent ('sent'),
+        # and of the start ('reply'), end of reading ('read') and end of
+        # parsing ('parsed') of the last reply with data put in it, for
+        # queryprofile
+        self.timings = None
         if conn is not None:
             # copy the socket from the supplied connection.  get_connect() will
             # validate the supplied connection and return it.
             self._sock = server.get_connection(conn)._sock
             self._sfile = conn._sfile
             self.gnatsd_version = conn.gnatsd_version
+            self.chdb_state = conn.chdb_state
+            self.access_level = conn.access_level
             # XXX??? Should we do something to check the viability of the conn?
         else:
             # Make a new socket connection
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             try:
                 self._sock.connect((server.host, server.port))
-                self._sfile = self._sock.makefile()
+                if gnats.recv_reader:
+                    self._sfile = _SocketReader(self._sock)
+                else:
+                    self._sfile = self._sock.makefile()
                 mo = self._SERVER_VERSION_RE.match(self._get_reply(False)[0])
             except (socket.error, IOError):
                 raise GnatsNetworkException("Error connecting to gnatsd at "
@@ -162,7 +321,6 @@ class ServerConnection(object):
 
     # Protocol conversation methods
 
-    _CTRL_STRIP_RE = re.compile(r'[\x01-\x08\x0a-\x1a]')
     def command(self, cmd, parse=False):
         """ Send the given protocol command and arguments to gnatsd,
         return the output as a list of lines.
@@ -170,51 +328,110 @@ class ServerConnection(object):
         Most control characters are stripped out of the command before it
         is sent.  See package docs on 'allow_cmd_control_chars'.
         """
-        if gnats.allow_cmd_control_chars:
-            fixed_cmd = cmd.replace('\n', ' ')
-        else:
-            fixed_cmd = self._CTRL_STRIP_RE.sub(' ', cmd)
-        fixed_cmd = fixed_cmd.encode(gnats.ENCODING, gnats.ENCODING_ERROR)
-        _LOG.debug("Sending command '%s'", fixed_cmd)
+        self._send_command(cmd)
+        return self._get_reply(parse)
+
+    def pipeline(self):
+        """ Return a Pipeline, to send several commands in one go. """
+        return Pipeline(self)
+
+    # Reply states that are neither errors nor followed by data
+    _NO_DATA_STATES = (codes.CODE_OK, codes.CODE_GREETING, codes.CODE_CLOSING,
+                       codes.CODE_SEND_PR, codes.CODE_SEND_TEXT,
+                       codes.CODE_INFORMATION, codes.CODE_INFORMATION_FILLER)
+    @_marks_broken
+    def command_iter(self, cmd):
+        """ Send the given protocol command and arguments to gnatsd, and
+        return an iterator over the records of its output, parsed as for
+        command(cmd, parse=True).  Errors in the reply are raised right away,
+        as by command().
+
+        Records are handed out as they are read off the socket, so the
+        output is never held in memory all at once.  Sending another command
+        before the iterator is exhausted, or closing the iterator, first reads
+        and throws away the rest of the output.
+        """
+        self._send_command(cmd)
+        mark = self._bytes_in
+        rettext = []
+        rtype = codes.REPLY_CONT
         try:
-            self._sfile.write(fixed_cmd)
-            self._sfile.write("\n")
+            while rtype == codes.REPLY_CONT:
+                (state, text, rtype) = self._server_reply()
+                if (state == codes.CODE_PR_READY
+                    or state == codes.CODE_TEXT_READY):
+                    if self.timings is not None:
+                        self.timings['reply'] = time.time()
+                    entry = self._in_flight.popleft()
+                    entry[3] += self._bytes_in - mark
+                    self._stream = _RecordStream(self, entry)
+                    return self._stream
+                elif (state == codes.CODE_NO_PRS_MATCHED):
+                    break
+                elif (state >= '400' and state <= '799'):
+                    rettext.append(text)
+                    self._check_error(state, rtype, rettext)
+                elif state not in self._NO_DATA_STATES:
+                    self._check_unknown_state(state, text)
+        except GnatsNetworkException:
+            self._fail_in_flight()
+            raise
+        except GnatsException:
+            self._finish_command(self._bytes_in - mark, 0, True)
+            raise
+        self._finish_command(self._bytes_in - mark, 0, False)
+        return iter([])
+
+    def _finish_stream(self):
+        """ Read and discard what is left of a streamed command's output. """
+        if self._stream is not None:
+            self._stream.close()
+
+    def _send_command(self, cmd):
+        """ Clean up and send a protocol command, see command(). """
+        self._send_commands([cmd])
+
+    @_marks_broken
+    def _send_commands(self, cmds):
+        """ Clean up and send protocol commands, with a single flush. """
+        self._finish_stream()
+        fixed_cmds = []
+        now = time.time()
+        for cmd in cmds:
+            fixed_cmd = self._clean_command(cmd)
+            _LOG.debug("Sending command '%s'", fixed_cmd)
+            fixed_cmds.append(fixed_cmd)
+            self._in_flight.append([fixed_cmd.split(' ', 1)[0], now,
+                                    len(fixed_cmd) + 1, 0])
+        if self.timings is not None:
+            self.timings['sent'] = now
+        try:
+            for fixed_cmd in fixed_cmds:
+                self._sfile.write(fixed_cmd)
+                self._sfile.write("\n")
             self._sfile.flush()
         except (IOError, socket.error):
+            self._fail_in_flight()
             raise GnatsNetworkException('Error sending command "%s" to '
                     'gnatsd at %s port %s' %
-                    (fixed_cmd, self.server.host, self.server.port))
-        return self._get_reply(parse)
+                    ('; '.join(fixed_cmds), self.server.host, self.server.port))
 
-    _SERVER_REPLY_RE = re.compile(r'(\d+)([- ]?)(.*?)\s*$')
     def _server_reply(self):
         """ Read and parse protocol reply lines from the server.
 
         Returns (state, text, type, raw_reply).
         """
         try:
-            raw_reply = unicode(self._sfile.readline(), gnats.ENCODING)
+            raw_reply = self._sfile.readline()
         except (IOError, socket.error):
             raise GnatsNetworkException('Error reading reply from '
                 'gnatsd at %s port %s' % (self.server.host, self.server.port))
+        self._bytes_in += len(raw_reply)
+        raw_reply = unicode(raw_reply, gnats.ENCODING)
         if gnats.protocol_debug:
             # Log line w/o trailing newline
             _LOG.debug("Reply: %s", raw_reply[:-1])
-        mo = self._SERVER_REPLY_RE.match(raw_reply)
-        if mo:
-            state = mo.group(1)
-            text = mo.group(3)
-            if mo.group(2) == '-':
-                rtype = codes.REPLY_CONT
-            else:
-                if mo.group(2) != ' ':
-                    raise GnatsNetworkException("Bad reply type from server " +
-                                                "(neither ' ' nor '-').", state)
-                rtype = codes.REPLY_END
-            return (state, text, rtype)
-        else:
-            raise GnatsNetworkException("Unparseable reply from server: '%s'" %
-                                        raw_reply)
+        return self._parse_reply(raw_reply)
 
     def _read_server(self, parse):
         """ Read output from server until a line containing a single period
@@ -222,13 +439,12 @@ class ServerConnection(object):
 
         This code has been profiled and optimized.
         """
-        if parse:
-            output = _DelimitedData()
-        else:
-            output = []
+        if isinstance(self._sfile, _SocketReader):
+            return self._read_server_block(parse)
+        output = []
         while 1:
             try:
-                line = unicode(self._sfile.readline(), gnats.ENCODING)
+                line = self._sfile.readline()
             except (IOError, socket.error):
                 raise GnatsNetworkException('Error reading from gnatsd '
                     'at %s port %s' % (self.server.host, self.server.port))
@@ -237,6 +453,7 @@ class ServerConnection(object):
             if not line:
                 raise GnatsNetworkException("EOF encountered while reading " +
                                             "server output.")
+            self._bytes_in += len(line)
             if line[0] == '.':
                 if line.startswith('..'):
                     line = line[1:]
@@ -250,20 +467,88 @@ class ServerConnection(object):
             # is still faster than re.sub, if we have to go there.
             if not parse:
                 # Don't strip newlines for parsed data
-                line = line.rstrip()
+                line = unicode(line, gnats.ENCODING).rstrip()
             output.append(line)
+        if self.timings is not None:
+            self.timings['read'] = time.time()
+        if parse:
+            # Parsed data is split into Rows in one go, see _split_records()
+            output = _split_records(''.join(output))
+        if self.timings is not None:
+            self.timings['parsed'] = time.time()
         if _LOG.isEnabledFor(logging.DEBUG):
             _LOG.debug("Read %d %s from server.",
                        len(output), parse and 'records' or 'lines')
+        return output
+
+    def _read_server_block(self, parse):
+        """ _read_server() for a _SocketReader: the whole output is taken
+        off the socket buffer at once, then unescaped and split in bulk
+        rather than line by line.  Parsed output is left undecoded, for Rows
+        to decode field by field.
+        """
+        try:
+            raw = self._sfile.read_block()
+        except (IOError, socket.error):
+            raise GnatsNetworkException('Error reading from gnatsd '
+                'at %s port %s' % (self.server.host, self.server.port))
+        if raw is None:
+            raise GnatsNetworkException("EOF encountered while reading " +
+                                        "server output.")
+        # Plus the terminating period line
+        self._bytes_in += len(raw) + 3
+        # Undo the escaping of leading periods
+        if raw.startswith('..'):
+            raw = raw[1:]
+        raw = raw.replace('\n..', '\n.')
+        if self.timings is not None:
+            self.timings['read'] = time.time()
+        if gnats.protocol_debug:
+            _LOG.debug("Read: %s", raw)
         if parse:
-            return output.records
+            output = _split_records(raw)
         else:
-            return output
+            text = unicode(raw, gnats.ENCODING)
+            output = [line.rstrip() for line in text.split(u'\n')]
+            # text ends with a newline, leaving an empty string at the end
+            output.pop()
+        if self.timings is not None:
+            self.timings['parsed'] = time.time()
+        if _LOG.isEnabledFor(logging.DEBUG):
+            _LOG.debug("Read %d %s from server.",
+                       len(output), parse and 'records' or 'lines')
+        return output
 
+    @_marks_broken
     def _get_reply(self, parse=False):
         """ Process output from the server, calling _server_reply() to
         parse protocol lines, and _read_server() if additional data needs
-        to be read. """
+        to be read.
+
+        The command is counted in server.stats when its reply is read, or,
+        if gnatsd asks for text, when the reply to the text is read.
+        """
+        mark = self._bytes_in
+        try:
+            rettext, state = self._read_reply(parse)
+        except GnatsNetworkException:
+            self._fail_in_flight()
+            raise
+        except GnatsException:
+            self._finish_command(self._bytes_in - mark, 0, True)
+            raise
+        if state == codes.CODE_SEND_PR or state == codes.CODE_SEND_TEXT:
+            if self._in_flight:
+                self._in_flight[0][3] += self._bytes_in - mark
+        elif state == codes.CODE_PR_READY or state == codes.CODE_TEXT_READY:
+            self._finish_command(self._bytes_in - mark, len(rettext), False)
+        else:
+            self._finish_command(self._bytes_in - mark, 0, False)
+        return rettext
+
+    def _read_reply(self, parse):
+        """ _get_reply() body, returning the output and the state of the
+        last reply line. """
         rettext = []
         rtype = codes.REPLY_CONT
         while rtype == codes.REPLY_CONT:
@@ -276,6 +561,8 @@ class ServerConnection(object):
             elif (state == codes.CODE_PR_READY
                   or state == codes.CODE_TEXT_READY):
                 # XXX??? This will throw away any previously read lines.
+                if self.timings is not None:
+                    self.timings['reply'] = time.time()
                 rettext = self._read_server(parse)
             elif (state == codes.CODE_SEND_PR
                   or state == codes.CODE_SEND_TEXT):
@@ -290,40 +577,53 @@ class ServerConnection(object):
             #elif (state == codes.CODE_INVALID_LIST):
             #    pass
             elif (state == codes.CODE_NO_PRS_MATCHED):
-                return
+                return None, state
             elif (state >= '400' and state <= '799'):
                 # 400 - 699 are errors of varying levels of severity
-                if (state == codes.CODE_NO_ACCESS):
-                    if hasattr(self, 'database'):
-                        errmsg = 'You do not have access to database "%s"' % \
-                            getattr(self, 'database').name
-                    else:
-                        errmsg = 'Access denied'
-                    raise GnatsAccessException(errmsg, state)
-                else:
-                    rettext.append(text)
-                    if rtype != codes.REPLY_CONT:
-                        raise GnatsException("Error: %s - %s" %
-                            (state, '\n'.join(rettext)), state)
-                    else:
-                        if state > "500":
-                            # Errors in the 400s are problems with user input
-                            # and the like, while the 600s are "real" problems
-                            _LOG.warning("Received error code %s: '%s'",
-                                         state, text)
+                rettext.append(text)
+                self._check_error(state, rtype, rettext)
             else:
                 # gnatsd returned a state, but we don't know what it is
-                if self.strict_protocol:
-                    raise GnatsNetworkException\
-                        ("unknown state '%s' from gnatsd, with message '%s'" %
-                         (state, text), state)
-                else:
-                    rettext.append(text)
-        return rettext
+                self._check_unknown_state(state, text)
+                rettext.append(text)
+        return rettext, state
+
+    def _finish_command(self, bytes_in, records, failed):
+        """ Count the oldest command in flight in server.stats, adding
+        bytes_in to the bytes read for it. """
+        if not self._in_flight:
+            return
+        verb, sent, bytes_out, read = self._in_flight.popleft()
+        self.server.stats.record(verb, time.time() - sent, bytes_out,
+                                 read + bytes_in, records, failed)
+
+    def _fail_in_flight(self):
+        """ Count all commands in flight as failed, when the connection
+        fails. """
+        while self._in_flight:
+            self._finish_command(0, 0, True)
+
+    @_marks_broken
+    def _read_line(self):
+        """ Read one line of output from the server for _RecordStream,
+        undecoded. """
+        try:
+            line = self._sfile.readline()
+        except (IOError, socket.error):
+            raise GnatsNetworkException('Error reading from gnatsd '
+                'at %s port %s' % (self.server.host, self.server.port))
+        if gnats.protocol_debug:
+            _LOG.debug("Read: %s", line[:-1])
+        if not line:
+            raise GnatsNetworkException("EOF encountered while reading " +
+                                        "server output.")
+        self._bytes_in += len(line)
+        return line
 
     # Utility methods
 
     _DOT_ESCAPE_RE = re.compile(r'^\.', re.MULTILINE)
+    @_marks_broken
     def _send_text(self, text):
         """ Send the text to gnatsd, after escaping leading periods.  Used
         by check, subm, edit. """
@@ -332,25 +632,19 @@ class ServerConnection(object):
             encode(gnats.ENCODING, gnats.ENCODING_ERROR)
         if gnats.protocol_debug:
             _LOG.debug("Sending: %s", escaped)
+        if self._in_flight:
+            self._in_flight[-1][2] += len(escaped) + 4
         try:
             self._sfile.write(escaped)
             self._sfile.write('\n.\r\n')
             self._sfile.flush()
         except (IOError, socket.error):
+            self._fail_in_flight()
             raise GnatsNetworkException('Error sending data to '
                 'gnatsd at %s port %s' % (self.server.host, self.server.port))
         if _LOG.isEnabledFor(logging.DEBUG):
             _LOG.debug("Sent %d bytes to gnatsd", len(escaped))
 
-    _ACCESS_LEVEL_RE = re.compile(r"User access level set to '(\w*)'")
-    def _parse_access_level(self, srv_output):
-        mo = self._ACCESS_LEVEL_RE.match(srv_output)
-        if mo:
-            access_level = mo.group(1)
-        else:
-            access_level = 'none'
-        return access_level
-
     # Database level commands
 
     def dbls(self):
@@ -372,8 +666,11 @@ class ServerConnection(object):
             passwd = userpass[1]
         if user is None: user = ''
         if passwd is None: passwd = ''
+        self.chdb_state = None
         output = self.command('CHDB %s %s %s' % (dbname, user, passwd))
         access_level = self._parse_access_level(output[1])
+        self.chdb_state = (dbname, user, passwd)
+        self.access_level = access_level
 
         # check access level.  if < view, make them log in again.
         # it might be better to allow "create-only" access for users
@@ -389,7 +686,11 @@ class ServerConnection(object):
         """
         output =  self.command("USER %s %s" % (name, passwd))
         if name:
-            return self._parse_access_level(output[1])
+            access_level = self._parse_access_level(output[1])
+            if self.chdb_state is not None:
+                self.chdb_state = (self.chdb_state[0], name, passwd)
+                self.access_level = access_level
+            return access_level
         else:
             return output[0]
 
@@ -430,11 +731,14 @@ class ServerConnection(object):
         the constraints of EXPR, or with one or more PRs in its command,
         which will search those PRs specifically.
         """
-        if prs is not None and not (isinstance(prs, basestring) or
-                isinstance(prs, int)):
-            prs = ' '.join([str(pr) for pr in prs])
-        if prs is None: prs = ''
-        return self.command("QUER %s" % prs, parse)
+        return self.command("QUER %s" % self._quer_prs(prs), parse)
+
+    def quer_iter(self, prs=''):
+        """ Like quer(parse=True), but return an iterator over the records,
+        which are read from the server as the iterator is consumed.  See
+        command_iter().
+        """
+        return self.command_iter("QUER %s" % self._quer_prs(prs))
 
     def rset(self):
         """ RSET
@@ -676,39 +980,613 @@ class ServerConnection(object):
         return self.command("HELP")
 
 
-class _DelimitedData(object):
-    """ Collect input and parse into records based on field & record delimiters.
-    """
+class Pipeline(object):
+    """ A batch of protocol commands, written to gnatsd with a single flush,
+    after which the replies are read in order.  This saves a round trip per
+    command:
 
-    _record_separator = codes.RECORD_SEP + '\r\n'
-    _rs_len = len(_record_separator)
+        pipe = conn.pipeline()
+        pipe.rset()
+        pipe.qfmt(format)
+        pipe.quer('1234', parse=True)
+        replies = pipe.execute()
+
+    Only commands that need no further input from the client can be batched
+    (LOCKN and UNLK, but not SUBM, EDIT, APPN and the like).  Keep in mind
+    that gnatsd carries out every command even if an earlier one failed: a
+    QUER batched after an EXPR that gets rejected searches the whole
+    database.
+    """
 
-    def __init__(self):
-        self.records = []
-        self._buffer = []
+    def __init__(self, conn):
+        self.conn = conn
+        # (command, parse) pairs
+        self._commands = []
 
     def __len__(self):
-        return len(self.records)
+        return len(self._commands)
+
+    def command(self, cmd, parse=False):
+        """ Queue a protocol command; see ServerConnection.command(). """
+        self._commands.append((cmd, parse))
+        return self
+
+    def rset(self):
+        return self.command("RSET")
+
+    def qfmt(self, format):
+        return self.command("QFMT %s" % format)
+
+    def tqfmt(self, field_name, format):
+        return self.command("TQFMT %s %s" % (field_name, format))
+
+    def expr(self, expr):
+        return self.command("EXPR %s" % expr)
+
+    def quer(self, prs='', parse=False):
+        return self.command("QUER %s" % self.conn._quer_prs(prs), parse)
+
+    # Edit session commands (those needing no text), as sent by the
+    # ServerConnection methods of the same names.  Unlike
+    # ServerConnection.lockn(), a LOCKN rejected as unknown (code 600) is not
+    # retried with LOCK.
+
+    def editaddr(self, address):
+        return self.command("EDITADDR %s" % address)
 
-    def append(self, value=''):
-        """ Append a chunk of data, which may hold bits of multiple records. """
-        start = 0
+    def lockn(self, prnum, user, pid, session_id=''):
+        return self.command("LOCKN %s %s %s %s" %
+                            (prnum, user, pid, session_id))
+
+    def unlk(self, prnum):
+        return self.command("UNLK %s" % prnum)
+
+    # Metadata commands, as sent by the ServerConnection methods of the
+    # same names
+
+    def list(self, list_type):
+        return self.command("LIST %s" % list_type)
+
+    def ftyp(self, fields):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        return self.command("FTYP %s" % ' '.join(fields))
+
+    def fdsc(self, fields):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        return self.command("FDSC %s" % ' '.join(fields))
+
+    def fieldflags(self, fields):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        return self.command("FIELDFLAGS %s" % ' '.join(fields))
+
+    def inputdefault(self, fields):
+        if isinstance(fields, basestring):
+            fields = [fields]
+        return self.command("INPUTDEFAULT %s" % ' '.join(fields))
+
+    def ftypinfo(self, field, prop):
+        return self.command("FTYPINFO %s %s" % (field, prop))
+
+    def fvld(self, field, *subfield_args):
+        return self.command("FVLD %s %s" % (field, ' '.join(subfield_args)))
+
+    def execute(self, raise_errors=True):
+        """ Send the queued commands, and return the list of their replies
+        (as command() would return them), in order.
+
+        If commands fail, the replies to the rest are still read, so the
+        connection stays usable, and then the exception of the first failure
+        is raised.  The exception gets a command attribute holding the
+        command that failed, and an index attribute with its position in the
+        batch.  If raise_errors is false, the exception of each failed
+        command takes the place of its reply instead.  Network errors are
+        raised right away.
+        """
+        commands = self._commands
+        self._commands = []
+        if not commands:
+            return []
+        self.conn._send_commands([cmd for cmd, __ in commands])
+        replies = []
+        error = None
+        for index, (cmd, parse) in enumerate(commands):
+            try:
+                replies.append(self.conn._get_reply(parse))
+            except GnatsNetworkException:
+                raise
+            except GnatsException, err:
+                _LOG.info("Pipelined command %d ('%s') failed: %s",
+                          index, cmd, err.message)
+                err.command = cmd
+                err.index = index
+                if not raise_errors:
+                    replies.append(err)
+                    continue
+                if error is None:
+                    error = err
+                replies.append(None)
+        if error is not None:
+            raise error
+        return replies
+
+
+class ConnectionPool(object):
+    """ A thread-safe pool of ServerConnections to one Server.
+
+    get() hands out an idle connection, or opens a new one if fewer than
+    max_size are open; otherwise it waits until one is put() back.  An idle
+    connection is checked with RSET before it is handed out, and a new one
+    is opened in its place if that fails.  Connections left idle for more
+    than idle_timeout seconds are closed, as gnatsd drops idle clients.
+
+    Connections remember the database and user they were last CHDB'd to
+    (ServerConnection.chdb_state), so get(dbname, username, passwd) only sends
+    CHDB when those differ.  Connections flagged as broken are closed instead
+    of going back to the pool.
+
+    Normally used through Database.get_handle(..., pooled=True).
+    """
+
+    def __init__(self, server, max_size, idle_timeout, wait_timeout=None):
+        self.server = server
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        # Seconds get() waits for a free connection, None waits forever
+        self.wait_timeout = wait_timeout
+        self._cond = threading.Condition()
+        # (connection, time it was put back), most recent last
+        self._idle = []
+        # Number of open connections, idle or checked out
+        self._size = 0
+
+    def __str__(self):
+        return "ConnectionPool for %s" % self.server
+
+    def __repr__(self):
+        return "<%s>" % self.__str__()
+
+    def get(self, dbname=None, username='', passwd=''):
+        """ Check out a connection.  If dbname is given, the connection is
+        logged into that database as username.
+
+        Raises GnatsException if no connection frees up within wait_timeout
+        seconds, and whatever opening a connection or CHDB raises.
+        """
+        if username is None: username = ''
+        if passwd is None: passwd = ''
+        deadline = None
+        if self.wait_timeout is not None:
+            deadline = time.time() + self.wait_timeout
         while 1:
-            index = value.find(self._record_separator, start)
-            if index > -1:
-                # This chunk contains the end of a record, the beginning of
-                # which may be in the buffer
-                self._buffer.append(value[start:index])
-                # Reconstruct the raw record, and split it on separators
-                raw = ''.join(self._buffer)
-                self.records.append(raw.split(codes.FIELD_SEP))
-                self._buffer = []
-                if len(value) > (index + self._rs_len):
-                    # There's more to process
-                    start = index + self._rs_len
+            conn = self._checkout(deadline)
+            fresh = conn is None
+            if fresh:
+                try:
+                    conn = self.server.get_connection()
+                except:
+                    self._forget()
+                    raise
+            elif not self._healthy(conn):
+                _LOG.info("Replacing dead pooled connection to %s",
+                          self.server)
+                self._discard(conn)
+                continue
+            try:
+                if dbname is not None and \
+                        conn.chdb_state != (dbname, username, passwd):
+                    conn.chdb(dbname, username, passwd)
+            except GnatsNetworkException:
+                self._discard(conn)
+                if fresh:
+                    raise
+                continue
+            except:
+                # Don't know what database the connection is left in
+                self._discard(conn)
+                raise
+            return conn
+
+    def put(self, conn):
+        """ Give a connection back to the pool. """
+        if conn._stream is not None:
+            try:
+                conn._finish_stream()
+            except GnatsException:
+                pass
+        if conn.broken:
+            self._discard(conn)
+            return
+        self._cond.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close(self):
+        """ Close all idle connections. """
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+        finally:
+            self._cond.release()
+        for conn, __ in idle:
+            try:
+                conn.close()
+            except GnatsException:
+                pass
+
+    def _checkout(self, deadline):
+        """ Return an idle connection, or None if the caller may open a new
+        one (which then counts against max_size). """
+        self._cond.acquire()
+        try:
+            while 1:
+                self._expire()
+                if self._idle:
+                    return self._idle.pop()[0]
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+                if deadline is None:
+                    self._cond.wait()
                 else:
-                    break
-            else:
-                # chunk is merely part of a record, save it in the buffer
-                self._buffer.append(value[start:])
-                break
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise GnatsException("No connection to %s available "
+                            "after %s seconds" % (self.server, self.wait_timeout))
+                    self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+    def _expire(self):
+        """ Close connections idle for too long.  Called with the lock held. """
+        limit = time.time() - self.idle_timeout
+        while self._idle and self._idle[0][1] < limit:
+            conn = self._idle.pop(0)[0]
+            self._size -= 1
+            self._close_socket(conn)
+
+    def _healthy(self, conn):
+        try:
+            conn.rset()
+            return True
+        except GnatsException:
+            return False
+
+    def _discard(self, conn):
+        """ Close a checked out connection, and free its slot. """
+        self._close_socket(conn)
+        self._forget()
+
+    def _forget(self):
+        self._cond.acquire()
+        try:
+            self._size -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def _close_socket(self, conn):
+        try:
+            conn._sock.close()
+        except (IOError, socket.error):
+            pass
+
+
+class _SocketReader(object):
+    """ Buffered file-like wrapper around a socket, used by ServerConnection
+    in place of socket.makefile() (see package docs on 'recv_reader').
+
+    Data is received in large chunks with recv_into() a reusable bytearray,
+    and lines are found with find() on the receive buffer.  read_block()
+    hands out the whole dot-terminated output of a command in one piece, so
+    that it can be decoded and split in bulk.  Writes are buffered until
+    flush().
+    """
+
+    _TERMINATOR = '\n.\r\n'
+
+    def __init__(self, sock, bufsize=65536):
+        self._sock = sock
+        self._chunk = bytearray(bufsize)
+        self._chunk_view = memoryview(self._chunk)
+        # Received data; everything before _pos has been handed out
+        self._buf = bytearray()
+        self._pos = 0
+        self._out = []
+
+    def _fill(self):
+        """ Receive more data into the buffer, return False on EOF. """
+        if self._pos:
+            del self._buf[:self._pos]
+            self._pos = 0
+        while 1:
+            try:
+                count = self._sock.recv_into(self._chunk)
+            except socket.error, err:
+                if err.args[0] == errno.EINTR:
+                    continue
+                raise
+            break
+        if not count:
+            return False
+        self._buf += self._chunk_view[:count]
+        return True
+
+    def _take(self, end, skip=0):
+        """ Hand out the buffered data up to end, and drop skip bytes more. """
+        data = memoryview(self._buf)[self._pos:end].tobytes()
+        self._pos = end + skip
+        return data
+
+    def readline(self):
+        """ Return the next line, with its newline; at EOF, whatever is left
+        (which is the empty string once everything has been read). """
+        searched = 0
+        while 1:
+            end = self._buf.find('\n', self._pos + searched)
+            if end > -1:
+                return self._take(end + 1)
+            searched = len(self._buf) - self._pos
+            if not self._fill():
+                return self._take(len(self._buf))
+
+    def read_block(self):
+        """ Return the raw output up to (and without) the line holding a
+        single period, which is consumed.  The output still has its leading
+        periods escaped.  Returns None on EOF.
+        """
+        searched = 0
+        while 1:
+            avail = len(self._buf) - self._pos
+            if avail >= 3:
+                if self._buf.startswith('.\r\n', self._pos):
+                    self._pos += 3
+                    return ''
+                # The terminator may straddle the data searched already
+                end = self._buf.find(self._TERMINATOR,
+                                     self._pos + max(searched - 3, 0))
+                if end > -1:
+                    return self._take(end + 1, 3)
+                searched = avail
+            if not self._fill():
+                return None
+
+    def write(self, data):
+        self._out.append(data)
+
+    def flush(self):
+        data = ''.join(self._out)
+        self._out = []
+        self._sock.sendall(data)
+
+
+_RECORD_END = codes.RECORD_SEP + '\r\n'
+
+def _split_records(data):
+    """ Return a Row for each record of query output held in data, an
+    undecoded str.  Only the record boundaries are found here; a trailing
+    partial record is dropped.
+    """
+    rows = []
+    find = data.find
+    sep_len = len(_RECORD_END)
+    start = 0
+    while 1:
+        end = find(_RECORD_END, start)
+        if end < 0:
+            return rows
+        rows.append(Row(data, start, end))
+        start = end + sep_len
+
+
+class Row(object):
+    """ A record of query output, which behaves like a list of its field
+    values (indexing, slicing, iteration, comparison with lists).
+
+    A Row starts out as offsets into the undecoded buffer holding the whole
+    reply.  The record is split into fields the first time it is used, and
+    each field is decoded to unicode the first time it is read, so rows and
+    fields that are never looked at cost next to nothing.  tolist()
+    returns a plain list; copying or pickling a Row also gives a list.
+    """
+
+    __slots__ = ('_buf', '_start', '_end', '_fields')
+
+    def __init__(self, buf, start=0, end=None):
+        self._buf = buf
+        self._start = start
+        if end is None:
+            end = len(buf)
+        self._end = end
+        # Field values once split: str while undecoded, unicode (or
+        # whatever was assigned) afterwards
+        self._fields = None
+
+    def _split(self):
+        """ Split the record into its (undecoded) fields. """
+        self._fields = self._buf[self._start:self._end].split(codes.FIELD_SEP)
+        # Don't keep the reply alive for Rows that have been split
+        self._buf = None
+        return self._fields
+
+    def __len__(self):
+        fields = self._fields
+        if fields is None:
+            fields = self._split()
+        return len(fields)
+
+    def __getitem__(self, index):
+        # The hot path: _split() is inlined
+        fields = self._fields
+        if fields is None:
+            fields = self._fields = \
+                self._buf[self._start:self._end].split(codes.FIELD_SEP)
+            self._buf = None
+        value = fields[index]
+        if type(value) is str:
+            value = fields[index] = unicode(value, gnats.ENCODING)
+        elif type(index) is slice:
+            return [self[i] for i in xrange(*index.indices(len(fields)))]
+        return value
+
+    def __setitem__(self, index, value):
+        fields = self._fields
+        if fields is None:
+            fields = self._split()
+        if isinstance(index, slice):
+            value = list(value)
+        fields[index] = value
+
+    def __iter__(self):
+        self.tolist()
+        return iter(self._fields)
+
+    def __contains__(self, value):
+        return value in self.tolist()
+
+    def index(self, value):
+        return self.tolist().index(value)
+
+    def count(self, value):
+        return self.tolist().count(value)
+
+    def tolist(self):
+        """ Return the decoded fields as a list. """
+        fields = self._fields
+        if fields is None:
+            # Decode the record in one go
+            fields = self._fields = \
+                unicode(self._buf[self._start:self._end],
+                        gnats.ENCODING).split(codes.FIELD_SEP)
+            self._buf = None
+        else:
+            encoding = gnats.ENCODING
+            for i, value in enumerate(fields):
+                if type(value) is str:
+                    fields[i] = unicode(value, encoding)
+        return list(fields)
+
+    def __add__(self, other):
+        return self.tolist() + list(other)
+
+    def __radd__(self, other):
+        return list(other) + self.tolist()
+
+    def _other(self, other):
+        """ other as a list, or None if it can't be compared to a Row. """
+        if isinstance(other, Row):
+            return other.tolist()
+        if isinstance(other, list):
+            return other
+        return None
+
+    def __eq__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() == other
+
+    def __ne__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() != other
+
+    def __lt__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() < other
+
+    def __le__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() <= other
+
+    def __gt__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() > other
+
+    def __ge__(self, other):
+        other = self._other(other)
+        if other is None:
+            return NotImplemented
+        return self.tolist() >= other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        return (list, (self.tolist(),))
+
+    def __repr__(self):
+        return repr(self.tolist())
+
+
+class _RecordStream(object):
+    """ Iterator over the records of a command's output, which reads from the
+    server only as far as needed to hand out the next record.  See
+    ServerConnection.command_iter().
+    """
+
+    def __init__(self, conn, entry=None):
+        self._conn = conn
+        self._records = []
+        # Lines of the record being read
+        self._pending = []
+        self.count = 0
+        self.done = False
+        # The command's entry of conn._in_flight, counted in the server's
+        # stats once the output is read
+        self._entry = entry
+        self._mark = conn._bytes_in
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """ Return the next record, reading more output if need be. """
+        while not self._records:
+            if self.done:
+                raise StopIteration
+            line = self._conn._read_line()
+            if line[0] == '.':
+                if line.startswith('..'):
+                    line = line[1:]
+                elif line.startswith('.\r'):
+                    self._end()
+                    continue
+            self._pending.append(line)
+            if line.endswith(_RECORD_END):
+                self._records = _split_records(''.join(self._pending))
+                self._pending = []
+        self.count += 1
+        return self._records.pop(0)
+
+    def close(self):
+        """ Read and throw away the rest of the output. """
+        while not self.done:
+            if self._conn._read_line().startswith('.\r'):
+                self._end()
+        self._records = []
+        self._pending = []
+
+    def _end(self):
+        self.done = True
+        if self._conn._stream is self:
+            self._conn._stream = None
+        if self._entry is not None:
+            verb, sent, bytes_out, read = self._entry
+            self._conn.server.stats.record(verb, time.time() - sent, bytes_out,
+                read + self._conn._bytes_in - self._mark, self.count)
+        if _LOG.isEnabledFor(logging.DEBUG):
+            _LOG.debug("Streamed %d records from server.", self.count)
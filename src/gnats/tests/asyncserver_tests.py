@@ -0,0 +1,302 @@
+#!/usr/bin/python
+"""
+Unit tests for the gnats asyncserver module
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import unittest
+import socket
+import threading
+
+import gnats
+from gnats import GnatsException, GnatsNetworkException, codes
+from gnats import Database
+from gnats.asyncserver import AsyncClient, _AsyncReply
+from gnats.server import _Protocol
+from gnats.tests.database_tests import FakeServerConnectionForDB
+
+# Shut up logging during the tests
+import logging
+logging.disable(logging.FATAL)
+
+def records(*rows):
+    """ Protocol text of a 300 reply holding the given rows. """
+    return "300 PRs follow.\r\n" + \
+        ''.join([codes.FIELD_SEP.join(row) + codes.RECORD_SEP + "\r\n"
+                 for row in rows]) + ".\r\n"
+
+class FakeGnatsd(threading.Thread):
+    """ Serves connections on a local port.  Each command gets the reply in
+    replies under the longest matching command prefix, or "210 Ok.".  The
+    commands of every connection are recorded in sessions.  A reply of None
+    drops the connection.
+    """
+
+    def __init__(self, replies):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.replies = replies
+        self.sessions = []
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(20)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while 1:
+            try:
+                sock = self.listener.accept()[0]
+            except socket.error:
+                return
+            commands = []
+            self.sessions.append(commands)
+            worker = threading.Thread(target=self.serve,
+                                      args=(sock, commands))
+            worker.setDaemon(True)
+            worker.start()
+
+    def serve(self, sock, commands):
+        sfile = sock.makefile()
+        sock.sendall('200 localhost GNATS server 4.0-TEST ready.\r\n')
+        while 1:
+            line = sfile.readline()
+            if not line:
+                sock.close()
+                return
+            cmd = line.rstrip('\r\n')
+            commands.append(cmd)
+            reply = "210 Ok.\r\n"
+            prefixes = [p for p in self.replies if cmd.startswith(p)]
+            if prefixes:
+                reply = self.replies[max(prefixes, key=len)]
+            if reply is None:
+                sock.close()
+                return
+            sock.sendall(reply)
+
+    def stop(self):
+        self.listener.close()
+
+
+class T01_AsyncReply(unittest.TestCase):
+    """ Reading replies a line at a time """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.conn = _Protocol()
+        self.conn.strict_protocol = True
+
+    def feed(self, text, parse=False):
+        reply = _AsyncReply(parse, None)
+        lines = text.splitlines(True)
+        for i, line in enumerate(lines):
+            finished = reply.feed(self.conn, line)
+            self.assertEqual(finished, i == len(lines) - 1)
+        return reply
+
+    def test_01_simple(self):
+        """ One-line reply """
+        self.assertEqual(self.feed("210 Ok.\r\n").rettext, ['Ok.'])
+
+    def test_02_continued(self):
+        """ Continued reply """
+        reply = self.feed("210-Now accessing GNATS database 'db'\r\n"
+                          "210 User access level set to 'edit'\r\n")
+        self.assertEqual(reply.rettext, ["Now accessing GNATS database 'db'",
+                                         "User access level set to 'edit'"])
+
+    def test_03_text(self):
+        """ Unparsed 301 reply, with a dot-escape """
+        reply = self.feed("301 List follows.\r\nfoo\r\n..bar\r\n.\r\n")
+        self.assertEqual(reply.rettext, ['foo', '.bar'])
+
+    def test_04_parsed(self):
+        """ Parsed 300 reply """
+        reply = self.feed(records(['1', 'a'], ['2', 'b']), parse=True)
+        self.assertEqual(reply.rettext, [['1', 'a'], ['2', 'b']])
+
+    def test_05_no_match(self):
+        """ 220 gives None """
+        self.assertEqual(self.feed("220 No PRs Matched\r\n").rettext, None)
+
+    def test_06_error(self):
+        """ Error reply sets error """
+        reply = self.feed("432 Invalid expression\r\n")
+        self.assertEqual(reply.rettext, None)
+        self.assertTrue(isinstance(reply.error, GnatsException))
+        self.assertEqual(reply.error.code, '432')
+
+    def test_07_error_continued(self):
+        """ The rest of a reply is read after an access error """
+        reply = self.feed("422-No access\r\n210 Ok.\r\n")
+        self.assertTrue(isinstance(reply.error, gnats.GnatsAccessException))
+
+    def test_08_unknown_state(self):
+        """ Unknown state raises GnatsNetworkException """
+        reply = _AsyncReply(False, None)
+        self.assertRaises(GnatsNetworkException, reply.feed, self.conn,
+                          "999 Huh?\r\n")
+
+
+class T02_AsyncClient(unittest.TestCase):
+    """ AsyncClient and AsyncDatabaseHandle against a fake gnatsd """
+
+    chdb_reply = "210-Now accessing GNATS database 'testdb'\r\n" \
+                 "210 User access level set to 'edit'\r\n"
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.gnatsd = FakeGnatsd({
+            'CHDB': self.chdb_reply,
+            'QUER': records(['1', 'first'], ['2', 'second']),
+            'QUER 1': records(['1', 'first']),
+            'EXPR bad': "432 Invalid expression\r\n",
+            'EXPR hangup': None,
+            })
+        self.gnatsd.start()
+        self.server = gnats.Server('127.0.0.1', self.gnatsd.port)
+        self.db = Database(self.server, 'testdb',
+                           FakeServerConnectionForDB(self.server))
+        self.client = AsyncClient(self.db)
+        self.results = []
+        self.errors = []
+
+    def tearDown(self):
+        self.client.close()
+        self.gnatsd.stop()
+        unittest.TestCase.tearDown(self)
+
+    def test_01_login(self):
+        """ Handle logs in """
+        dbh = self.client.get_handle('user', 'pass')
+        self.client.run(10)
+        self.assertEqual(dbh.access_level, 'edit')
+        self.assertEqual(dbh.conn.gnatsd_version, '4.0-TEST')
+        self.assertEqual(self.gnatsd.sessions, [['CHDB testdb user pass']])
+
+    def test_02_query_expr(self):
+        """ Query with an expression sends QUER after EXPR is accepted """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('foo="bar"', ['number', 'synopsis'], self.results.append)
+        self.client.run(10)
+        self.assertEqual(self.results, [[['1', 'first'], ['2', 'second']]])
+        self.assertEqual([cmd.split(' ')[0]
+                          for cmd in self.gnatsd.sessions[0][1:]],
+                         ['RSET', 'QFMT', 'EXPR', 'QUER'])
+        self.assertEqual(self.gnatsd.sessions[0][3], 'EXPR foo="bar"')
+
+    def test_03_query_pr_list(self):
+        """ Query of a PR list """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('', ['number', 'synopsis'], self.results.append,
+                  pr_list=['1'])
+        self.client.run(10)
+        self.assertEqual(self.results, [[['1', 'first']]])
+        self.assertEqual(self.gnatsd.sessions[0][-1], 'QUER 1')
+
+    def test_04_bad_expr(self):
+        """ Rejected EXPR goes to the errback, and QUER is not sent """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('bad', ['number'], self.results.append,
+                  errback=self.errors.append)
+        self.client.run(10)
+        self.assertEqual(self.results, [])
+        self.assertEqual(self.errors[0].code, '432')
+        self.assertEqual(self.errors[0].command, 'EXPR bad')
+        self.assertFalse([c for c in self.gnatsd.sessions[0]
+                          if c.startswith('QUER')])
+
+    def test_05_unhandled_error(self):
+        """ run() raises errors that have no errback """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('bad', ['number'], self.results.append)
+        self.assertRaises(GnatsException, self.client.run, 10)
+
+    def test_06_callback_raises(self):
+        """ run() raises what a callback raised """
+        dbh = self.client.get_handle('user', 'pass')
+        def callback(rows):
+            raise ValueError(rows)
+        dbh.query('foo', ['number'], callback)
+        self.assertRaises(ValueError, self.client.run, 10)
+
+    def test_07_in_order(self):
+        """ Requests on one handle are carried out in order """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('', ['number'], self.results.append, pr_list=['1'])
+        dbh.query('foo', ['number'], self.results.append)
+        dbh.query('', ['number'], self.results.append, pr_list=['1'])
+        self.client.run(10)
+        self.assertEqual(len(self.results), 3)
+        self.assertEqual(self.results[0], self.results[2])
+        self.assertEqual(len(self.results[1]), 2)
+
+    def test_08_many_handles(self):
+        """ Many handles run at once """
+        for __ in range(10):
+            dbh = self.client.get_handle('user', 'pass')
+            dbh.query('foo', ['number'], self.results.append)
+        self.client.run(10)
+        self.assertEqual(len(self.results), 10)
+        self.assertEqual(len(self.gnatsd.sessions), 10)
+
+    def test_09_get_pr(self):
+        """ get_pr() """
+        self.gnatsd.replies['QUER 1'] = records(['fred', 'joe'])
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.get_pr('1', self.results.append,
+                   field_names=['enum-fld', 'synopsis'])
+        self.client.run(10)
+        self.assertEqual(self.results, [{'enum-fld': 'fred',
+                                         'synopsis': 'joe'}])
+
+    def test_10_get_pr_not_found(self):
+        """ get_pr() of a missing PR goes to the errback """
+        self.gnatsd.replies['QUER 1'] = "220 No PRs Matched\r\n"
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.get_pr('1', self.results.append, field_names=['synopsis'],
+                   errback=self.errors.append)
+        self.client.run(10)
+        self.assertTrue(isinstance(self.errors[0],
+                                   gnats.PRNotFoundException))
+
+    def test_11_quer(self):
+        """ quer() """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.quer(['1'], self.results.append)
+        self.client.run(10)
+        self.assertEqual(self.results, [[['1', 'first']]])
+
+    def test_12_hangup(self):
+        """ Dropped connection fails the request and those after it """
+        dbh = self.client.get_handle('user', 'pass')
+        dbh.query('hangup', ['number'], self.results.append,
+                  errback=self.errors.append)
+        dbh.query('foo', ['number'], self.results.append,
+                  errback=self.errors.append)
+        self.client.run(10)
+        self.assertEqual(self.results, [])
+        self.assertEqual(len(self.errors), 2)
+        for err in self.errors:
+            self.assertTrue(isinstance(err, GnatsNetworkException))
+        self.assertTrue(dbh.conn.broken)
+
+    def test_13_bad_args(self):
+        """ Bad query arguments raise right away """
+        dbh = self.client.get_handle('user', 'pass')
+        self.assertRaises(GnatsException, dbh.query, '', ['number'],
+                          self.results.append)
+
+
+classes = (
+           T01_AsyncReply,
+           T02_AsyncClient,
+          )
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    suites = []
+    for cl in classes:
+        suites.append(unittest.makeSuite(cl, 'test'))
+    runner.run(unittest.TestSuite(suites))
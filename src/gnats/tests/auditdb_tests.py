@@ -0,0 +1,155 @@
+#!/usr/bin/python
+"""
+Unit tests for gnats AuditDB
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+import unittest
+
+# Shut up logging during the tests
+import logging
+logging.disable(logging.FATAL)
+
+from gnats import auditdb, codes
+
+def make_audit_file(at_rows, cl_rows):
+    """ Return the path of a new sqlite file with the tables of
+    auditdb.SQLITE_SCHEMA, holding the given rows. """
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    conn = sqlite3.connect(path)
+    conn.executescript(auditdb.SQLITE_SCHEMA)
+    conn.executemany("INSERT INTO AUDIT_TRAIL VALUES (?, ?, ?, ?, ?)",
+                     at_rows)
+    conn.executemany("INSERT INTO CHANGE_LOG VALUES "
+                     "(?, ?, ?, ?, ?, ?, ?, ?, ?)", cl_rows)
+    conn.commit()
+    conn.close()
+    return path
+
+AT_ROWS = [(1, 2, 'joe', '2009-01-02 10:00:00 -0800', 'again'),
+           (1, 1, 'joe', '2009-01-01 10:00:00 -0800', 'hi'),
+           (2, 1, 'ann', '2009-07-01 10:00:00 -0700', None)]
+CL_ROWS = [(2, 1, 'ann', '2009-07-01 10:00:00 -0700', 'state', 'open',
+            'closed', 'done', '1')]
+
+
+class FakeCxOracle(object):
+    """ Stands in for the cx_Oracle module and its connections and
+    cursors, recording what is executed. """
+
+    def __init__(self):
+        self.connects = []
+        self.executed = []
+        self.closed = 0
+
+    def Connection(self, *args):
+        self.connects.append(args)
+        return self
+
+    def cursor(self):
+        return self
+
+    def execute(self, query, params):
+        self.executed.append((query, params))
+        self.rows = []
+
+    def fetchmany(self):
+        rows = self.rows
+        self.rows = []
+        return rows
+
+    def close(self):
+        self.closed += 1
+
+
+class T01_AuditDB(unittest.TestCase):
+    """ AuditDB with a sqlite file """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.path = make_audit_file(AT_ROWS, CL_ROWS)
+        self.adb = auditdb.sqlite_audit_db(self.path, in_limit=2,
+                                           arraysize=1)
+
+    def tearDown(self):
+        self.adb.close()
+        os.remove(self.path)
+        unittest.TestCase.tearDown(self)
+
+    def test_01_get(self):
+        """ Rows of each PR, in row-id order, as dicts of unicode """
+        out = self.adb.get(['1', '2', '3'])
+        self.assertEqual(out['1']['audit-trail'],
+            [{u'row-id': u'1', u'username': u'joe',
+              u'datetime': u'2009-01-01 10:00:00 PST', u'info': u'hi'},
+             {u'row-id': u'2', u'username': u'joe',
+              u'datetime': u'2009-01-02 10:00:00 PST', u'info': u'again'}])
+        self.assertEqual(out['1']['change-log'], [])
+        self.assertEqual(out['2']['audit-trail'][0][u'info'], u'')
+        self.assertEqual(out['2']['change-log'][0][u'datetime'],
+                         u'2009-07-01 10:00:00 PDT')
+        self.assertEqual(out['2']['change-log'][0][u'to'], u'closed')
+        self.assertEqual(out['3'], {'audit-trail': [], 'change-log': []})
+
+    def test_02_chunks(self):
+        """ One query of each table per in_limit PRs """
+        self.adb.get(['1', '2', '3'])
+        self.assertEqual(self.adb.queries, 4)
+
+    def test_03_pooled(self):
+        """ Connections are reused """
+        self.adb.get(['1'])
+        self.adb.get(['2'])
+        self.assertEqual(self.adb.connections, 1)
+        self.assertEqual(len(self.adb._idle), 1)
+        self.adb.close()
+        self.assertEqual(len(self.adb._idle), 0)
+
+    def test_04_error(self):
+        """ Errors are raised, and the connection is not kept """
+        self.adb.at_query = "SELECT * FROM NO_SUCH_TABLE WHERE ID IN (%s)"
+        self.assertRaises(sqlite3.Error, self.adb.get, ['1'])
+        self.assertEqual(len(self.adb._idle), 0)
+
+    def test_05_no_prs(self):
+        """ No PRs, no connection """
+        self.assertEqual(self.adb.get([]), {})
+        self.assertEqual(self.adb.connections, 0)
+
+    def test_06_oracle(self):
+        """ The Oracle AuditDB binds named parameters """
+        oracle = FakeCxOracle()
+        sys.modules['cx_Oracle'] = oracle
+        try:
+            adb = auditdb.oracle_audit_db(arraysize=100)
+            adb.get(['12', '34'])
+        finally:
+            del sys.modules['cx_Oracle']
+        self.assertEqual(oracle.connects, [(codes.DEFAULT_USER,
+            codes.DEFAULT_PASSWORD, codes.DEFAULT_DB)])
+        query, params = oracle.executed[0]
+        self.assertTrue('IN (:p0, :p1)' in query)
+        self.assertEqual(params, {'p0': 12, 'p1': 34})
+        self.assertEqual(oracle.arraysize, 100)
+
+    def test_07_bad_paramstyle(self):
+        """ Unsupported paramstyles are refused """
+        self.assertRaises(ValueError, auditdb.AuditDB, None, 'format')
+
+
+classes = (
+           T01_AuditDB,
+          )
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    suites = []
+    for cl in classes:
+        suites.append(unittest.makeSuite(cl, 'test'))
+    runner.run(unittest.TestSuite(suites))
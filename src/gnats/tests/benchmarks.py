@@ -0,0 +1,382 @@
+#!/usr/bin/python
+"""
+Benchmarks for the gnats protocol code.  Not part of the unit tests, run as:
+
+    python -m gnats.tests.benchmarks [megabytes]
+
+bench_reader talks to a fake gnatsd on a local socket, which answers every
+QUER with the same synthetic query reply.  bench_rows parses that reply in
+memory.  bench_sort sorts synthetic query results the way query() does.
+bench_audit reads Audit-Trails and Change-Logs from a sqlite stand-in for
+the audit database.
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+import socket
+import threading
+
+import gnats
+from gnats import Server, Database, codes, server, database, auditdb
+
+# Shut up logging during the benchmarks
+import logging
+logging.disable(logging.FATAL)
+
+
+def synthetic_reply(megabytes):
+    """ Build a QUER reply of roughly the given size: records of a few short
+    fields and a multi-line text field, some lines needing dot-escapes. """
+    record = codes.FIELD_SEP.join([
+        '%d', 'open', 'some-category', 'someuser',
+        'Synopsis of a problem report, long enough to be realistic',
+        'First line of a multitext field\r\n'
+        '..a line starting with a period\r\n'
+        'and a last line']) + codes.RECORD_SEP + '\r\n'
+    count = megabytes * 1024 * 1024 / len(record)
+    body = ''.join([record % (i + 1) for i in xrange(count)])
+    return '300 PRs follow.\r\n' + body + '.\r\n', count
+
+
+class FakeGnatsd(threading.Thread):
+    """ Accepts connections on a local port, greets, and answers QUER with
+    the canned reply and anything else with a 210. """
+
+    def __init__(self, reply):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.reply = reply
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.port = self.listener.getsockname()[1]
+
+    def run(self):
+        while 1:
+            sock = self.listener.accept()[0]
+            worker = threading.Thread(target=self.serve, args=(sock,))
+            worker.setDaemon(True)
+            worker.start()
+
+    def serve(self, sock):
+        sfile = sock.makefile()
+        sock.sendall('200 localhost GNATS server 4.0-BENCH ready.\r\n')
+        while 1:
+            line = sfile.readline()
+            if not line or line.startswith('QUIT'):
+                sock.sendall('201 Closing connection.\r\n')
+                sock.close()
+                return
+            if line.startswith('QUER'):
+                sock.sendall(self.reply)
+            else:
+                sock.sendall('210 Ok.\r\n')
+
+
+def time_query(port, use_recv_reader, parse, repeat):
+    """ Return (best time, result) of repeat QUERs over one connection. """
+    gnats.recv_reader = use_recv_reader
+    conn = Server('127.0.0.1', port).get_connection()
+    best = None
+    for __ in range(repeat):
+        start = time.time()
+        result = conn.command('QUER', parse)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    conn.close()
+    return best, result
+
+
+def bench_reader(megabytes=8, repeat=3):
+    """ socket.makefile() readline path vs. the recv_into() _SocketReader. """
+    reply, count = synthetic_reply(megabytes)
+    gnatsd = FakeGnatsd(reply)
+    gnatsd.start()
+    size = len(reply) / (1024.0 * 1024)
+    print "QUER reply of %.1f MB, %d records, best of %d" % (size, count,
+                                                             repeat)
+    saved = gnats.recv_reader
+    try:
+        for parse in (True, False):
+            old, old_result = time_query(gnatsd.port, False, parse, repeat)
+            new, new_result = time_query(gnatsd.port, True, parse, repeat)
+            if old_result != new_result:
+                print "  MISMATCH between makefile and recv_into output!"
+            print "  parse=%-5s  makefile: %.3fs (%.1f MB/s)  " \
+                  "recv_into: %.3fs (%.1f MB/s)  speedup %.2fx" % \
+                  (parse, old, size / old, new, size / new, old / new)
+    finally:
+        gnats.recv_reader = saved
+
+
+class OldDelimitedData(object):
+    """ The record parser that server.Row replaced, for comparison. """
+
+    _record_separator = codes.RECORD_SEP + '\r\n'
+    _rs_len = len(_record_separator)
+
+    def __init__(self):
+        self.records = []
+        self._buffer = []
+
+    def append(self, value=''):
+        start = 0
+        while 1:
+            index = value.find(self._record_separator, start)
+            if index > -1:
+                self._buffer.append(value[start:index])
+                raw = ''.join(self._buffer)
+                self.records.append(raw.split(codes.FIELD_SEP))
+                self._buffer = []
+                if len(value) > (index + self._rs_len):
+                    start = index + self._rs_len
+                else:
+                    break
+            else:
+                self._buffer.append(value[start:])
+                break
+
+def old_records(data):
+    """ Parse as _read_server_block() did before server.Row: decode the
+    whole reply, then split it into lists of unicode fields. """
+    output = OldDelimitedData()
+    output.append(unicode(data, gnats.ENCODING))
+    return output.records
+
+def rows_size(rows, data=None):
+    """ Rough bytes held by parsed rows (and the reply buffer they share). """
+    size = sys.getsizeof(rows)
+    if data is not None:
+        size += sys.getsizeof(data)
+    for row in rows:
+        size += sys.getsizeof(row)
+        fields = isinstance(row, list) and row or row._fields
+        if fields is not None:
+            size += sys.getsizeof(fields)
+            size += sum([sys.getsizeof(field) for field in fields])
+    return size
+
+def bench_rows(megabytes=8, repeat=3):
+    """ Old eager parsing vs. lazy server.Row parsing of a QUER reply,
+    reading no fields, one field per row, and every field. """
+    reply = synthetic_reply(megabytes)[0]
+    # The record data, as _read_server_block() has it
+    data = reply[reply.index('\n') + 1:-3]
+    def first_field(rows):
+        for row in rows:
+            row[0]
+    def all_fields(rows):
+        for row in rows:
+            for field in row:
+                pass
+    print "Parsing %d MB of records, best of %d" % (megabytes, repeat)
+    for name, touch in (('no fields', None), ('one field', first_field),
+                        ('all fields', all_fields)):
+        results = []
+        for parse in (old_records, server._split_records):
+            best = None
+            for __ in range(repeat):
+                start = time.time()
+                rows = parse(data)
+                if touch is not None:
+                    touch(rows)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            if parse is old_records:
+                size = rows_size(rows)
+            else:
+                size = rows_size(rows, data)
+            results.append((best, size / (1024.0 * 1024)))
+            rows = None
+        (old, old_mb), (new, new_mb) = results
+        print "  %-10s  old: %.3fs %.0f MB  lazy: %.3fs %.0f MB  " \
+              "speedup %.2fx" % (name, old, old_mb, new, new_mb, old / new)
+
+
+def old_sort(dbh, field_names, rows, sort):
+    """ Sort as DatabaseHandle.query() did before database._SortPlan:
+    decorate with negated numbers for descending enum and integer fields, and
+    use an eval()'d comparison function if there are other descending
+    fields.  Enum values are ranked in a copy of the field's values with
+    the result values added, rather than in the field itself. """
+    fields = dbh.database.fields
+    mysort = []
+    sort_fast = True
+    for fname, direct in sort:
+        fld = fields[fname]
+        mysort.append((fld, direct, field_names.index(fname), fld.sorting))
+        if direct != 'asc' and fld.sorting not in ('enum', 'integer'):
+            sort_fast = False
+    sort_keys = {}
+    for fld, direct, index, sort_type in mysort:
+        if sort_type == 'enum':
+            values = list(fld.values) + [row[index] for row in rows]
+            values.sort()
+            sort_keys[index] = dict(zip(values, xrange(len(values))))
+    dsu_rows = []
+    for row in rows:
+        dsu_ent = []
+        for fld, direct, index, sort_type in mysort:
+            if sort_type in ('integer', 'enum'):
+                if fld == dbh.database.number_field:
+                    val = dbh._prnum_to_sortable(row[index])
+                elif sort_type == 'enum':
+                    val = sort_keys[index].get(row[index], -1)
+                else:
+                    val = int(row[index])
+                if direct == 'desc':
+                    val = 0 - val
+            elif sort_type == 'numeric':
+                val = dbh._numeric_sortable(row[index])
+            else:
+                val = row[index]
+            dsu_ent.append(val)
+        dsu_rows.append((tuple(dsu_ent), row))
+    if sort_fast:
+        dsu_rows.sort()
+    else:
+        func_parts = []
+        for num, (fld, direct, index, sort_type) in enumerate(mysort):
+            if sort_type in ('enum', 'integer') or direct == 'asc':
+                higher, lower = 1, 2
+            else:
+                higher, lower = 2, 1
+            func_parts.append("cmp(row%s[0][%s], row%s[0][%s])" %
+                              (higher, num, lower, num))
+        dsu_rows.sort(cmp=eval("lambda row1, row2: " + " or ".join(func_parts)))
+    return [r for __, r in dsu_rows]
+
+def bench_sort(count=100000, repeat=3):
+    """ The old decorate-and-cmp sort vs. _SortPlan's key sorts, on count
+    rows of ['number', 'enum-fld', 'synopsis', 'last-modified']. """
+    from gnats.tests.database_tests import FakeServerConnectionForDB
+    srv = Server('somehost')
+    db = Database(srv, 'testdb', FakeServerConnectionForDB(srv))
+    dbh = db.get_handle('user', 'pass', FakeServerConnectionForDB(srv))
+    field_names = ['number', 'enum-fld', 'synopsis', 'last-modified']
+    rnd = random.Random(42)
+    enums = db.fields['enum-fld'].values + ['unknown']
+    rows = [[str(i + 1), rnd.choice(enums),
+             'Synopsis %d' % rnd.randint(0, count / 10),
+             '2008-%02d-%02d' % (rnd.randint(1, 12), rnd.randint(1, 28))]
+            for i in xrange(count)]
+    sorts = (
+        ('number desc', [('number', 'desc')]),
+        ('enum asc, number desc',
+         [('enum-fld', 'asc'), ('number', 'desc')]),
+        ('text desc, date asc',
+         [('synopsis', 'desc'), ('last-modified', 'asc')]),
+        ('date desc, enum asc, text desc, number asc',
+         [('last-modified', 'desc'), ('enum-fld', 'asc'),
+          ('synopsis', 'desc'), ('number', 'asc')]),
+        )
+    print "Sorting %d rows, best of %d" % (count, repeat)
+    for name, sort in sorts:
+        times = []
+        for sorter in (old_sort, None):
+            best = None
+            for __ in range(repeat):
+                start = time.time()
+                if sorter is None:
+                    database._SortPlan(dbh, field_names, sort).sort(
+                        list(rows))
+                else:
+                    sorter(dbh, field_names, rows, sort)
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            times.append(best)
+        old, new = times
+        print "  %-44s  old: %.3fs  keys: %.3fs  speedup %.2fx" % \
+              (name, old, new, old / new)
+
+
+def old_audit(path, prnums):
+    """ Read Audit-Trails and Change-Logs as DatabaseHandle did before
+    auditdb: a new connection for each PR, queries built with %, and every
+    value converted with unicode(str(val)). """
+    out = {}
+    for prnum in prnums:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        pr_out = {}
+        for name, query, fields in (
+                ('audit-trail', auditdb.SQLITE_AT_QUERY, codes.AT_FIELDS),
+                ('change-log', auditdb.SQLITE_CL_QUERY, codes.CL_FIELDS)):
+            rows = []
+            cursor.execute(query % prnum)
+            for result in cursor:
+                row = {}
+                for i, val in enumerate(result[1:]):
+                    if val is None:
+                        val = ''
+                    row[unicode(fields[i], 'iso-8859-1')] = \
+                        unicode(str(val), 'iso-8859-1')
+                rows.append(row)
+            pr_out[name] = rows
+        out[prnum] = pr_out
+        cursor.close()
+        conn.close()
+    return out
+
+def bench_audit(prs=2000, rows=10, repeat=3):
+    """ A connection and two queries per PR vs. AuditDB's pooled, chunked
+    bulk queries, reading the Audit-Trail and Change-Log of prs PRs with
+    rows rows in each. """
+    fd, path = tempfile.mkstemp(suffix='.sqlite')
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(path)
+        conn.executescript(auditdb.SQLITE_SCHEMA)
+        conn.executemany("INSERT INTO AUDIT_TRAIL VALUES (?, ?, ?, ?, ?)",
+            [(pr, row, 'someuser', '2009-01-01 10:00:00 -0800',
+              'State changed from open to analyzed')
+             for pr in xrange(1, prs + 1) for row in xrange(rows)])
+        conn.executemany("INSERT INTO CHANGE_LOG VALUES "
+                         "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(pr, row, 'someuser', '2009-01-01 10:00:00 -0800', 'state',
+              'open', 'analyzed', 'looked at it', '1')
+             for pr in xrange(1, prs + 1) for row in xrange(rows)])
+        conn.commit()
+        conn.close()
+        prnums = [str(pr) for pr in xrange(1, prs + 1)]
+        adb = auditdb.sqlite_audit_db(path)
+        print "Audit-Trail and Change-Log of %d PRs, %d rows each, " \
+              "best of %d" % (prs, rows, repeat)
+        for name, read in (('one PR', lambda prnums: prnums[:1]),
+                           ('all PRs', lambda prnums: prnums)):
+            times = []
+            for get in (lambda prnums: old_audit(path, prnums), adb.get):
+                best = None
+                for __ in range(repeat):
+                    start = time.time()
+                    get(read(prnums))
+                    elapsed = time.time() - start
+                    if best is None or elapsed < best:
+                        best = elapsed
+                times.append(best)
+            old, new = times
+            print "  %-8s  old: %.4fs  AuditDB: %.4fs  speedup %.2fx" % \
+                  (name, old, new, old / new)
+        adb.close()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        mb = int(sys.argv[1])
+    else:
+        mb = 8
+    bench_reader(mb)
+    bench_rows(mb)
+    bench_sort()
+    bench_audit()
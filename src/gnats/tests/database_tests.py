@@ -7,7 +7,9 @@ Dirk Bergstrom, dirk@juniper.net, 2008-04-24
 Copyright (c) 2008, Juniper Networks, Inc.
 All rights reserved.
 """
+import time
 import unittest
+import threading
 
 # Shut up logging during the tests
 import logging
@@ -15,13 +17,55 @@ logging.disable(logging.FATAL)
 
 import gnats
 from gnats import Database, DatabaseHandle, GnatsException
-from gnats.database import Field, EnumField
+from gnats.database import Field, EnumField, MetadataRefresher
+
+class FakePipeline(object):
+    """ Pipeline that records the commands queued on it, and calls the
+    (possibly replaced) protocol methods of the fake connection for them when
+    executed. """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self.calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self, raise_errors=True):
+        calls = self.calls
+        self.calls = []
+        self.conn.pipelined.append([name for name, __, __ in calls])
+        replies = []
+        for name, args, kwargs in calls:
+            try:
+                replies.append(getattr(self.conn, name)(*args, **kwargs))
+            except gnats.GnatsException, err:
+                if raise_errors:
+                    raise
+                replies.append(err)
+        return replies
+
 
 class FakeServerConnectionForDB(object):
     """ Passed to Database's constructor to get a db object for testing. """
 
     def __init__(self, server):
         self.server = server
+        # Enum values are read on first use, through a connection from the
+        # server's pool; have the pool hand out this connection.
+        server.get_connection = lambda conn=None: self
+        self.broken = False
+        self.chdb_state = None
+        self.access_level = None
+        self._stream = None
+        # Names of the commands of each executed pipeline
+        self.pipelined = []
         self._ftyp_out = [
              'Integer Text Text Text Multitext Date'.split(),
              'Integer Text Enum Enum MultiEnum Multitext Table Date'.split(),]
@@ -70,8 +114,16 @@ Change-Log field
 Last-Modified field""".split('\n'),]
 
     def chdb(self, db, user='', passwd='', userpass=None):
+        self.chdb_state = (db, user, passwd)
+        self.access_level = 'edit'
         return 'edit'
 
+    def rset(self):
+        return 'Ok.'
+
+    def pipeline(self):
+        return FakePipeline(self)
+
     def dbdesc(self, dbname): #IGNORE:E0202
         return "Fake Database"
 
@@ -79,7 +131,11 @@ Last-Modified field""".split('\n'),]
                  'Multitext-fld Change-Log Last-Modified'
     _lists = {
               'fieldnames':FIELDNAMES.split(),
-              'initialinputfields':'Synopsis Enum-fld Multitext-fld'.split()
+              'initialinputfields':'Synopsis Enum-fld Multitext-fld'.split(),
+              'axisnames':['Identifier'],
+              'builtinfields':['number:Number', 'synopsis:Synopsis',
+                               'last-modified:Last-Modified',
+                               'audit-trail.info:Audit-Trail.Info'],
               }
     def list(self, list_type):
         return list(self._lists[list_type])
@@ -362,6 +418,50 @@ class T03_EnumField(unittest.TestCase):
         enum.load_enum_values(self.conn)
         self.assertEqual(len(enum.values), 4)
 
+    def record_fvld(self):
+        """ Get a fresh conn that counts the FVLD commands sent, slowly. """
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.fvlds = []
+        fvld = self.conn.fvld
+        def slow_fvld(name, *subfield_args):
+            self.fvlds.append(name)
+            time.sleep(0.01)
+            return fvld(name, *subfield_args)
+        self.conn.fvld = slow_fvld
+
+    def test_08_lazy(self):
+        """ Values are read on first use, once """
+        self.record_fvld()
+        db = Database(self.server, 'testdb', self.conn)
+        self.assertEqual(self.fvlds, [])
+        enum = db.fields['enum-fld']
+        self.assertEqual(enum.values, ['cat1', 'cat2', 'cat3', 'cat4'])
+        self.assertEqual(enum.values_dict['cat2']['category'], 'cat2')
+        self.assertEqual(self.fvlds, ['enum-fld'])
+
+    def test_09_lazy_pool(self):
+        """ Lazy loading borrows a metadata connection from the pool """
+        self.conn = FakeServerConnectionForDB(self.server)
+        db = Database(self.server, 'testdb', self.conn)
+        self.assertEqual(db.fields['multienum-fld'].default_separator, ':')
+        self.assertEqual(self.conn.chdb_state, ('testdb', 'gnatatui', '*'))
+        self.assertEqual(len(self.server.pool._idle), 1)
+
+    def test_10_lazy_threads(self):
+        """ Threads asking at the same time load the values once """
+        self.record_fvld()
+        db = Database(self.server, 'testdb', self.conn)
+        enum = db.fields['enum-fld']
+        lens = []
+        threads = [threading.Thread(target=lambda: lens.append(
+                       len(enum.values))) for __ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(lens, [4] * 5)
+        self.assertEqual(self.fvlds, ['enum-fld'])
+
 
 class T03a_TableField(unittest.TestCase):
     """ TableField tests """
@@ -1101,6 +1201,139 @@ class T08_MetadataLevels(unittest.TestCase):
         self.assertEqual(cb.dbin, None)
 
 
+class T09_MetadataRefresher(unittest.TestCase):
+    """ Background metadata refreshes """
+
+    def setUp(self):
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        # The pool hands out the newest fake conn
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.conn.cfgt = lambda: u'2000'
+        self.refresher = MetadataRefresher(self.db, 60)
+
+    def tearDown(self):
+        self.db.stop_refresher(5)
+
+    def test_01_refresh(self):
+        """ New metadata is swapped in when CFGT changes """
+        def cb(db):
+            cb.fields = db.fields
+        self.db.post_metadata_callback = cb
+        old_fields = self.db.fields
+        self.refresher.check()
+        self.assertEqual(self.db.last_config_time, u'2000')
+        self.assertFalse(self.db.fields is old_fields)
+        self.assertTrue(cb.fields is self.db.fields)
+        self.assertEqual((self.refresher.checks, self.refresher.refreshes),
+                         (1, 1))
+        self.assertEqual(len(self.server.pool._idle), 1)
+
+    def test_02_current(self):
+        """ Nothing happens when CFGT is unchanged """
+        self.conn.cfgt = lambda: u'1000'
+        old_fields = self.db.fields
+        self.refresher.check()
+        self.assertTrue(self.db.fields is old_fields)
+        self.assertEqual((self.refresher.checks, self.refresher.refreshes),
+                         (1, 0))
+
+    def test_03_error(self):
+        """ Errors are kept, and leave the old metadata in place """
+        def gm(conn):
+            raise GnatsException('boo')
+        self.db._get_metadata = gm
+        old_fields = self.db.fields
+        self.refresher.check()
+        self.assertTrue(isinstance(self.refresher.last_error, GnatsException))
+        self.assertTrue(self.db.fields is old_fields)
+        self.assertEqual(self.refresher.refreshes, 0)
+
+    def test_04_thread(self):
+        """ start_refresher() runs checks until stopped """
+        refresher = self.db.start_refresher(0.01)
+        self.assertTrue(self.db.start_refresher(0.01) is refresher)
+        for __ in range(200):
+            if refresher.refreshes:
+                break
+            time.sleep(0.01)
+        self.db.stop_refresher(5)
+        self.assertEqual(refresher.refreshes, 1)
+        self.assertFalse(refresher.isAlive())
+        self.assertEqual(self.db.refresher, None)
+
+    def test_05_get_handle(self):
+        """ get_handle() leaves checking to the refresher """
+        self.db.refresher = self.refresher
+        def cfgt():
+            raise AssertionError("CFGT sent")
+        self.conn.cfgt = cfgt
+        self.db.get_handle('user', 'pass', self.conn)
+
+
+class T10_Bootstrap(unittest.TestCase):
+    """ Pipelined metadata loading """
+
+    def setUp(self):
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+
+    def test_01_batches(self):
+        """ Field metadata is sent in three pipelined batches """
+        self.assertEqual(self.conn.pipelined,
+            [['ftyp', 'fieldflags', 'fdsc', 'inputdefault', 'list', 'list'],
+             ['ftypinfo'],
+             ['ftyp', 'fieldflags', 'fdsc', 'inputdefault']])
+
+    def test_02_same_fields(self):
+        """ The fields are the same as those loaded one command at a time """
+        prefetch = Database._prefetch_fields
+        Database._prefetch_fields = lambda self, conn, names: None
+        try:
+            conn = FakeServerConnectionForDB(self.server)
+            db = Database(self.server, 'testdb', conn)
+        finally:
+            Database._prefetch_fields = prefetch
+        self.assertEqual(conn.pipelined, [])
+        self.assertEqual([f.lcname for f in db.ordered_fields],
+                         [f.lcname for f in self.db.ordered_fields])
+        for old in db.ordered_fields:
+            new = self.db.fields[old.lcname]
+            self.assertEqual(new.__class__, old.__class__)
+            for attr in ('description', 'default', 'ftype', 'read_only',
+                         'required', 'multi_valued', 'initial', 'sorting'):
+                self.assertEqual(getattr(new, attr), getattr(old, attr),
+                                 "%s.%s" % (old.lcname, attr))
+        self.assertEqual(sorted(self.db.fields['change-log'].columns),
+                         sorted(db.fields['change-log'].columns))
+        self.assertEqual([f.lcname for f in self.db.initial_entry_fields],
+                         [f.lcname for f in db.initial_entry_fields])
+
+    def test_03_preload(self):
+        """ preload_enum_values() loads all values in two batches """
+        conn = FakeServerConnectionForDB(self.server)
+        self.db.preload_enum_values()
+        self.assertEqual(len(conn.pipelined), 2)
+        def fvld(*args):
+            raise AssertionError("FVLD sent")
+        conn.fvld = fvld
+        self.assertEqual(self.db.fields['enum-fld'].values,
+                         ['cat1', 'cat2', 'cat3', 'cat4'])
+        self.assertEqual(self.db.fields['multienum-fld'].default_separator,
+                         ':')
+        self.assertTrue(self.db.fields['scoped-enum-fld'].values)
+        self.assertEqual(len(self.server.pool._idle), 1)
+
+    def test_04_preload_loaded(self):
+        """ preload_enum_values() skips fields already loaded """
+        self.db.preload_enum_values()
+        conn = FakeServerConnectionForDB(self.server)
+        self.db.preload_enum_values()
+        self.assertEqual(conn.pipelined, [])
+
+
 classes = (
           T01_DatabaseMetadata,
           T02_FieldMetadata,
@@ -1111,6 +1344,8 @@ classes = (
           T06_Validate,
           T07_ValidatePR,
           T08_MetadataLevels,
+          T09_MetadataRefresher,
+          T10_Bootstrap,
           )
 
 if __name__ == '__main__':
@@ -7,6 +7,7 @@ Dirk Bergstrom, dirk@juniper.net, 2008-04-30
 Copyright (c) 2008, Juniper Networks, Inc.
 All rights reserved.
 """
+import os
 import unittest
 
 # Shut up logging during the tests
@@ -14,8 +15,9 @@ import logging
 logging.disable(logging.FATAL)
 
 import gnats
-from gnats import Database, DatabaseHandle, codes
+from gnats import Database, DatabaseHandle, codes, auditdb
 from gnats.tests.database_tests import FakeServerConnectionForDB
+from gnats.tests.auditdb_tests import make_audit_file, AT_ROWS, CL_ROWS
 
 class TestExc(Exception):
     pass
@@ -67,6 +69,54 @@ class T01_MetadataAndUtilityMethods(unittest.TestCase):
         self.assertEqual(self.dbh._numeric_sortable('fred'), 'fred')
 
 
+class T01a_PooledHandle(unittest.TestCase):
+    """ Handles borrowing their connection from the server's pool. """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.conn.rset = lambda: None
+        self.opened = 0
+        self.server.get_connection = self.fake_get_connection
+
+    def fake_get_connection(self, conn=None):
+        self.opened += 1
+        return self.conn
+
+    def test_01_borrows(self):
+        """ A pooled handle gets a logged-in connection from the pool """
+        dbh = self.db.get_handle('user', 'pass', pooled=True)
+        self.assertEqual(dbh.conn, self.conn)
+        self.assertEqual(dbh.access_level, 'edit')
+        self.assertEqual(self.conn.chdb_state, ('testdb', 'user', 'pass'))
+        self.assertEqual(self.server.pool._idle, [])
+
+    def test_02_close_returns(self):
+        """ close() gives the connection back, once """
+        dbh = self.db.get_handle('user', 'pass', pooled=True)
+        dbh.close()
+        dbh.close()
+        self.assertEqual(dbh.conn, None)
+        self.assertEqual(len(self.server.pool._idle), 1)
+
+    def test_03_with(self):
+        """ A pooled handle is closed at the end of a with block """
+        dbh = self.db.get_handle('user', 'pass', pooled=True)
+        dbh.__enter__()
+        dbh.__exit__(None, None, None)
+        dbh2 = self.db.get_handle('user', 'pass', pooled=True)
+        self.assertEqual(dbh2.conn, self.conn)
+        self.assertEqual(self.opened, 1)
+
+    def test_04_unpooled_close(self):
+        """ close() leaves the connection of other handles alone """
+        dbh = self.db.get_handle('user', 'pass', self.conn)
+        dbh.close()
+        self.assertEqual(dbh.conn, self.conn)
+
+
 class T02_Query(unittest.TestCase):
     """ query() method. """
 
@@ -76,6 +126,8 @@ class T02_Query(unittest.TestCase):
         self.conn = FakeServerConnectionForDB(self.server)
         self.db = Database(self.server, 'testdb', self.conn)
         self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        # Leave out the metadata commands
+        self.conn.pipelined = []
         self.conn.rset = self.my_rset
         self.rset_called = False
         self.conn.expr = self.my_expr
@@ -361,6 +413,214 @@ class T02_Query(unittest.TestCase):
         self.assertEquals(self.qfmt, 'fred')
         self.assertEquals(self.tqfmt, 'fred')
 
+    def test_29_pipelines_setup(self):
+        """ Setup commands are pipelined, QUER is sent after EXPR succeeds """
+        self.dbh.query('expr', ['synopsis'])
+        self.assertEquals(self.conn.pipelined, [['rset', 'qfmt', 'expr']])
+        self.assertTrue(self.parse)
+
+    def test_30_pipelines_quer_without_expr(self):
+        """ QUER goes in the same batch when there is no expression """
+        self.quer_out = [['1', 'foo']]
+        self.assertEquals(self.dbh.query('', ['number', 'synopsis'],
+                                         pr_list=['1']), [['1', 'foo']])
+        self.assertEquals(self.conn.pipelined, [['rset', 'qfmt', 'quer']])
+        self.assertTrue(self.parse)
+
+    def test_31_sort_enum_unknown_values(self):
+        """ Enum values not in the dbconfig sort first, alphabetically, and
+        the field's values are left alone """
+        self.quer_out = [['1', 'cat2'], ['2', 'zzz'], ['3', 'aaa'],
+                         ['4', 'cat1']]
+        values = list(self.db.fields['enum-fld'].values)
+        res = self.dbh.query('expr', ['number', 'enum-fld'],
+                             sort=(('enum-fld', 'asc'),))
+        self.assertEquals([r[0] for r in res], ['3', '2', '4', '1'])
+        self.assertEquals(self.db.fields['enum-fld'].values, values)
+        self.assertEquals(len(self.quer_out), 4)
+        self.assertEquals(self.quer_out[0], ['1', 'cat2'])
+
+    def test_32_sort_mixed_directions(self):
+        """ Runs of ascending and descending fields """
+        self.quer_out = [['1', 'a', 'x', '2008'], ['2', 'a', 'y', '2007'],
+                         ['3', 'b', 'x', '2007'], ['4', 'a', 'x', '2007'],
+                         ['5', 'b', 'x', '2008']]
+        res = self.dbh.query('expr',
+            ['number', 'synopsis', 'multitext-fld', 'last-modified'],
+            sort=(('synopsis', 'desc'), ('multitext-fld', 'asc'),
+                  ('last-modified', 'asc'), ('number', 'desc')))
+        self.assertEquals([r[0] for r in res], ['3', '5', '4', '1', '2'])
+
+
+class T02a_IterQuery(unittest.TestCase):
+    """ iter_query() and query_batches() methods. """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.calls = []
+        self.conn.rset = lambda: self.calls.append('RSET')
+        self.conn.qfmt = lambda format: self.calls.append('QFMT')
+        self.conn.tqfmt = lambda field_name, format: self.calls.append('TQFMT')
+        self.conn.expr = lambda expr: self.calls.append('EXPR %s' % expr)
+        self.conn.quer_iter = self.my_quer_iter
+        self.prs = None
+        self.quer_out = []
+
+    def my_quer_iter(self, prs=''):
+        self.calls.append('QUER')
+        self.prs = prs
+        return iter(self.quer_out)
+
+    # ['number', 'synopsis']
+    results = [['1', 'foo1'], ['4', 'foo2'], ['6', 'foo3'], ['2', 'foo4']]
+
+    def test_01_raises_empty_expr(self):
+        """ Raises on empty expr """
+        self.assertRaises(gnats.GnatsException, self.dbh.iter_query, '',
+                          ['number'])
+
+    def test_02_raises_no_fields(self):
+        """ Raises on empty field list """
+        self.assertRaises(gnats.GnatsException, self.dbh.iter_query, 'x', [])
+
+    def test_03_sets_up_query(self):
+        """ Sends RSET, QFMT, EXPR and QUER before iterating """
+        self.dbh.iter_query('field="value"', 'synopsis', pr_list=['12'])
+        self.assertEquals(self.calls,
+                          ['RSET', 'QFMT', 'EXPR field="value"', 'QUER'])
+        self.assertEquals(self.prs, ['12'])
+
+    def test_04_server_order(self):
+        """ Rows come in gnatsd-natural order """
+        self.quer_out = self.results
+        res = self.dbh.iter_query('expr', ['number', 'synopsis'])
+        self.assertEquals([r[0] for r in res], ['1', '4', '6', '2'])
+
+    def test_05_table_cols_parsed(self):
+        """ Table-field values parsed with table_cols """
+        row = codes.COL_SEP.join(['1', 'a', 'b', 'me', '', 'now'])
+        self.quer_out = [['1', row + codes.ROW_SEP]]
+        res = list(self.dbh.iter_query('expr', ['number', 'change-log'],
+                                       table_cols="all"))
+        self.assertEquals(res, [['1', [['1', 'a', 'b', 'me', '', 'now']]]])
+        self.assertEquals(self.calls[:3], ['RSET', 'QFMT', 'TQFMT'])
+
+    def test_06_query_batches(self):
+        """ query_batches hands rows to the callback in batches """
+        self.quer_out = self.results
+        batches = []
+        count = self.dbh.query_batches('expr', ['number', 'synopsis'],
+                                       batches.append, batch_size=3)
+        self.assertEquals(count, 4)
+        self.assertEquals([[r[0] for r in b] for b in batches],
+                          [['1', '4', '6'], ['2']])
+
+    def test_07_query_batches_no_results(self):
+        """ query_batches doesn't call the callback without results """
+        batches = []
+        self.assertEquals(self.dbh.query_batches('expr', ['number'],
+                                                 batches.append), 0)
+        self.assertEquals(batches, [])
+
+
+class T02b_QueryWindow(unittest.TestCase):
+    """ query() with limit, offset and total. """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.conn.rset = lambda: 'Ok.'
+        self.conn.qfmt = lambda format: 'Ok.'
+        self.conn.tqfmt = lambda field_name, format: 'Ok.'
+        self.conn.expr = lambda expr: 'Ok.'
+        self.conn.quer = self.my_quer
+        self.conn.quer_iter = self.my_quer_iter
+        self.read = 0
+        # ['number', 'synopsis']
+        self.quer_out = [[str(i), 'foo%d' % (i % 7)] for i in range(1, 101)]
+
+    def my_quer(self, prs='', parse=False):
+        return list(self.quer_out)
+
+    def my_quer_iter(self, prs=''):
+        for row in self.quer_out:
+            self.read += 1
+            yield list(row)
+
+    def numbers(self, rows):
+        return [r[0] for r in rows]
+
+    def test_01_top_k(self):
+        """ A limit with sort gives the start of the sorted results """
+        sort = (('synopsis', 'desc'), ('number', 'asc'))
+        full = self.dbh.query('expr', ['number', 'synopsis'], sort=sort)
+        top = self.dbh.query('expr', ['number', 'synopsis'], sort=sort,
+                             limit=10)
+        self.assertEquals(top, full[:10])
+        self.assertEquals(self.read, 100)
+
+    def test_02_offset(self):
+        """ offset skips the first rows """
+        sort = (('number', 'desc'),)
+        page = self.dbh.query('expr', ['number', 'synopsis'], sort=sort,
+                              limit=5, offset=20)
+        self.assertEquals(self.numbers(page), ['80', '79', '78', '77', '76'])
+        page = self.dbh.query('expr', ['number', 'synopsis'], sort=sort,
+                              offset=98)
+        self.assertEquals(self.numbers(page), ['2', '1'])
+
+    def test_03_total(self):
+        """ total gives the number of matching rows too """
+        rows, count = self.dbh.query('expr', ['number', 'synopsis'],
+                                     sort=(('number', 'asc'),), limit=3,
+                                     total=True)
+        self.assertEquals((self.numbers(rows), count), (['1', '2', '3'], 100))
+        rows, count = self.dbh.query('expr', ['number'], limit=3,
+                                     offset=99, total=True)
+        self.assertEquals((self.numbers(rows), count), (['100'], 100))
+        self.assertEquals(self.dbh.query('expr', ['number'], total=True)[1],
+                          100)
+
+    def test_04_unsorted(self):
+        """ Without sort, rows after the window are not read """
+        rows = self.dbh.query('expr', ['number', 'synopsis'], limit=3,
+                              offset=2)
+        self.assertEquals(self.numbers(rows), ['3', '4', '5'])
+        self.assertEquals(self.read, 5)
+
+    def test_05_table_cols(self):
+        """ Table fields are parsed only for the rows returned """
+        parsed = []
+        self.dbh._parse_table_fields = \
+            lambda record, tf_indexes: parsed.append(record[0])
+        self.quer_out = [[str(i), ''] for i in range(1, 21)]
+        self.dbh.query('expr', ['number', 'change-log'], table_cols='all',
+                       sort=(('number', 'desc'),), limit=2)
+        self.assertEquals(parsed, ['20', '19'])
+
+    def test_06_bad_window(self):
+        """ Raises on a bad limit or offset """
+        self.assertRaises(gnats.GnatsException, self.dbh.query, 'expr',
+                          ['number'], limit=-1)
+        self.assertRaises(gnats.GnatsException, self.dbh.query, 'expr',
+                          ['number'], limit='10')
+        self.assertRaises(gnats.GnatsException, self.dbh.query, 'expr',
+                          ['number'], offset=-2)
+
+    def test_07_no_results(self):
+        """ No matches gives no rows and a total of 0 """
+        self.quer_out = []
+        self.assertEquals(self.dbh.query('expr', ['number'], limit=5,
+                                         sort=(('number', 'asc'),),
+                                         total=True), ([], 0))
+
 
 class T03_Get_pr(unittest.TestCase):
     """ get_pr() and related methods. """
@@ -371,6 +631,8 @@ class T03_Get_pr(unittest.TestCase):
         self.conn = FakeServerConnectionForDB(self.server)
         self.db = Database(self.server, 'testdb', self.conn)
         self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        # Leave out the metadata commands
+        self.conn.pipelined = []
         self.conn.rset = self.my_rset
         self.rset_called = False
         self.conn.qfmt = self.my_qfmt
@@ -388,6 +650,7 @@ class T03_Get_pr(unittest.TestCase):
         self.table_cols = []
         self.dbh.old_get_pr_fields = self.dbh._get_pr_fields
         self.dbh._get_pr_fields = self.my_get_pr_fields
+        self.dbh._get_pr_fields_batch = self.my_get_pr_fields_batch
         self.vtc_cols = ''
         self.vtc_fnames = ''
         self.vtc_out = ''
@@ -423,6 +686,9 @@ class T03_Get_pr(unittest.TestCase):
         self.table_cols.append(table_cols)
         return self.pr_fields.pop()
 
+    def my_get_pr_fields_batch(self, fetches):
+        return [self.my_get_pr_fields(*fetch) for fetch in fetches]
+
     def my_validate_table_columns(self, table_cols, field_names=None):
         self.vtc_cols = table_cols
         self.vtc_fnames = field_names
@@ -456,6 +722,18 @@ class T03_Get_pr(unittest.TestCase):
         self.assertEqual(self.prnum, '100')
         self.assertEqual(out, 'boo')
 
+    def test_01a_get_pr_fields_batch(self):
+        """ _get_pr_fields_batch() pipelines all fetches, returns the QUERs """
+        self.dbh._get_pr_fields_batch = self.dbh.__class__._get_pr_fields_batch.\
+            __get__(self.dbh)
+        out = self.dbh._get_pr_fields_batch([('100', ['synopsis'], None),
+                                              ('100', ['change-log'],
+                                               {'change-log': ['x']})])
+        self.assertEqual(out, ['boo', 'boo'])
+        self.assertEqual(self.conn.pipelined,
+                         [['rset', 'qfmt', 'quer', 'rset', 'qfmt', 'tqfmt',
+                           'quer']])
+
     def test_02_raises_no_prnum(self):
         """ Raises with no prnum """
         self.assertRaises(gnats.GnatsException, self.dbh.get_pr, '', ['foo'])
@@ -608,6 +886,138 @@ class T03_Get_pr(unittest.TestCase):
         self.assertEqual(self.table_cols, [{'change-log': ['x', 'y']}])
 
 
+class T03a_Get_prs(unittest.TestCase):
+    """ get_prs() """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.dbh._get_pr_fields_batch = self.my_get_pr_fields_batch
+        self.dbh._validate_table_columns = lambda table_cols, fnames: {}
+        self.fetches = []
+        self.pr_fields = []
+
+    def my_get_pr_fields_batch(self, fetches, missing_ok=False):
+        self.fetches.extend(fetches)
+        return [self.pr_fields.pop(0) for __ in fetches]
+
+    def my_quer(self, prs='', parse=False):
+        if '3' in prs:
+            raise gnats.GnatsException("No PR 3", '400')
+        rows = {'1': ['1', 'joe'], '2': ['2', 'ann']}
+        return [rows[prnum] for prnum in prs]
+
+    def test_01_groups_rows(self):
+        """ One QUER per axis, scope rows grouped back to their PRs """
+        self.pr_fields = [[['1', 'joe'], ['2', 'ann']],
+                          [['1', '1', 'fred'], ['2', '2', 'y'],
+                           ['2-1', '1', 'x']]]
+        self.assertEqual(self.dbh.get_prs(['1', '2'],
+                                          ['synopsis', 'scoped-enum-fld']),
+            {'1': {'synopsis': 'joe',
+                   'identifier': [('1', {'scoped-enum-fld': 'fred',
+                                         'scope:identifier': '1'})]},
+             '2': {'synopsis': 'ann',
+                   'identifier': [('1', {'scoped-enum-fld': 'x',
+                                         'scope:identifier': '1'}),
+                                  ('2', {'scoped-enum-fld': 'y',
+                                         'scope:identifier': '2'})]}})
+        self.assertEqual(self.fetches,
+            [(['1', '2'], ['number', 'synopsis'], {}),
+             (['1', '2'], ['number', 'scope:identifier', 'scoped-enum-fld'],
+              None)])
+
+    def test_02_same_as_get_pr(self):
+        """ Each PR is what get_pr() would return """
+        self.pr_fields = [[['1', 'joe']], [['1', '1', 'fred']],
+                          [['joe']], [['1', 'fred']]]
+        prs = self.dbh.get_prs([1], ['synopsis', 'scoped-enum-fld'])
+        self.assertEqual(prs['1'],
+                         self.dbh.get_pr('1', ['synopsis', 'scoped-enum-fld']))
+
+    def test_03_missing_and_duplicates(self):
+        """ Scoped and repeated numbers are fetched once, missing PRs are
+        left out """
+        self.pr_fields = [[['2', 'ann']]]
+        self.assertEqual(self.dbh.get_prs(['1-2', 2, '1', '3'], ['synopsis']),
+                         {'2': {'synopsis': 'ann'}})
+        self.assertEqual(self.fetches[0][0], ['1', '2', '3'])
+
+    def test_03a_nonexistent(self):
+        """ A chunk whose QUER fails on a nonexistent PR is fetched again one
+        PR at a time """
+        self.dbh._get_pr_fields_batch = \
+            self.dbh.__class__._get_pr_fields_batch.__get__(self.dbh)
+        self.conn.rset = lambda: 'Ok.'
+        self.conn.qfmt = lambda format: 'Ok.'
+        self.conn.quer = self.my_quer
+        self.dbh.GET_PRS_CHUNK = 2
+        self.assertEqual(self.dbh.get_prs(['1', '3', '2'], ['synopsis']),
+                         {'1': {'synopsis': 'joe'}, '2': {'synopsis': 'ann'}})
+        self.assertEqual(self.conn.pipelined[-2:],
+                         [['rset', 'qfmt', 'quer', 'rset', 'qfmt', 'quer'],
+                          ['rset', 'qfmt', 'quer', 'rset', 'qfmt', 'quer']])
+
+    def test_03b_other_errors(self):
+        """ Other QUER errors are raised """
+        self.dbh._get_pr_fields_batch = \
+            self.dbh.__class__._get_pr_fields_batch.__get__(self.dbh)
+        self.conn.rset = lambda: 'Ok.'
+        self.conn.qfmt = lambda format: 'Ok.'
+        def quer(prs='', parse=False):
+            raise gnats.GnatsException("Invalid query format", '418')
+        self.conn.quer = quer
+        self.assertRaises(gnats.GnatsException, self.dbh.get_prs, ['1'],
+                          ['synopsis'])
+
+    def test_04_no_matches(self):
+        """ No PRs found """
+        self.pr_fields = [None, None]
+        self.assertEqual(self.dbh.get_prs(['1'], ['scoped-enum-fld']), {})
+
+    def test_05_chunks(self):
+        """ Long PR lists are split over several QUERs """
+        self.dbh.GET_PRS_CHUNK = 2
+        self.pr_fields = [[['1', 'a'], ['2', 'b']], [['3', 'c']]]
+        prs = self.dbh.get_prs(['1', '2', '3'], ['synopsis'])
+        self.assertEqual(sorted(prs), ['1', '2', '3'])
+        self.assertEqual([fetch[0] for fetch in self.fetches],
+                         [['1', '2'], ['3']])
+
+    def test_06_bad_prnums(self):
+        """ Empty list fetches nothing, bad numbers raise """
+        self.assertEqual(self.dbh.get_prs([], ['synopsis']), {})
+        self.assertEqual(self.fetches, [])
+        self.assertRaises(gnats.GnatsException, self.dbh.get_prs,
+                          ['1', '1 OR 1=1'], ['synopsis'])
+
+    def test_07_bulk_audit_trail(self):
+        """ Audit-Trail and Change-Log of many PRs from the audit_db """
+        path = make_audit_file(AT_ROWS, CL_ROWS)
+        try:
+            adb = self.db.enable_audit_db(
+                auditdb.sqlite_audit_db(path, in_limit=2))
+            out = self.dbh._get_change_logs_audit_trails(['1', '2', '3'])
+            adb.close()
+        finally:
+            os.remove(path)
+        self.assertEqual((adb.connections, adb.queries), (1, 4))
+        self.assertEqual(len(out['1']['audit-trail']), 2)
+        self.assertEqual(out['2']['change-log'][0][u'to'], u'closed')
+        self.assertEqual(out['3'], {'audit-trail': [], 'change-log': []})
+
+    def test_08_audit_trail_error(self):
+        """ Audit-Trail and Change-Log are empty if they can't be read """
+        def connect():
+            raise TestExc("no database")
+        self.db.enable_audit_db(auditdb.AuditDB(connect))
+        self.assertEqual(self.dbh._get_change_log_audit_trail('1'),
+                         {'audit-trail': {}, 'change-log': {}})
+
+
 class T04_Edit_pr(unittest.TestCase):
     """ edit_pr() """
 
@@ -789,6 +1199,288 @@ class T04_Edit_pr(unittest.TestCase):
         self.assertEqual(self.unp_in['synopsis'], 'boo')
 
 
+class T04a_Edit_pr_delta(unittest.TestCase):
+    """ edit_pr_delta() """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.calls = []
+        self.conn.editaddr = lambda addr: self.calls.append(('EDITADDR', addr))
+        self.conn.lockn = lambda prnum, user, pid, sess: \
+            self.calls.append(('LOCKN', prnum, user, sess))
+        self.conn.unlk = lambda prnum: self.calls.append(('UNLK', prnum))
+        self.conn.repl = lambda prnum, fname, value, scope, sess: \
+            self.calls.append(('REPL', prnum, fname, value, scope))
+        self.conn.appn = lambda prnum, fname, value, scope, sess: \
+            self.calls.append(('APPN', prnum, fname, value, scope))
+        self.conn.tappn = lambda prnum, fname, value_dict, sess: \
+            self.calls.append(('TAPPN', prnum, fname, value_dict))
+        self.dbh.edit_pr = self.my_edit_pr
+        self.dbh.get_pr = self.my_get_pr
+        self.edited = None
+        self.fetched = []
+        self.baseline = {'synopsis': 'foo bar',
+                         'enum-fld': 'cat1',
+                         'multienum-fld': 'product1',
+                         'multitext-fld': 'line 1\n',
+                         'last-modified': '2009-01-01',
+                         'identifier': [('1', {'scoped-enum-fld': 'open'})]}
+
+    def my_edit_pr(self, prnum, pr, user_address):
+        self.calls.append(('EDIT', prnum))
+        self.edited = (prnum, pr)
+
+    def my_get_pr(self, prnum, field_names='all'):
+        self.fetched.append(field_names)
+        return {'last-modified': '2009-01-01'}
+
+    def edits(self):
+        return [call for call in self.calls
+                if call[0] in ('REPL', 'APPN', 'TAPPN')]
+
+    def test_01_changed_only(self):
+        """ Only fields differing from the baseline are replaced """
+        pr = dict(self.baseline)
+        pr['synopsis'] = 'new'
+        pr['multienum-fld'] = ['product1', 'product2']
+        self.assertEqual(self.dbh.edit_pr_delta('12-1', pr, 'me',
+                                                self.baseline),
+                         [('REPL', 'synopsis'), ('REPL', 'multienum-fld')])
+        self.assertEqual(self.edits(),
+            [('REPL', '12', 'synopsis', 'new', ''),
+             ('REPL', '12', 'multienum-fld', 'product1:product2', '')])
+        self.assertEqual(self.calls[0], ('EDITADDR', 'me'))
+        self.assertEqual(self.calls[1][:3], ('LOCKN', '12', 'user'))
+        self.assertEqual(self.calls[-1], ('UNLK', '12'))
+        self.assertEqual(self.fetched, [['last-modified']])
+
+    def test_02_append_multitext(self):
+        """ Text added to the end of a multitext field is appended """
+        pr = {'multitext-fld': 'line 1\nline 2\n'}
+        self.dbh.edit_pr_delta('12', pr, 'me', self.baseline)
+        self.assertEqual(self.edits(),
+                         [('APPN', '12', 'multitext-fld', 'line 2\n', '')])
+
+    def test_03_no_baseline(self):
+        """ Without a baseline, every field given is sent """
+        self.dbh.edit_pr_delta('12', {'synopsis': 'foo bar'}, 'me')
+        self.assertEqual(self.edits(),
+                         [('REPL', '12', 'synopsis', 'foo bar', '')])
+        self.assertEqual(self.fetched, [])
+
+    def test_04_last_modified(self):
+        """ Raises if the PR changed since the baseline, and unlocks """
+        pr = {'synopsis': 'new', 'last-modified': '2008-12-31'}
+        self.assertRaises(gnats.LastModifiedTimeException,
+                          self.dbh.edit_pr_delta, '12', pr, 'me')
+        self.assertEqual(self.edits(), [])
+        self.assertEqual(self.calls[-1], ('UNLK', '12'))
+
+    def test_05_unlocks_on_error(self):
+        """ The PR is unlocked if an edit fails """
+        def repl(*args):
+            raise gnats.GnatsException("bad value")
+        self.conn.repl = repl
+        self.assertRaises(gnats.GnatsException, self.dbh.edit_pr_delta, '12',
+                          {'synopsis': 'new'}, 'me')
+        self.assertEqual(self.calls[-1], ('UNLK', '12'))
+
+    def test_06_nothing_changed(self):
+        """ No commands if nothing changed """
+        self.assertEqual(self.dbh.edit_pr_delta('12', dict(self.baseline),
+                                                'me', self.baseline), [])
+        self.assertEqual(self.calls, [])
+
+    def test_07_change_reason_fallback(self):
+        """ Fields needing a change reason go through edit_pr() """
+        pr = {'enum-fld': 'cat2', 'enum-fld-changed-why': 'because'}
+        self.assertEqual(self.dbh.edit_pr_delta('12', pr, 'me',
+                                                self.baseline),
+                         [('EDIT', None)])
+        self.assertEqual(self.edited, ('12', pr))
+        self.assertEqual([call[:2] for call in self.calls],
+                         [('EDITADDR', 'me'), ('LOCKN', '12'), ('EDIT', '12'),
+                          ('UNLK', '12')])
+        self.assertEqual(self.fetched, [['last-modified']])
+
+    def test_07a_fallback_last_modified(self):
+        """ The fallback checks last-modified, and unlocks """
+        pr = {'enum-fld': 'cat2', 'enum-fld-changed-why': 'because',
+              'last-modified': '2008-12-31'}
+        self.assertRaises(gnats.LastModifiedTimeException,
+                          self.dbh.edit_pr_delta, '12', pr, 'me')
+        self.assertEqual(self.edited, None)
+        self.assertEqual(self.calls[-1], ('UNLK', '12'))
+
+    def test_08_envelope_fallback(self):
+        """ Envelope changes go through edit_pr() """
+        self.dbh.edit_pr_delta('12', {'from:': 'x@y'}, 'me', self.baseline)
+        self.assertEqual(self.edited, ('12', {'from:': 'x@y'}))
+
+    def test_09_table_rows(self):
+        """ Rows added to a table field are appended """
+        fld = self.db.fields['change-log']
+        fld._really_read_only = False
+        self.baseline['change-log'] = [{'row-id': '1', 'field': 'a'}]
+        pr = {'synopsis': 'foo bar',
+              'change-log': [{'row-id': '1', 'field': 'a'}, {'field': 'b'}]}
+        self.dbh.edit_pr_delta('12', pr, 'me', self.baseline)
+        self.assertEqual(self.edits(),
+                         [('TAPPN', '12', 'change-log', {'field': 'b'})])
+
+    def test_10_scoped(self):
+        """ Scoped fields are replaced in their scope; new scopes fall
+        back """
+        axis = self.db.fields['scoped-enum-fld'].axis
+        self.baseline[axis] = self.baseline.pop('identifier')
+        self.db.fields['scoped-enum-fld'].require_change_reason = False
+        self.dbh.edit_pr_delta('12', {axis: [('1', {'scoped-enum-fld':
+                                                    'closed'})]},
+                               'me', self.baseline)
+        self.assertEqual(self.edits(),
+                         [('REPL', '12', 'scoped-enum-fld', 'closed', '1')])
+        self.assertEqual(self.edited, None)
+        self.dbh.edit_pr_delta('12', {axis: [('2', {'scoped-enum-fld':
+                                                    'open'})]},
+                               'me', self.baseline)
+        self.assertEqual(self.edited[0], '12')
+
+
+class FakeSocket(object):
+    def close(self):
+        pass
+
+
+class T04b_Bulk_edit(unittest.TestCase):
+    """ Database.bulk_edit() """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.conn._sock = FakeSocket()
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.conn.pipelined = []
+        self.calls = []
+        self.conn.editaddr = lambda addr: self.calls.append(('EDITADDR', addr))
+        self.conn.lockn = self.my_lockn
+        self.conn.unlk = lambda prnum: self.calls.append(('UNLK', prnum))
+        self.conn.repl = self.my_repl
+        self.locked = []
+        self.bad_repl = None
+
+    def my_lockn(self, prnum, user, pid, sess):
+        if prnum == '2':
+            raise gnats.GnatsException("PR 2 is locked", '430')
+        self.calls.append(('LOCKN', prnum, user))
+
+    def my_repl(self, prnum, fname, value, scope, sess):
+        if prnum == self.bad_repl:
+            raise gnats.GnatsException("Invalid value")
+        self.calls.append(('REPL', prnum, fname, value))
+
+    def test_01_edits(self):
+        """ PRs are locked and unlocked a batch at a time """
+        results = self.db.bulk_edit('user', 'pass',
+                                    [('1', {'synopsis': 'one'}),
+                                     ('3-1', {'synopsis': 'three'}),
+                                     (4, {'synopsis': 'four'})],
+                                    'me', workers=1, batch_size=2)
+        self.assertEqual(results, [('1', None), ('3-1', None), (4, None)])
+        self.assertEqual(self.conn.pipelined,
+                         [['editaddr', 'lockn', 'lockn'], ['unlk', 'unlk'],
+                          ['editaddr', 'lockn'], ['unlk']])
+        self.assertEqual([c for c in self.calls if c[0] == 'REPL'],
+                         [('REPL', '1', 'synopsis', 'one'),
+                          ('REPL', '3', 'synopsis', 'three'),
+                          ('REPL', '4', 'synopsis', 'four')])
+        self.assertEqual(self.calls[:3], [('EDITADDR', 'me'),
+                                          ('LOCKN', '1', 'user'),
+                                          ('LOCKN', '3', 'user')])
+
+    def test_02_failures(self):
+        """ Failed PRs are reported without stopping the batch """
+        self.bad_repl = '3'
+        results = self.db.bulk_edit('user', 'pass',
+                                    [('1', {'synopsis': 'one'}),
+                                     ('2', {'synopsis': 'two'}),
+                                     ('3', {'synopsis': 'three'}),
+                                     ('4', {})],
+                                    'me', workers=1)
+        self.assertEqual(results[0], ('1', None))
+        self.assertEqual(results[1][1].message, "PR 2 is locked")
+        self.assertEqual(results[2][1].message, "Invalid value")
+        self.assertEqual(results[3][1].message, "No PR supplied for edit.")
+        self.assertEqual([c for c in self.calls if c[0] == 'UNLK'],
+                         [('UNLK', '1'), ('UNLK', '3')])
+
+    def test_03_fallback(self):
+        """ Changes needing a change reason are made with edit_pr() """
+        edited = []
+        def edit_pr(dbh, prnum, pr, user_address):
+            edited.append((prnum, pr))
+        orig = DatabaseHandle.edit_pr
+        DatabaseHandle.edit_pr = edit_pr
+        try:
+            changes = {'enum-fld': 'cat2', 'enum-fld-changed-why': 'moved'}
+            results = self.db.bulk_edit('user', 'pass', [('1', changes)],
+                                        'me')
+        finally:
+            DatabaseHandle.edit_pr = orig
+        self.assertEqual(results, [('1', None)])
+        self.assertEqual(edited, [('1', changes)])
+        self.assertEqual(self.calls, [('EDITADDR', 'me'),
+                                      ('LOCKN', '1', 'user'),
+                                      ('UNLK', '1')])
+
+    def test_04_network_error(self):
+        """ PRs locked on a failed connection are unlocked on another """
+        def repl(*args):
+            self.conn.broken = True
+            raise gnats.GnatsNetworkException("Connection reset")
+        self.conn.repl = repl
+        results = self.db.bulk_edit('user', 'pass',
+                                    [('1', {'synopsis': 'one'}),
+                                     ('3', {'synopsis': 'three'})], 'me')
+        self.assertEqual([r[1].message for r in results],
+                         ["Connection reset"] * 2)
+        self.assertEqual(self.conn.pipelined, [['editaddr', 'lockn', 'lockn']])
+        self.assertEqual(self.calls[-2:], [('UNLK', '1'), ('UNLK', '3')])
+
+    def test_05_workers(self):
+        """ Batches are shared out among threads """
+        edits = [(str(n), {'synopsis': 'x'}) for n in (1, 3, 4, 5, 6, 7)]
+        results = self.db.bulk_edit('user', 'pass', edits, 'me', workers=3,
+                                    batch_size=2)
+        self.assertEqual(results, [(prnum, None) for prnum, __ in edits])
+        self.assertEqual(sorted([c[1] for c in self.calls if c[0] == 'UNLK']),
+                         ['1', '3', '4', '5', '6', '7'])
+
+    def test_06_partial_network_error(self):
+        """ PRs edited before a connection fails aren't reported as failed """
+        def repl(prnum, *args):
+            if prnum == '3':
+                self.conn.broken = True
+                raise gnats.GnatsNetworkException("Connection reset")
+            self.calls.append(('REPL', prnum))
+        self.conn.repl = repl
+        results = self.db.bulk_edit('user', 'pass',
+                                    [('1', {'synopsis': 'one'}),
+                                     ('2', {'synopsis': 'two'}),
+                                     ('3', {'synopsis': 'three'}),
+                                     ('4', {'synopsis': 'four'})], 'me')
+        self.assertEqual(results[0], ('1', None))
+        self.assertEqual(results[1][1].message, "PR 2 is locked")
+        self.assertEqual([r[1].message for r in results[2:]],
+                         ["Connection reset"] * 2)
+        self.assertEqual(self.calls[-3:],
+                         [('UNLK', '1'), ('UNLK', '3'), ('UNLK', '4')])
+
+
 class T05_MiscEditMethods(unittest.TestCase):
     """ submit_pr, lock_pr, unlock_pr, append_to_field, replace_field, check_pr
     """
@@ -947,9 +1639,15 @@ class T05_MiscEditMethods(unittest.TestCase):
 
 classes = (
           T01_MetadataAndUtilityMethods,
+          T01a_PooledHandle,
           T02_Query,
+          T02a_IterQuery,
+          T02b_QueryWindow,
           T03_Get_pr,
+          T03a_Get_prs,
           T04_Edit_pr,
+          T04a_Edit_pr_delta,
+          T04b_Bulk_edit,
           T05_MiscEditMethods,
          )
 
@@ -0,0 +1,133 @@
+#!/usr/bin/python
+"""
+Unit tests for gnats metadata snapshots
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+# Shut up logging during the tests
+import logging
+logging.disable(logging.FATAL)
+
+import gnats
+from gnats import Database, metadata
+from gnats.tests.database_tests import FakeServerConnectionForDB
+
+class NoMetadataConn(FakeServerConnectionForDB):
+    """ Fails any metadata command other than CHDB and CFGT. """
+
+    def __getattribute__(self, name):
+        if name in ('list', 'ftyp', 'fieldflags', 'fdsc', 'inputdefault',
+                    'fvld', 'ftypinfo', 'dbdesc'):
+            raise AssertionError("%s sent" % name)
+        return FakeServerConnectionForDB.__getattribute__(self, name)
+
+
+class T01_Snapshot(unittest.TestCase):
+    """ Writing metadata snapshots and building Databases from them """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.dir = tempfile.mkdtemp()
+        gnats.metadata_snapshot_dir = self.dir
+        self.server = gnats.Server('somehost')
+        self.db = Database(self.server, 'testdb',
+                           FakeServerConnectionForDB(self.server))
+        self.path = metadata.snapshot_path(self.server, 'testdb')
+        metadata.write_snapshot(self.db, self.path)
+
+    def tearDown(self):
+        gnats.metadata_snapshot_dir = None
+        shutil.rmtree(self.dir)
+        unittest.TestCase.tearDown(self)
+
+    def load(self, conn=None):
+        return Database(self.server, 'testdb',
+                        conn or NoMetadataConn(self.server))
+
+    def test_01_path(self):
+        """ Snapshots are named by server and db """
+        self.assertEqual(self.path,
+                         os.path.join(self.dir, 'somehost_1529_testdb.sqlite'))
+        gnats.metadata_snapshot_dir = None
+        self.assertEqual(metadata.snapshot_path(self.server, 'testdb'), None)
+
+    def test_02_fields(self):
+        """ Fields read from the snapshot match those from gnatsd """
+        db = self.load()
+        self.assertEqual([f.lcname for f in db.ordered_fields],
+                         [f.lcname for f in self.db.ordered_fields])
+        for old in self.db.ordered_fields:
+            new = db.fields[old.lcname]
+            self.assertEqual(new.__class__, old.__class__)
+            for attr in ('name', 'description', 'default', 'ftype',
+                         'read_only', 'required', 'require_change_reason',
+                         'multi_valued', 'text_search', 'initial', 'sorting'):
+                self.assertEqual(getattr(new, attr), getattr(old, attr),
+                                 "%s.%s" % (old.lcname, attr))
+        self.assertEqual(db.description, self.db.description)
+        self.assertEqual(db.last_config_time, u'1000')
+
+    def test_03_enum_values(self):
+        """ Enum values are looked up in the snapshot """
+        db = self.load()
+        for name in ('enum-fld', 'multienum-fld', 'scoped-enum-fld'):
+            old = self.db.fields[name]
+            new = db.fields[name]
+            self.assertEqual(new.values, old.values)
+            self.assertEqual(new.values_dict, old.values_dict)
+            self.assertEqual(new.subfields, old.subfields)
+        self.assertEqual(db.fields['multienum-fld'].separators, ':|')
+        self.assertEqual(db.fields['multienum-fld'].default_separator, ':')
+
+    def test_04_table_and_builtins(self):
+        """ Table columns, builtins and initial fields """
+        db = self.load()
+        self.assertEqual(sorted(db.fields['change-log'].columns),
+                         sorted(self.db.fields['change-log'].columns))
+        self.assertEqual(db.builtin('number'), 'number')
+        self.assertEqual(db.builtin('synopsis'), self.db.builtin('synopsis'))
+        self.assertEqual([f.lcname for f in db.initial_entry_fields],
+                         [f.lcname for f in self.db.initial_entry_fields])
+
+    def test_05_stale(self):
+        """ A snapshot from another CFGT is ignored """
+        conn = FakeServerConnectionForDB(self.server)
+        conn.cfgt = lambda: u'2000'
+        db = self.load(conn)
+        self.assertEqual(db.last_config_time, u'2000')
+        self.assertEqual(len(db.ordered_fields), len(self.db.ordered_fields))
+
+    def test_06_bad_file(self):
+        """ Unreadable snapshots and other versions are ignored """
+        conn = sqlite3.connect(self.path)
+        conn.execute("UPDATE info SET value = '0' WHERE name = 'version'")
+        conn.commit()
+        conn.close()
+        self.assertEqual(metadata.open_snapshot(self.path), None)
+        open(self.path, 'w').write('garbage')
+        self.assertEqual(metadata.open_snapshot(self.path), None)
+        self.load(FakeServerConnectionForDB(self.server))
+
+    def test_07_replace(self):
+        """ Writing replaces the snapshot, leaving no temporary files """
+        metadata.write_snapshot(self.db, self.path)
+        self.assertEqual(os.listdir(self.dir), [os.path.basename(self.path)])
+
+
+classes = (
+           T01_Snapshot,
+          )
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    suites = []
+    for cl in classes:
+        suites.append(unittest.makeSuite(cl, 'test'))
+    runner.run(unittest.TestSuite(suites))
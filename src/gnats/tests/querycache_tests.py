@@ -0,0 +1,259 @@
+#!/usr/bin/python
+"""
+Unit tests for gnats QueryCache, and its use by DatabaseHandle.query()
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import time
+import unittest
+
+# Shut up logging during the tests
+import logging
+logging.disable(logging.FATAL)
+
+import gnats
+from gnats import Database, QueryCache
+from gnats import querycache
+from gnats.server import Row
+from gnats.tests.database_tests import FakeServerConnectionForDB
+
+class FakeDB(object):
+    last_config_time = u'1000'
+
+class FakeDBH(object):
+    """ Just enough of a DatabaseHandle for QueryCache.get(). """
+
+    def __init__(self):
+        self.database = FakeDB()
+        self.changed = False
+        self.probes = []
+
+    def _pr_changes_since(self, when):
+        self.probes.append(when)
+        return self.changed
+
+
+class T01_QueryCache(unittest.TestCase):
+    """ QueryCache on its own """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.cache = QueryCache(max_bytes=10000, ttl=60, probe_interval=None)
+        self.dbh = FakeDBH()
+        self.key = self.cache.key('user', 'foo', ['number'], None, None, None)
+        self.rows = [['1'], ['2']]
+
+    def put(self, key=None, rows=None, stored=None):
+        self.cache.put(key or self.key, rows or self.rows, u'1000', stored)
+
+    def test_01_miss_then_hit(self):
+        """ Miss, then a hit after put() """
+        self.assertEqual(self.cache.get(self.key, self.dbh), None)
+        self.put()
+        self.assertEqual(self.cache.get(self.key, self.dbh), self.rows)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_02_copy(self):
+        """ get() returns a new list each time """
+        self.put()
+        self.cache.get(self.key, self.dbh).append(['3'])
+        self.assertEqual(self.cache.get(self.key, self.dbh), self.rows)
+
+    def test_03_ttl(self):
+        """ Entries expire after ttl seconds """
+        self.put(stored=time.time() - 61)
+        self.assertEqual(self.cache.get(self.key, self.dbh), None)
+        self.assertEqual(self.cache.invalidations, 1)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_04_config_time(self):
+        """ Entries go stale when CFGT changes """
+        self.put()
+        self.dbh.database.last_config_time = u'2000'
+        self.assertEqual(self.cache.get(self.key, self.dbh), None)
+
+    def test_05_probe_changed(self):
+        """ Probe finding modified PRs drops the entry """
+        self.cache.probe_interval = 0
+        stored = time.time()
+        self.put(stored=stored)
+        self.dbh.changed = True
+        self.assertEqual(self.cache.get(self.key, self.dbh), None)
+        self.assertEqual(self.dbh.probes, [stored - self.cache.probe_slack])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_06_probe_unchanged(self):
+        """ Probe finding nothing keeps the entry, and moves the check time """
+        self.cache.probe_interval = 10
+        self.put(stored=time.time() - 20)
+        self.assertEqual(self.cache.get(self.key, self.dbh), self.rows)
+        self.assertEqual(self.cache.get(self.key, self.dbh), self.rows)
+        self.assertEqual(len(self.dbh.probes), 1)
+
+    def test_07_no_probe(self):
+        """ No probe with probe_interval None """
+        self.put(stored=time.time() - 30)
+        self.cache.get(self.key, self.dbh)
+        self.assertEqual(self.dbh.probes, [])
+
+    def test_08_lru(self):
+        """ Least recently used entries are evicted to make room """
+        self.cache.max_bytes = 3 * querycache._result_size(self.rows)
+        keys = [self.cache.key('user', str(i), ['number'], None, None, None)
+                for i in range(4)]
+        for key in keys[:3]:
+            self.put(key)
+        self.cache.get(keys[0], self.dbh)
+        self.put(keys[3])
+        self.assertEqual(self.cache.evictions, 1)
+        self.assertEqual(self.cache.get(keys[1], self.dbh), None)
+        self.assertEqual(self.cache.get(keys[0], self.dbh), self.rows)
+        self.assertEqual(self.cache.size, self.cache.max_bytes)
+
+    def test_09_too_big(self):
+        """ Results bigger than the cache are not kept """
+        self.cache.max_bytes = 10
+        self.put()
+        self.assertEqual(len(self.cache), 0)
+
+    def test_10_clear(self):
+        """ clear() drops everything """
+        self.put()
+        self.cache.clear()
+        self.assertEqual(self.cache.stats(),
+                         {'hits': 0, 'misses': 0, 'evictions': 0,
+                          'invalidations': 1, 'entries': 0, 'bytes': 0})
+
+    def test_11_key(self):
+        """ Keys are normalized """
+        self.assertEqual(
+            self.cache.key('u', ' x ', 'number', (('Number', 'DESC'),),
+                           {'b': ['c'], 'a': ['d']}, [2, '1']),
+            self.cache.key('u', 'x', ['number'], [('number', 'desc')],
+                           {'a': ['d'], 'b': ['c']}, ['1', '2']))
+        self.assertNotEqual(self.cache.key('u', 'x', ['a'], None, None, None),
+                            self.cache.key('v', 'x', ['a'], None, None, None))
+
+    def test_11a_window_key(self):
+        """ Windows of a query have their own keys """
+        whole = self.cache.key('u', 'x', ['a'], None, None, None)
+        self.assertEqual(self.cache.key('u', 'x', ['a'], None, None, None,
+                                        (None, 0)), whole)
+        self.assertNotEqual(self.cache.key('u', 'x', ['a'], None, None, None,
+                                           (50, 0)), whole)
+
+    def test_12_row_size(self):
+        """ Undecoded Rows are sized by their share of the reply """
+        row = Row('x' * 100)
+        self.assertEqual(querycache._result_size(row),
+                         querycache._ROW_OVERHEAD + 100)
+
+
+class T02_CachedQuery(unittest.TestCase):
+    """ DatabaseHandle.query() with a query cache """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.cache = self.db.enable_query_cache(
+            QueryCache(probe_interval=None))
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.conn.rset = lambda: 'Ok.'
+        self.conn.qfmt = lambda format: 'Ok.'
+        self.conn.expr = self.my_expr
+        self.conn.quer = self.my_quer
+        self.exprs = []
+        self.quers = 0
+
+    def my_expr(self, expr):
+        self.exprs.append(expr)
+        return 'Ok.'
+
+    def my_quer(self, prs='', parse=False):
+        self.quers += 1
+        return [['1', 'a'], ['2', 'b']]
+
+    def test_01_cached(self):
+        """ A repeated query is answered from the cache """
+        first = self.dbh.query('foo', ['number', 'synopsis'])
+        second = self.dbh.query('foo', ['number', 'synopsis'])
+        self.assertEqual(first, second)
+        self.assertEqual(self.quers, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_02_other_user(self):
+        """ Other users don't share entries """
+        self.dbh.query('foo', ['number'])
+        self.db.get_handle('other', 'pass', self.conn).query('foo', ['number'])
+        self.assertEqual(self.quers, 2)
+
+    def test_03_sorted(self):
+        """ Sorted results are cached sorted """
+        self.dbh.query('foo', ['number'], sort=[('number', 'desc')])
+        self.assertEqual(self.dbh.query('foo', ['number'],
+                                        sort=[('number', 'desc')]),
+                         [['2', 'b'], ['1', 'a']])
+        self.assertEqual(self.quers, 1)
+
+    def test_04_cfgt_change(self):
+        """ A metadata refresh clears the cache """
+        self.dbh.query('foo', ['number'])
+        self.conn.cfgt = lambda: u'2000'
+        self.db._get_metadata = lambda conn: None
+        self.db.update_metadata(self.conn)
+        self.assertEqual(len(self.cache), 0)
+
+    def test_05_probe(self):
+        """ _pr_changes_since() queries for newer last-modified values """
+        self.db.builtin = lambda name: {'last-modified':
+                                        'last-modified'}.get(name, '')
+        self.assertTrue(self.dbh._pr_changes_since(0))
+        self.assertEqual(self.exprs,
+                         ['last-modified>"1970-01-01 00:00:00 GMT"'])
+        self.conn.quer = lambda prs='', parse=False: None
+        self.assertFalse(self.dbh._pr_changes_since(0))
+
+    def test_06_probe_no_field(self):
+        """ _pr_changes_since() without a last-modified field says True """
+        self.db.builtin = lambda name: ''
+        self.assertTrue(self.dbh._pr_changes_since(0))
+        self.assertEqual(self.quers, 0)
+
+    def test_06a_probe_new_pr(self):
+        """ _pr_changes_since() also finds newly submitted PRs """
+        self.db.builtin = lambda name: name
+        def quer(prs='', parse=False):
+            if 'arrival-date>"1970-01-01 00:00:00 GMT"' in self.exprs[-1]:
+                return [['3']]
+            return None
+        self.conn.quer = quer
+        self.assertTrue(self.dbh._pr_changes_since(0))
+        self.assertEqual(self.exprs,
+                         ['last-modified>"1970-01-01 00:00:00 GMT" | '
+                          'arrival-date>"1970-01-01 00:00:00 GMT"'])
+
+    def test_07_window(self):
+        """ Pages are cached apart from the whole result, totals aren't """
+        self.conn.quer_iter = lambda prs='': iter(self.my_quer(prs))
+        self.dbh.query('foo', ['number'], limit=1)
+        self.assertEqual(self.dbh.query('foo', ['number']),
+                         [['1', 'a'], ['2', 'b']])
+        self.assertEqual(self.dbh.query('foo', ['number'], total=True),
+                         ([['1', 'a'], ['2', 'b']], 2))
+        self.assertEqual(len(self.cache), 2)
+
+
+classes = (
+           T01_QueryCache,
+           T02_CachedQuery,
+          )
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    suites = []
+    for cl in classes:
+        suites.append(unittest.makeSuite(cl, 'test'))
+    runner.run(unittest.TestSuite(suites))
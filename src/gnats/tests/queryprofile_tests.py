@@ -0,0 +1,168 @@
+#!/usr/bin/python
+"""
+Unit tests for gnats QueryProfiler, and its use by DatabaseHandle.query()
+
+Copyright (c) 2026, Juniper Networks, Inc.
+All rights reserved.
+"""
+import json
+import time
+import unittest
+from StringIO import StringIO
+
+# Shut up logging during the tests
+import logging
+logging.disable(logging.FATAL)
+
+import gnats
+from gnats import Database, QueryCache, QueryProfiler
+from gnats.tests.database_tests import FakeServerConnectionForDB
+
+class T01_QueryProfiler(unittest.TestCase):
+    """ QueryProfiler on its own """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.profiler = QueryProfiler(max_profiles=3)
+
+    def profile(self, expr, seconds):
+        profile = self.profiler.start('user', expr, ['number'], None, None,
+                                      None, 0)
+        profile.started -= seconds
+        profile._last = profile.started
+        self.profiler.finish(profile, 1, 10)
+        return profile
+
+    def test_01_phases(self):
+        """ Marks add up the time between them; earlier times are ignored """
+        profile = self.profiler.start('user', 'foo', 'number',
+                                      [('number', 'asc')], ['1', '2'], 5, 0)
+        start = profile.started
+        profile.mark_timings({'sent': start + 1, 'reply': start + 3,
+                              'parsed': start + 4})
+        profile.mark('sort', start + 3.5)
+        self.assertEqual(profile.phases, {'setup': 1.0, 'evaluate': 2.0,
+                                          'parse': 1.0})
+        self.profiler.finish(profile, 2, 100)
+        self.assertFalse('other' in profile.phases)
+        self.assertEqual(profile.field_names, ['number'])
+        self.assertEqual(profile.prs, 2)
+
+    def test_02_slowest(self):
+        """ The slowest of the last max_profiles queries """
+        for expr, seconds in (('a', 5), ('b', 1), ('c', 3), ('d', 2)):
+            self.profile(expr, seconds)
+        self.assertEqual([p.expr for p in self.profiler.slowest(2)],
+                         ['c', 'd'])
+        self.assertEqual(len(self.profiler.profiles()), 3)
+        self.profiler.clear()
+        self.assertEqual(self.profiler.profiles(), [])
+
+    def test_03_min_seconds(self):
+        """ Fast queries are not kept """
+        self.profiler.min_seconds = 2
+        self.profile('a', 1)
+        self.profile('b', 3)
+        self.assertEqual([p.expr for p in self.profiler.profiles()], ['b'])
+
+    def test_04_json(self):
+        """ Profiles are dumped as a JSON list """
+        self.profile(u'synopsis~"caf\xe9"', 1)
+        out = StringIO()
+        self.profiler.dump(out)
+        self.assertEqual(json.loads(out.getvalue()),
+                         json.loads(self.profiler.to_json()))
+        profile = json.loads(out.getvalue())[0]
+        self.assertEqual(profile['expr'], u'synopsis~"caf\xe9"')
+        self.assertEqual(profile['expr_length'], 15)
+        self.assertEqual((profile['rows'], profile['bytes']), (1, 10))
+
+
+class T02_ProfiledQuery(unittest.TestCase):
+    """ DatabaseHandle.query() with a query profiler """
+
+    def setUp(self):
+        unittest.TestCase.setUp(self)
+        self.server = gnats.Server('somehost')
+        self.conn = FakeServerConnectionForDB(self.server)
+        self.db = Database(self.server, 'testdb', self.conn)
+        self.profiler = self.db.enable_query_profiler()
+        self.dbh = self.db.get_handle('user', 'pass', self.conn)
+        self.conn.rset = lambda: 'Ok.'
+        self.conn.qfmt = lambda format: 'Ok.'
+        self.conn.expr = lambda expr: 'Ok.'
+        self.conn.quer = self.my_quer
+        self.conn.quer_iter = lambda prs='': iter(self.my_quer(prs))
+
+    def my_quer(self, prs='', parse=False):
+        # As ServerConnection would fill in its timings
+        timings = getattr(self.conn, 'timings', None)
+        if timings is not None:
+            now = time.time()
+            for key in ('sent', 'reply', 'read', 'parsed'):
+                timings[key] = now
+        return [['1', 'a'], ['2', 'b']]
+
+    def test_01_query(self):
+        """ Each query's phases, rows and expression are recorded """
+        self.dbh.query('foo', ['number', 'synopsis'],
+                       sort=[('number', 'desc')])
+        profile, = self.profiler.profiles()
+        self.assertEqual(profile.expr, 'foo')
+        self.assertEqual(profile.rows, 2)
+        self.assertEqual(profile.sort, [['number', 'desc']])
+        self.assertFalse(profile.cached)
+        for phase in ('setup', 'evaluate', 'transfer', 'parse', 'sort'):
+            self.assertTrue(phase in profile.phases, phase)
+        self.assertTrue(abs(sum(profile.phases.values()) -
+                            profile.seconds) < 0.001)
+        self.assertEqual(self.conn.timings, None)
+
+    def test_02_error(self):
+        """ Failed queries are recorded with their error """
+        def quer(prs='', parse=False):
+            raise gnats.GnatsException("Invalid expression")
+        self.conn.quer = quer
+        self.assertRaises(gnats.GnatsException, self.dbh.query, 'foo',
+                          ['number'])
+        self.assertEqual(self.profiler.profiles()[0].error,
+                         "Invalid expression")
+
+    def test_03_cached(self):
+        """ Queries answered from the cache are marked """
+        self.db.enable_query_cache(QueryCache(probe_interval=None))
+        self.dbh.query('foo', ['number'])
+        self.dbh.query('foo', ['number'])
+        first, second = self.profiler.profiles()
+        self.assertFalse(first.cached)
+        self.assertTrue(second.cached)
+        self.assertTrue('cache' in second.phases)
+        self.assertFalse('evaluate' in second.phases)
+
+    def test_04_window(self):
+        """ Streamed queries record their transfer and total """
+        self.assertEqual(self.dbh.query('foo', ['number'], limit=1,
+                                        total=True),
+                         ([['1', 'a']], 2))
+        profile, = self.profiler.profiles()
+        self.assertEqual((profile.rows, profile.limit), (1, 1))
+        self.assertTrue('transfer' in profile.phases)
+
+    def test_05_off(self):
+        """ Nothing is recorded once the profiler is removed """
+        self.db.query_profiler = None
+        self.dbh.query('foo', ['number'])
+        self.assertEqual(self.profiler.profiles(), [])
+
+
+classes = (
+           T01_QueryProfiler,
+           T02_ProfiledQuery,
+          )
+
+if __name__ == '__main__':
+    runner = unittest.TextTestRunner(verbosity=2)
+    suites = []
+    for cl in classes:
+        suites.append(unittest.makeSuite(cl, 'test'))
+    runner.run(unittest.TestSuite(suites))
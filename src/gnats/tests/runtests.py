@@ -5,11 +5,21 @@ import unittest
 from gnats.tests import database_tests
 from gnats.tests import server_tests
 from gnats.tests import dbhandle_tests
+from gnats.tests import asyncserver_tests
+from gnats.tests import querycache_tests
+from gnats.tests import metadata_tests
+from gnats.tests import auditdb_tests
+from gnats.tests import queryprofile_tests
 
 modules = (
            server_tests,
            database_tests,
            dbhandle_tests,
+           asyncserver_tests,
+           querycache_tests,
+           metadata_tests,
+           auditdb_tests,
+           queryprofile_tests,
            )
 
 def run_all_suites(verbosity):
@@ -63,6 +63,8 @@ def setup_fake_socket_server_and_connection():
     server.socket = sockmock
     # Needed for error testing
     server.socket.error = socket.error
+    # The mocks above provide makefile(), see T08_SocketReader for the rest
+    gnats.recv_reader = False
     srv = Server('somehost')
     fake_sfile.set_reply_buf("200 somehost GNATS server 4.0-DEV ready.")
     conn = srv.get_connection()
@@ -422,6 +424,100 @@ class T04_Protocol_get_reply(unittest.TestCase):
             self.assertTrue(e.message.find('XXX') > -1 and
                             e.message.find('YYY') > -1)
 
+    def test_20_timings(self):
+        """ _get_reply records the times of a data reply in timings """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n'
+                                      'pr\037l1\036\r\n.\r\n')
+        self.conn.timings = {}
+        self.conn._get_reply(True)
+        self.assertEquals(sorted(self.conn.timings),
+                          ['parsed', 'read', 'reply'])
+        self.assertTrue(self.conn.timings['reply'] <=
+                        self.conn.timings['read'] <=
+                        self.conn.timings['parsed'])
+
+
+class T04a_Protocol_command_iter(unittest.TestCase):
+    """ Test Connection.command_iter() (streamed replies). """
+
+    def setUp(self):
+        self.fake_sfile, self.srv, self.conn = \
+            setup_fake_socket_server_and_connection()
+
+    def records(self, *recs):
+        return ''.join([codes.FIELD_SEP.join(rec) + codes.RECORD_SEP + '\r\n'
+                        for rec in recs])
+
+    def test_01_command_iter_sends_input(self):
+        """ command_iter sends the command """
+        self.fake_sfile.set_reply_buf('220 No PRs Matched.\r\n')
+        self.conn.command_iter('QUER')
+        self.assertEquals(self.fake_sfile.inputs, ['QUER', '\n'])
+
+    def test_02_command_iter_parses_records(self):
+        """ command_iter yields parsed records """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n' +
+            self.records(['1', 'a'], ['2', 'b\nc']) + '.\r\n')
+        self.assertEquals(list(self.conn.command_iter('QUER')),
+                          [['1', 'a'], ['2', 'b\nc']])
+
+    def test_03_command_iter_reads_lazily(self):
+        """ command_iter only reads as far as the records handed out """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n' +
+            self.records(['1', 'a'], ['2', 'b'], ['3', 'c']) + '.\r\n')
+        stream = self.conn.command_iter('QUER')
+        self.assertEquals(stream.next(), ['1', 'a'])
+        self.assertEquals(len(self.fake_sfile.reply_buf), 3)
+
+    def test_04_command_iter_no_prs_matched(self):
+        """ command_iter returns an empty iterator on NO_PRS_MATCHED """
+        self.fake_sfile.set_reply_buf('220 No PRs Matched.\r\n')
+        self.assertEquals(list(self.conn.command_iter('QUER')), [])
+
+    def test_05_command_iter_error_state(self):
+        """ command_iter raises on an error state before iterating """
+        self.fake_sfile.set_reply_buf('415 Invalid expression.\r\n')
+        self.failUnlessRaises(gnats.GnatsException,
+                              self.conn.command_iter, 'QUER')
+
+    def test_06_command_iter_unescape_period(self):
+        """ command_iter unescapes periods """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n' +
+            '..' + self.records(['x', 'y']) + '.\r\n')
+        self.assertEquals(list(self.conn.command_iter('QUER')), [['.x', 'y']])
+
+    def test_07_command_iter_early_eof(self):
+        """ command_iter raises on unexpected EOF """
+        self.fake_sfile.set_reply_buf(['300 PRs follow.\r\n',
+                                       self.records(['1', 'a']), ''])
+        stream = self.conn.command_iter('QUER')
+        self.assertEquals(stream.next(), ['1', 'a'])
+        self.failUnlessRaises(GnatsNetworkException, stream.next)
+
+    def test_08_command_drains_stream(self):
+        """ command() throws away the rest of an unfinished stream """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n' +
+            self.records(['1', 'a'], ['2', 'b']) + '.\r\n210 Ok.\r\n')
+        stream = self.conn.command_iter('QUER')
+        stream.next()
+        self.assertEquals(self.conn.command('RSET'), ['Ok.'])
+        self.assertEquals(list(stream), [])
+
+    def test_09_close_drains_stream(self):
+        """ Closing the iterator throws away the rest of the output """
+        self.fake_sfile.set_reply_buf('300 PRs follow.\r\n' +
+            self.records(['1', 'a'], ['2', 'b']) + '.\r\n210 Ok.\r\n')
+        stream = self.conn.command_iter('QUER')
+        stream.close()
+        self.assertEquals(self.fake_sfile.reply_buf, ['210 Ok.\r\n'])
+        self.assertEquals(self.conn._stream, None)
+
+    def test_10_quer_iter(self):
+        """ quer_iter sends QUER with the PR numbers """
+        self.fake_sfile.set_reply_buf('220 No PRs Matched.\r\n')
+        self.conn.quer_iter(('123', '456'))
+        self.assertEquals(self.fake_sfile.inputs, ['QUER 123 456', '\n'])
+
 
 class T05_UtilityMethods(unittest.TestCase):
     """ Test utility methods. """
@@ -892,14 +988,526 @@ class T06_ProtocolCmdMethods(unittest.TestCase):
         self.assertEquals(self.cmd_in, 'HELP')
 
 
+class FakePooledConnection(object):
+    """ Stand-in for a ServerConnection handed out by a ConnectionPool. """
+
+    def __init__(self):
+        self.broken = False
+        self.chdb_state = None
+        self.access_level = None
+        self._stream = None
+        self.rset_error = None
+        self.chdb_calls = []
+        self.rsets = 0
+        self.closed = False
+        self._sock = self
+
+    def rset(self):
+        self.rsets += 1
+        if self.rset_error is not None:
+            raise self.rset_error
+
+    def chdb(self, dbname, user='', passwd=''):
+        self.chdb_calls.append((dbname, user, passwd))
+        self.chdb_state = (dbname, user, passwd)
+        self.access_level = 'edit'
+        return 'edit'
+
+    def close(self):
+        self.closed = True
+
+
+class T07_ConnectionPool(unittest.TestCase):
+    """ Test server.ConnectionPool. """
+
+    def setUp(self):
+        self.fake_sfile, self.srv, __ = \
+            setup_fake_socket_server_and_connection()
+        self.opened = []
+        self.srv.get_connection = self.fake_get_connection
+        self.pool = server.ConnectionPool(self.srv, 2, 120)
+
+    def fake_get_connection(self, conn=None):
+        conn = FakePooledConnection()
+        self.opened.append(conn)
+        return conn
+
+    def test_01_server_has_pool(self):
+        """ Server creates a pool with its size and idle timeout """
+        srv = Server('somehost', pool_size=3, pool_idle_timeout=5)
+        self.assertEquals(srv.pool.max_size, 3)
+        self.assertEquals(srv.pool.idle_timeout, 5)
+
+    def test_02_reuses_idle(self):
+        """ get() hands out the connection put back, after an RSET """
+        conn = self.pool.get()
+        self.assertEquals(conn.rsets, 0)
+        self.pool.put(conn)
+        self.assert_(self.pool.get() is conn)
+        self.assertEquals(conn.rsets, 1)
+        self.assertEquals(len(self.opened), 1)
+
+    def test_03_chdb_when_needed(self):
+        """ get() only sends CHDB when db or user differ """
+        conn = self.pool.get('db1', 'user1', 'pw')
+        self.assertEquals(conn.chdb_calls, [('db1', 'user1', 'pw')])
+        self.pool.put(conn)
+        self.pool.put(self.pool.get('db1', 'user1', 'pw'))
+        self.assertEquals(len(conn.chdb_calls), 1)
+        self.pool.get('db1', 'user2', 'pw')
+        self.assertEquals(conn.chdb_calls[-1], ('db1', 'user2', 'pw'))
+
+    def test_04_replaces_dead(self):
+        """ A connection that fails RSET is closed and replaced """
+        conn = self.pool.get()
+        self.pool.put(conn)
+        conn.rset_error = GnatsNetworkException('gone')
+        conn2 = self.pool.get()
+        self.assert_(conn2 is not conn)
+        self.assert_(conn.closed)
+        self.assertEquals(self.pool._size, 1)
+
+    def test_05_discards_broken(self):
+        """ put() closes broken connections and frees their slot """
+        conn = self.pool.get()
+        conn.broken = True
+        self.pool.put(conn)
+        self.assert_(conn.closed)
+        self.assertEquals(self.pool._size, 0)
+        self.assertEquals(self.pool._idle, [])
+
+    def test_06_expires_idle(self):
+        """ Connections idle longer than idle_timeout are closed """
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.pool._idle[0] = (conn, self.pool._idle[0][1] - 121)
+        self.assert_(self.pool.get() is not conn)
+        self.assert_(conn.closed)
+
+    def test_07_wait_timeout(self):
+        """ get() raises when the pool stays exhausted """
+        self.pool.wait_timeout = 0.01
+        self.pool.get()
+        self.pool.get()
+        self.assertRaises(gnats.GnatsException, self.pool.get)
+
+    def test_08_waits_for_put(self):
+        """ get() on an exhausted pool returns the next connection put back """
+        import threading
+        conn = self.pool.get()
+        self.pool.get()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.pool.get()))
+        waiter.start()
+        self.pool.put(conn)
+        waiter.join(5)
+        self.assertEquals(got, [conn])
+
+    def test_09_failed_chdb_discards(self):
+        """ A connection is closed if CHDB fails """
+        def bad_chdb(*args):
+            raise GnatsAccessException('denied')
+        conn = self.pool.get()
+        self.pool.put(conn)
+        conn.chdb = bad_chdb
+        self.assertRaises(GnatsAccessException, self.pool.get, 'db1', 'x')
+        self.assert_(conn.closed)
+        self.assertEquals(self.pool._size, 0)
+
+    def test_10_network_error_marks_broken(self):
+        """ A network error flags a ServerConnection as broken """
+        self.fake_sfile.set_reply_buf("200 somehost GNATS server 4.0-DEV ready.")
+        conn = server.ServerConnection(self.srv)
+        self.fake_sfile.readline = lambda: ''
+        self.assertRaises(GnatsNetworkException, conn.rset)
+        self.assert_(conn.broken)
+
+    def test_11_chdb_state(self):
+        """ chdb() and user() record the login state """
+        self.fake_sfile.set_reply_buf("200 somehost GNATS server 4.0-DEV ready.")
+        conn = server.ServerConnection(self.srv)
+        conn.command = lambda cmd: ["Now accessing GNATS database 'db1'",
+                                    "User access level set to 'edit'"]
+        conn.chdb('db1', 'u1', 'p1')
+        self.assertEquals(conn.chdb_state, ('db1', 'u1', 'p1'))
+        self.assertEquals(conn.access_level, 'edit')
+        conn.user('u2', 'p2')
+        self.assertEquals(conn.chdb_state, ('db1', 'u2', 'p2'))
+
+
+class FakeRecvSocket(object):
+    """ Socket that hands out the given reply in chunks of chunk_size bytes
+    on successive recv_into() calls, and records sendall() data. """
+
+    def __init__(self, reply, chunk_size):
+        self.reply = reply
+        self.chunk_size = chunk_size
+        self.sent = []
+
+    def recv_into(self, buf):
+        size = min(self.chunk_size, len(buf))
+        chunk = self.reply[:size]
+        self.reply = self.reply[size:]
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+
+    def sendall(self, data):
+        self.sent.append(data)
+
+
+class T08_SocketReader(unittest.TestCase):
+    """ Test server._SocketReader, and reading replies through it. """
+
+    def setUp(self):
+        self.fake_sfile, self.srv, self.conn = \
+            setup_fake_socket_server_and_connection()
+
+    def reader(self, reply, chunk_size=3, bufsize=5):
+        self.sock = FakeRecvSocket(reply, chunk_size)
+        return server._SocketReader(self.sock, bufsize)
+
+    def test_01_readline(self):
+        """ readline() returns lines across chunk boundaries """
+        rdr = self.reader('line one\r\nl2\n\nrest')
+        self.assertEquals(rdr.readline(), 'line one\r\n')
+        self.assertEquals(rdr.readline(), 'l2\n')
+        self.assertEquals(rdr.readline(), '\n')
+        self.assertEquals(rdr.readline(), 'rest')
+        self.assertEquals(rdr.readline(), '')
+
+    def test_02_read_block(self):
+        """ read_block() returns output up to the terminator line """
+        rdr = self.reader('a\r\n..b\r\n.\r\n201 bye\r\n')
+        self.assertEquals(rdr.read_block(), 'a\r\n..b\r\n')
+        self.assertEquals(rdr.readline(), '201 bye\r\n')
+
+    def test_03_read_block_empty(self):
+        """ read_block() handles empty output """
+        rdr = self.reader('.\r\n210 ok\r\n', 1)
+        self.assertEquals(rdr.read_block(), '')
+        self.assertEquals(rdr.readline(), '210 ok\r\n')
+
+    def test_04_read_block_eof(self):
+        """ read_block() returns None on EOF """
+        self.assertEquals(self.reader('a\r\nb\r\n').read_block(), None)
+
+    def test_05_write_flush(self):
+        """ Writes are sent on flush() """
+        rdr = self.reader('')
+        rdr.write('QUER')
+        rdr.write('\n')
+        self.assertEquals(self.sock.sent, [])
+        rdr.flush()
+        self.assertEquals(self.sock.sent, ['QUER\n'])
+
+    reply = ('300 PRs follow.\r\n'
+             'line 1\r\n'
+             '..l2\r\n'
+             'l3  \r\n'
+             '.\r\n')
+    parsed_reply = ('300 PRs follow.\r\n' +
+                    codes.FIELD_SEP.join(['pr', 'l1']) + codes.RECORD_SEP +
+                    '\r\n..pr' + codes.FIELD_SEP + 'l2\n' +
+                    'more' + codes.RECORD_SEP + '\r\n.\r\n')
+
+    def test_06_read_server(self):
+        """ Unparsed output matches what the makefile path returns """
+        self.fake_sfile.set_reply_buf(self.reply)
+        expected = self.conn._get_reply(False)
+        for chunk_size in (1, 2, 7, 100):
+            self.conn._sfile = self.reader(self.reply, chunk_size)
+            self.assertEquals(self.conn._get_reply(False), expected)
+        self.assertEquals(expected, ['line 1', '.l2', 'l3'])
+
+    def test_07_read_server_parsed(self):
+        """ Parsed output matches what the makefile path returns """
+        self.fake_sfile.set_reply_buf(self.parsed_reply)
+        expected = self.conn._get_reply(True)
+        for chunk_size in (1, 2, 7, 100):
+            self.conn._sfile = self.reader(self.parsed_reply, chunk_size)
+            self.assertEquals(self.conn._get_reply(True), expected)
+        self.assertEquals(expected, [['pr', 'l1'], ['.pr', 'l2\nmore']])
+
+    def test_08_read_server_eof(self):
+        """ EOF in the middle of output raises GnatsNetworkException """
+        self.conn._sfile = self.reader('300 PRs follow.\r\nline 1\r\n')
+        self.assertRaises(GnatsNetworkException, self.conn._get_reply, False)
+        self.assert_(self.conn.broken)
+
+    def test_09_read_server_socketerror(self):
+        """ socket.error raises GnatsNetworkException """
+        def raising_recv_into(buf):
+            raise socket.error(104, 'reset')
+        self.conn._sfile = self.reader('')
+        self.sock.recv_into = raising_recv_into
+        self.assertRaises(GnatsNetworkException, self.conn._get_reply, False)
+
+
+class T09_Pipeline(unittest.TestCase):
+    """ Test server.Pipeline. """
+
+    def setUp(self):
+        self.fake_sfile, self.srv, self.conn = \
+            setup_fake_socket_server_and_connection()
+        self.flushes = 0
+        self.fake_sfile.flush = self.count_flush
+
+    def count_flush(self):
+        self.flushes += 1
+
+    def test_01_one_flush(self):
+        """ All commands are sent with one flush, replies come in order """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n"
+                                      "210 Ok.\r\n"
+                                      "300 PRs follow.\r\n"
+                                      "line 1\r\n"
+                                      ".\r\n")
+        pipe = self.conn.pipeline()
+        pipe.rset().qfmt('fmt')
+        pipe.quer('123')
+        self.assertEquals(len(pipe), 3)
+        self.assertEquals(pipe.execute(), [['Reset.'], ['Ok.'], ['line 1']])
+        self.assertEquals(self.fake_sfile.inputs,
+                          ['RSET', '\n', 'QFMT fmt', '\n', 'QUER 123', '\n'])
+        self.assertEquals(self.flushes, 1)
+        self.assertEquals(len(pipe), 0)
+
+    def test_02_empty(self):
+        """ An empty pipeline sends nothing """
+        self.assertEquals(self.conn.pipeline().execute(), [])
+        self.assertEquals(self.fake_sfile.inputs, [])
+
+    def test_03_error_attribution(self):
+        """ The first failure is raised with its command, after all replies
+        have been read """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n"
+                                      "432 Invalid expression.\r\n"
+                                      "410 Invalid PR 99.\r\n")
+        pipe = self.conn.pipeline()
+        pipe.rset().expr('bad').quer('99')
+        try:
+            pipe.execute()
+            self.fail("Didn't raise as expected")
+        except gnats.GnatsException, e:
+            self.assertEquals(e.command, 'EXPR bad')
+            self.assertEquals(e.index, 1)
+            self.assertEquals(e.code, '432')
+        self.assertEquals(self.fake_sfile.reply_buf, [])
+        self.assertFalse(self.conn.broken)
+
+    def test_04_network_error(self):
+        """ Network errors are raised right away """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n")
+        self.fake_sfile.readline = lambda: ''
+        pipe = self.conn.pipeline()
+        pipe.rset().rset()
+        self.assertRaises(GnatsNetworkException, pipe.execute)
+        self.assertTrue(self.conn.broken)
+
+    def test_05_parse(self):
+        """ Parsed QUER output """
+        self.fake_sfile.set_reply_buf("300 PRs follow.\r\n" +
+            codes.FIELD_SEP.join(['pr', 'l1']) + codes.RECORD_SEP + "\r\n"
+            ".\r\n")
+        pipe = self.conn.pipeline()
+        pipe.quer(('1', '2'), parse=True)
+        self.assertEquals(pipe.execute(), [[['pr', 'l1']]])
+        self.assertEquals(self.fake_sfile.inputs, ['QUER 1 2', '\n'])
+
+    def test_06_errors_as_replies(self):
+        """ With raise_errors false, failures take the place of replies """
+        self.fake_sfile.set_reply_buf("350 Text\r\n"
+                                      "435 No such field.\r\n"
+                                      "301 Valid values follow.\r\n"
+                                      "a\r\n"
+                                      ".\r\n")
+        pipe = self.conn.pipeline()
+        pipe.ftyp(['synopsis']).ftypinfo('enum', 'subfields').fvld('enum')
+        replies = pipe.execute(raise_errors=False)
+        self.assertEquals(replies[0], ['Text'])
+        self.assertTrue(isinstance(replies[1], gnats.GnatsException))
+        self.assertEquals(replies[1].command, 'FTYPINFO enum subfields')
+        self.assertEquals(replies[2], ['a'])
+        self.assertEquals(self.fake_sfile.inputs,
+                          ['FTYP synopsis', '\n', 'FTYPINFO enum subfields',
+                           '\n', 'FVLD enum ', '\n'])
+
+    def test_07_lock_unlock(self):
+        """ EDITADDR, LOCKN and UNLK can be pipelined """
+        self.fake_sfile.set_reply_buf("210 Ok.\r\n"
+                                      "210 PR 1 locked.\r\n"
+                                      "210 PR 1 unlocked.\r\n")
+        pipe = self.conn.pipeline()
+        pipe.editaddr('me').lockn('1', 'user', 12, 's1').unlk('1')
+        self.assertEquals(len(pipe.execute()), 3)
+        self.assertEquals(self.fake_sfile.inputs,
+                          ['EDITADDR me', '\n', 'LOCKN 1 user 12 s1', '\n',
+                           'UNLK 1', '\n'])
+
+
+class T10_Row(unittest.TestCase):
+    """ Test server.Row and _split_records(). """
+
+    def setUp(self):
+        self.data = codes.FIELD_SEP.join(['1', 'caf\xe9', 'x']) + \
+            codes.RECORD_SEP + '\r\n' + \
+            codes.FIELD_SEP.join(['2', 'b', 'y']) + codes.RECORD_SEP + '\r\n'
+        self.rows = server._split_records(self.data)
+
+    def test_01_split(self):
+        """ _split_records() finds the records, dropping a partial one """
+        rows = server._split_records(self.data + 'partial')
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(rows, [['1', u'caf\xe9', 'x'], ['2', 'b', 'y']])
+
+    def test_02_lazy(self):
+        """ Fields are split and decoded on first access """
+        row = self.rows[0]
+        self.assertEquals(row._fields, None)
+        self.assertEquals(row[1], u'caf\xe9')
+        self.assertTrue(isinstance(row[1], unicode))
+        self.assertEquals(type(row._fields[0]), str)
+        self.assertEquals(type(row._fields[1]), unicode)
+
+    def test_03_list_behaviour(self):
+        """ Rows index, slice, iterate and compare like lists """
+        row = self.rows[1]
+        self.assertEquals(len(row), 3)
+        self.assertEquals(row[-1], 'y')
+        self.assertEquals(row[1:], ['b', 'y'])
+        self.assertEquals(list(row), ['2', 'b', 'y'])
+        self.assertTrue('b' in row)
+        self.assertEquals(row.index('y'), 2)
+        self.assertEquals(row + ['z'], ['2', 'b', 'y', 'z'])
+        self.assertTrue(['2', 'b', 'y'] == row)
+        self.assertTrue(self.rows[0] < row)
+        self.assertRaises(IndexError, row.__getitem__, 3)
+
+    def test_04_setitem(self):
+        """ Fields can be replaced """
+        row = self.rows[0]
+        row[2] = [['a', 'b']]
+        self.assertEquals(row, ['1', u'caf\xe9', [['a', 'b']]])
+
+    def test_05_copy(self):
+        """ Copies and pickles of Rows are lists """
+        import copy, pickle
+        self.assertEquals(type(copy.copy(self.rows[0])), list)
+        self.assertEquals(pickle.loads(pickle.dumps(self.rows[1])),
+                          ['2', 'b', 'y'])
+
+    def test_06_read_server(self):
+        """ Parsed query output is read into Rows """
+        self.fake_sfile, self.srv, self.conn = \
+            setup_fake_socket_server_and_connection()
+        self.fake_sfile.set_reply_buf(self.data + '..z' + codes.FIELD_SEP +
+                                      'w' + codes.RECORD_SEP + '\r\n.\r\n')
+        out = self.conn._read_server(True)
+        self.assertEquals(out, [['1', u'caf\xe9', 'x'], ['2', 'b', 'y'],
+                                ['.z', 'w']])
+        self.assertTrue(isinstance(out[0], server.Row))
+
+
+class T11_ProtocolStats(unittest.TestCase):
+    """ Per-verb protocol counters """
+
+    def setUp(self):
+        self.fake_sfile, self.srv, self.conn = \
+            setup_fake_socket_server_and_connection()
+        self.hooked = []
+
+    def stats(self, verb):
+        return self.srv.protocol_stats()[verb]
+
+    def test_01_command(self):
+        """ Commands are counted with their bytes """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n")
+        self.conn.rset()
+        stats = self.stats('RSET')
+        self.assertEquals((stats['count'], stats['failed'], stats['bytes_out'],
+                           stats['bytes_in'], stats['records']),
+                          (1, 0, 5, 12, 0))
+        self.assertEquals(sum([n for __, n in stats['histogram']]), 1)
+        self.assertEquals(stats['histogram'][-1][0], None)
+
+    def test_02_records_and_errors(self):
+        """ Output lines are counted, as are failures """
+        self.fake_sfile.set_reply_buf("301 List follows.\r\n"
+                                      "a\r\nb\r\n.\r\n"
+                                      "432 Invalid expression.\r\n")
+        self.conn.list('Categories')
+        self.assertRaises(gnats.GnatsException, self.conn.expr, 'x')
+        self.assertEquals(self.stats('LIST')['records'], 2)
+        self.assertEquals(self.stats('LIST')['bytes_in'], 28)
+        self.assertEquals(self.stats('EXPR')['failed'], 1)
+
+    def test_03_text(self):
+        """ Commands sending text are counted once, with the text """
+        self.fake_sfile.set_reply_buf("212 Ok, send field text now.\r\n"
+                                      "210 Ok.\r\n")
+        self.conn.repl('12', 'synopsis', 'new text')
+        stats = self.stats('REPL')
+        self.assertEquals(stats['count'], 1)
+        self.assertEquals(stats['bytes_out'], len('REPL 12 synopsis ') + 1 +
+                          len('new text') + 4)
+
+    def test_04_pipeline(self):
+        """ Pipelined commands are each counted """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n"
+                                      "210 Ok.\r\n")
+        self.conn.pipeline().rset().qfmt('fmt').execute()
+        self.assertEquals(sorted(self.srv.protocol_stats()), ['QFMT', 'RSET'])
+
+    def test_05_stream(self):
+        """ Streamed commands are counted when their output is read """
+        self.fake_sfile.set_reply_buf("300 PRs follow.\r\n"
+            "1" + codes.RECORD_SEP + "\r\n2" + codes.RECORD_SEP + "\r\n"
+            ".\r\n")
+        records = self.conn.command_iter('QUER')
+        self.assertFalse('QUER' in self.srv.protocol_stats())
+        self.assertEquals(len(list(records)), 2)
+        self.assertEquals(self.stats('QUER')['records'], 2)
+
+    def test_06_network_error(self):
+        """ Commands in flight fail with the connection """
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n")
+        readline = self.fake_sfile.readline
+        self.fake_sfile.readline = lambda: self.fake_sfile.reply_buf and \
+                                           readline() or ''
+        pipe = self.conn.pipeline().rset().qfmt('fmt')
+        self.assertRaises(gnats.GnatsNetworkException, pipe.execute)
+        self.assertEquals(self.stats('RSET')['failed'], 0)
+        self.assertEquals(self.stats('QFMT')['failed'], 1)
+
+    def test_07_hook(self):
+        """ The hook is called for each command; its errors are ignored """
+        def hook(*args):
+            self.hooked.append(args)
+            raise ValueError("hook failed")
+        self.srv.stats.hook = hook
+        self.fake_sfile.set_reply_buf("210 Reset.\r\n")
+        self.conn.rset()
+        self.assertEquals(len(self.hooked), 1)
+        self.assertEquals(self.hooked[0][0], 'RSET')
+        self.assertEquals(self.hooked[0][2:], (5, 12, 0, False))
+        self.srv.stats.reset()
+        self.assertEquals(self.srv.protocol_stats(), {})
+
+
 classes = (
           T01_ServerTest,
           T02_Protocol_command,
           T02a_Protocol_server_reply,
           T03_Protocol_read_server,
           T04_Protocol_get_reply,
+          T04a_Protocol_command_iter,
           T05_UtilityMethods,
           T06_ProtocolCmdMethods,
+          T07_ConnectionPool,
+          T08_SocketReader,
+          T09_Pipeline,
+          T10_Row,
+          T11_ProtocolStats,
          )
 
 if __name__ == '__main__':